@@ -0,0 +1,297 @@
+"""
+@summary: This module decides, before any ClearCase command runs, whether the
+update hook synchronizes a push, defers it to the post-receive hook or
+rejects it ([admission] section of the configuration).
+
+The cost of a push is estimated counting the cleartool commands its
+synchronization needs: checkouts and checkins of the modified files, one
+mkelem per group of new files of the same directory, the directories to
+create (parents of new files missing in the view), the directories checked
+out to add or remove names and the labels requested in its commits. Every
+command is multiplied by its mean duration in the metrics of the previous
+pushes (see Metrics), or by the default latency while there are too few of
+them. Shards are synchronized at the same time, so the estimate is the one of
+the slowest shard.
+
+Deferred pushes are accepted by the update hook without touching ClearCase
+and written commit by commit by the post-receive hook, as in sync_mode:
+replay. The update hook leaves a mark for the post-receive hook of the same
+push and reference in hooks_config/deferred. Marks of pushes whose receive-pack process is
+gone (a post-receive hook that never ran) are removed by the next push.
+
+"""
+
+import errno
+import os
+import urllib
+import Log
+
+from ClearCase import ClearCase
+from CommandEngine import CommandEngine
+from HooksConfig import HooksConfig
+from Metrics import Metrics
+from ViewLock import alive
+
+INLINE = "inline"
+DEFERRED = "deferred"
+REJECTED = "rejected"
+
+DEFERRED_DIR = "hooks_config" + os.sep + "deferred"
+
+
+def _chunks(count):
+
+    size = ClearCase._MAX_PATHS_PER_COMMAND
+
+    return (count + size - 1) // size
+
+
+class PushCost(object):
+
+    """
+    Estimated duration of the ClearCase synchronization of one push.
+    """
+
+    def __init__(self, shards, file_status_list, labels):
+        """
+        Class constructor that counts the cleartool commands of the given
+        files in every shard touching them and estimates their duration.
+
+        """
+
+        config = HooksConfig()
+
+        self._tool = CommandEngine.tool([config.get_cleartool_path()])
+        self._default = config.get_default_latency()
+        self._samples = config.get_latency_samples()
+        self._latencies = {}
+
+        # Cleartool commands of the whole push: {<subcommand>: <count>}
+        self.commands = {}
+        self.seconds = 0.0
+
+        for shard, files in shards.split(file_status_list):
+
+            commands = self._commands(shard, files, labels)
+            seconds = 0.0
+
+            for command, count in commands.items():
+
+                self.commands[command] = self.commands.get(command, 0) + count
+                seconds += count * self._latency(command)
+
+            self.seconds = max(self.seconds, seconds)
+
+    @staticmethod
+    def _commands(shard, file_status_list, labels):
+        """
+        Returns the cleartool commands needed to write the given files in the
+        view of the shard.
+
+        """
+
+        view = shard.view + os.sep
+        modified = 0
+        added = {}
+        changed_dirs = set()
+        removal_dirs = set()
+
+        for git_file in file_status_list:
+
+            ccpath = view + git_file[1]
+
+            if git_file[0] == 'M':
+
+                modified += 1
+
+            else:
+
+                parent = os.path.dirname(ccpath)
+                changed_dirs.add(parent)
+
+                if git_file[0] == 'A':
+
+                    added[parent] = added.get(parent, 0) + 1
+
+                else:
+
+                    removal_dirs.add(parent)
+
+        # Missing directories grouped by parent, as ClearCase.create_paths
+        missing = {}
+        known = set()
+
+        for parent in added:
+
+            current = os.path.normpath(parent)
+
+            while current not in known and not os.path.isdir(current):
+
+                known.add(current)
+                missing.setdefault(os.path.dirname(current),
+                                   set()).add(current)
+                current = os.path.dirname(current)
+
+            known.add(current)
+
+        new_dirs = set()
+
+        for children in missing.values():
+
+            new_dirs.update(children)
+
+        # Existing directories getting new or removed names
+        checkouts = (set(missing) | set(os.path.normpath(directory)
+                                        for directory in changed_dirs))
+        checkouts -= new_dirs
+        labelled = modified + sum(added.values())
+        vobs = len(shard.cc.group_by_vob(
+            [view + git_file[1] for git_file in file_status_list]))
+
+        return {
+            "co": modified + len(checkouts),
+            "ci": modified + len(checkouts) + len(new_dirs),
+            "mkdir": sum(_chunks(len(children))
+                         for children in missing.values()),
+            "mkelem": sum(_chunks(count) for count in added.values()),
+            "rmname": len(removal_dirs),
+            "mklbtype": len(labels) * vobs,
+            "mklabel": len(labels) * (modified + _chunks(labelled)),
+        }
+
+    def _latency(self, command):
+        """
+        Returns the seconds one cleartool command is expected to take.
+
+        """
+
+        if command not in self._latencies:
+
+            latency = Metrics().mean("git2cc_command_duration_seconds",
+                                     self._samples, command=command,
+                                     tool=self._tool)
+
+            if latency is None:
+
+                latency = self._default
+
+            self._latencies[command] = latency
+
+        return self._latencies[command]
+
+    def decision(self):
+        """
+        Returns INLINE, DEFERRED or REJECTED comparing the estimate with the
+        configured limits.
+
+        """
+
+        defer_seconds, reject_seconds = HooksConfig().get_admission_limits()
+
+        if reject_seconds and self.seconds > reject_seconds:
+
+            return REJECTED
+
+        if defer_seconds and self.seconds > defer_seconds:
+
+            return DEFERRED
+
+        return INLINE
+
+
+def _mark(refs, new_revision):
+    """
+    Returns the mark of a deferred update of the reference in the push
+    running the hooks, which have the same parent process, git receive-pack.
+    One push may update several branches to the same revision.
+
+    """
+
+    return os.path.join(DEFERRED_DIR, "%d-%s-%s" % (
+        os.getppid(), new_revision, urllib.quote('/'.join(refs), "")))
+
+
+def _remove_stale_marks():
+    """
+    Removes the marks whose push is no longer running, with the liveness
+    check of the view lock tickets.
+
+    """
+
+    try:
+
+        names = os.listdir(DEFERRED_DIR)
+
+    except OSError as e:
+
+        if e.errno != errno.ENOENT:
+
+            raise
+
+        return
+
+    for name in names:
+
+        owner = name.split('-', 1)[0]
+
+        if not owner.isdigit() or alive(int(owner)):
+
+            continue
+
+        Log.warning("Removing stale deferred mark " + name)
+
+        try:
+
+            os.remove(os.path.join(DEFERRED_DIR, name))
+
+        except OSError as e:
+
+            # Removed by another push at the same time
+            if e.errno != errno.ENOENT:
+
+                raise
+
+
+def defer(refs, new_revision):
+    """
+    Marks the update of the reference to new_revision in this push as
+    deferred to the post-receive hook.
+
+    """
+
+    try:
+
+        os.makedirs(DEFERRED_DIR)
+
+    except OSError as e:
+
+        if e.errno != errno.EEXIST:
+
+            raise
+
+    _remove_stale_marks()
+    open(_mark(refs, new_revision), "w").close()
+
+
+def take_deferred(refs, new_revision):
+    """
+    Checks if the update hook deferred the update of the reference to
+    new_revision in this push, removing the mark.
+
+    """
+
+    _remove_stale_marks()
+
+    try:
+
+        os.remove(_mark(refs, new_revision))
+
+    except OSError as e:
+
+        if e.errno != errno.ENOENT:
+
+            raise
+
+        return False
+
+    return True
@@ -0,0 +1,196 @@
+"""
+@summary: This module turns ClearCase history events (cleartool lshistory)
+into GIT change sets. It is used by the exporters writing ClearCase changes
+into the bare repository (see cc_export.py).
+
+Only two kinds of events change the GIT tree:
+    * Checkins of file versions: the file gets the content of the version.
+    * Checkins of directory versions uncataloguing elements (rmname): the
+      element is deleted.
+
+"""
+
+import hashlib
+import os
+import re
+import time
+
+# Comment ClearCase gives to directory versions when an element is removed
+UNCATALOGED_PATTERN = re.compile(
+    r'Uncataloged (?:file|directory|symbolic link) element "(.+)"\.')
+
+
+class HistoryEvent(object):
+
+    """
+    One event of the ClearCase history.
+    """
+
+    def __init__(self, date, user, operation, kind, element, version,
+                 comment):
+        """
+        Class constructor. The date is given as printed by %Nd in local time:
+        yyyymmdd.hhmmss
+
+        """
+
+        self.date = date
+        self.timestamp = int(time.mktime(time.strptime(date,
+                                                        "%Y%m%d.%H%M%S")))
+        self.user = user
+        self.operation = operation
+        self.kind = kind
+        self.element = os.path.normpath(element)
+        self.version = version
+        self.comment = comment
+
+    def key(self):
+        """
+        Returns the unique identifier of the event.
+
+        """
+
+        return self.element + "@@" + self.version
+
+    def branch(self):
+        """
+        Returns the ClearCase branch of the version: /main/rel_1/5 ->
+        /main/rel_1
+
+        """
+
+        return self.version.rpartition("/")[0]
+
+    def is_file_version(self):
+
+        return self.operation == "checkin" and self.kind == "version"
+
+    def deleted_elements(self):
+        """
+        Returns the paths of the elements removed by a directory version.
+
+        """
+
+        if self.operation != "checkin" or self.kind != "directory version":
+
+            return []
+
+        return [os.path.join(self.element, name)
+                for name in UNCATALOGED_PATTERN.findall(self.comment)]
+
+
+class ChangeSet(object):
+
+    """
+    Events of one user with the same comment close in time, exported as one
+    GIT commit.
+    """
+
+    def __init__(self, event):
+
+        self.user = event.user
+        self.comment = event.comment
+        self.timestamp = event.timestamp
+        self.events = [event]
+
+    def accepts(self, event, window):
+
+        return (event.user == self.user and
+                event.comment == self.comment and
+                event.timestamp - self.timestamp <= window)
+
+    def add(self, event):
+
+        self.events.append(event)
+        self.timestamp = event.timestamp
+
+    def changes(self):
+        """
+        Returns the final state of the change set as (versions, deletions):
+        versions maps every modified file to its last event and deletions is
+        the set of removed paths.
+
+        """
+
+        versions = {}
+        deletions = set()
+
+        for event in self.events:
+
+            if event.is_file_version():
+
+                versions[event.element] = event
+                deletions.discard(event.element)
+
+            for path in event.deleted_elements():
+
+                deletions.add(path)
+                versions.pop(path, None)
+
+        return versions, deletions
+
+    def message(self, default):
+        """
+        Returns the GIT commit message of the change set: its comment (or the
+        given default) and the ClearCase user.
+
+        """
+
+        return ((self.comment.strip() or default) + "\n\nClearCase user: " +
+                self.user + "\n")
+
+
+def group_changesets(events, window):
+    """
+    Groups time ordered events into change sets. A change set is closed when
+    the user or the comment change or after window seconds without events.
+
+    """
+
+    changeset = None
+
+    for event in events:
+
+        if changeset is not None and changeset.accepts(event, window):
+
+            changeset.add(event)
+            continue
+
+        if changeset is not None:
+
+            yield changeset
+
+        changeset = ChangeSet(event)
+
+    if changeset is not None:
+
+        yield changeset
+
+
+def blob_id(data):
+    """
+    Returns the GIT object id of a blob with the given content.
+
+    """
+
+    return hashlib.sha1("blob " + str(len(data)) + "\0" + data).hexdigest()
+
+
+def git_date(timestamp):
+    """
+    Returns the raw GIT date (seconds and local time zone) of a timestamp.
+
+    """
+
+    if time.localtime(timestamp).tm_isdst:
+
+        offset = -time.altzone
+
+    else:
+
+        offset = -time.timezone
+
+    sign = "+" if offset >= 0 else "-"
+    offset = abs(offset) // 60
+
+    return "%d %s%02d%02d" % (timestamp, sign, offset // 60, offset % 60)
@@ -0,0 +1,162 @@
+"""
+@summary: This module keeps track of the ClearCase elements checked out by the
+hooks during one push. Absolute paths are stored in a directory tree (trie)
+so duplicates are ignored, ancestor lookups cost O(depth) and the check in
+order is always bottom-up: children are checked in before their parents.
+
+"""
+
+import os
+
+
+class _Node(object):
+
+    """
+    One directory level of the tree.
+    """
+
+    __slots__ = ("children", "marked")
+
+    def __init__(self):
+        self.children = {}
+        self.marked = False
+
+
+class CheckoutTree(object):
+
+    """
+    Set of checked out paths organised as a directory tree.
+    """
+
+    def __init__(self):
+
+        self._root = _Node()
+        self._count = 0
+
+    @staticmethod
+    def _split(path):
+
+        return [x for x in os.path.abspath(path).split(os.sep) if x]
+
+    def _find(self, path):
+
+        node = self._root
+
+        for name in self._split(path):
+
+            node = node.children.get(name)
+
+            if node is None:
+
+                return None
+
+        return node
+
+    def add(self, path):
+        """
+        Records a checked out path. Returns False when it was already
+        recorded.
+
+        """
+
+        node = self._root
+
+        for name in self._split(path):
+
+            node = node.children.setdefault(name, _Node())
+
+        if node.marked:
+
+            return False
+
+        node.marked = True
+        self._count += 1
+
+        return True
+
+    def remove(self, path):
+        """
+        Forgets a recorded path, for example after checking it in.
+
+        """
+
+        node = self._find(path)
+
+        if node is not None and node.marked:
+
+            node.marked = False
+            self._count -= 1
+
+    def __contains__(self, path):
+
+        node = self._find(path)
+
+        return node is not None and node.marked
+
+    def has_ancestor(self, path):
+        """
+        Returns True when the path or any of its parent directories is
+        recorded.
+
+        """
+
+        node = self._root
+
+        for name in self._split(path):
+
+            node = node.children.get(name)
+
+            if node is None:
+
+                return False
+
+            if node.marked:
+
+                return True
+
+        return False
+
+    def __len__(self):
+
+        return self._count
+
+    def __nonzero__(self):
+
+        return self._count > 0
+
+    def checkin_order(self):
+        """
+        Returns the recorded paths ordered so every path comes before its
+        parent directories (post-order walk of the tree).
+
+        """
+
+        ordered = []
+
+        # Iterative post-order walk: (node, path, children visited)
+        stack = [(self._root, os.sep, False)]
+
+        while stack:
+
+            node, path, visited = stack.pop()
+
+            if visited:
+
+                if node.marked:
+
+                    ordered.append(path)
+
+                continue
+
+            stack.append((node, path, True))
+
+            for name in sorted(node.children, reverse=True):
+
+                stack.append((node.children[name],
+                              os.path.join(path, name), False))
+
+        return ordered
+
+    def __iter__(self):
+
+        return iter(self.checkin_order())
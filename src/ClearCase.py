@@ -10,11 +10,20 @@ http://docs.python.org/2/library/subprocess.html
 """
 
 import os
-import subprocess
+import re
 import sys
+import time
 import Log
 
+from CCHistory import HistoryEvent
+from CheckoutTree import CheckoutTree
+from CommandEngine import CommandEngine
+from CommandEngine import CommandError
 from HooksConfig import HooksConfig
+from Ledger import Ledger
+from Manifest import Manifest
+from MetadataCache import MetadataCache
+from Metrics import Metrics
 
 class CCError(Exception):
 
@@ -33,12 +42,28 @@ class CCError(Exception):
 
 class ClearCase:
 
+    # Maximum number of paths given to one cleartool command
+    _MAX_PATHS_PER_COMMAND = 200
+
+    # lshistory format: date, user, operation, object kind, element, version
+    # and comment. Comments can span several lines so every event ends with
+    # a line holding _HISTORY_END.
+    _HISTORY_END = "@@git2cc-event@@"
+    _HISTORY_FORMAT = ("%Nd\\t%u\\t%o\\t%m\\t%En\\t%Vn\\t%Nc\\n" +
+                       _HISTORY_END + "\\n")
+
     _config = None
+    _cache = None
+    _engine = None
+    _view = None
+    _vobs = None
     _ = None
 
-    def __init__(self):
+    def __init__(self, view=None, vobs=None):
         """
-        This constructor gets the current Hooks configuration and user messages
+        This constructor gets the current Hooks configuration and user
+        messages. The view and its VOBs are the configured ones unless a
+        shard view is given.
 
         """
 
@@ -50,6 +75,15 @@ class ClearCase:
             # Get configuration
             self._config = HooksConfig()
 
+            # Shared ClearCase metadata cache
+            self._cache = MetadataCache()
+
+            # Bounded command execution shared by the whole process
+            self._engine = CommandEngine()
+
+            self._view = view if view is not None else self._config.get_view()
+            self._vobs = vobs if vobs is not None else self._config.get_vobs()
+
         except:
 
             raise
@@ -67,50 +101,62 @@ class ClearCase:
             
             Log.debug("need_merge: exist_path")
 
-            try:
-                # Get the current version description
-                # Ex : path@@/main/Step2_project/rel_1.3/15
-                p = subprocess.Popen([self._config.get_cleartool_path(),
-                                      "des","-short"
-                                      ,ccpath],
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE)
-                out, err = p.communicate()
-
-                if p.returncode == 0:
-                    
-                    line=out.rstrip('\r\n')
-                    
-                    # Changes from (r)ight position of string the last number
-                    # (15) with LATEST
-                    branch=out.rpartition("/")[0]+"/LATEST"
-                    
-                    Log.debug ("need_merge: "+ ccpath + "," + line + ","+branch)
-                    
-                    p = subprocess.Popen([self._config.get_cleartool_path(),
-                                          "des","-short"
-                                          ,branch],
-                                         stdout=subprocess.PIPE,
-                                         stderr=subprocess.PIPE)
-                          
-                    out, err = p.communicate()
-                    
-                    Log.debug
-                    ("need_merge: compare:("+line+"=="+out.rstrip('\r\n')+")")
-                    
-                    result = (line != out.rstrip('\r\n'))
+            versions = self._cache.get_versions(ccpath)
 
-                else:
+            if versions is not None:
 
-                    Log.error ("need_merge:"+ str(p.returncode) & " ".join(out))
+                Log.debug("need_merge: cached compare:(" + versions[0] +
+                          "==" + versions[1] + ")")
+
+                result = (versions[0] != versions[1])
+
+            else:
+
+                try:
+                    # Get the current version description
+                    # Ex : path@@/main/Step2_project/rel_1.3/15
+                    returncode, out, err = self._engine.run(
+                        [self._config.get_cleartool_path(),
+                         "des","-short"
+                         ,ccpath])
+
+                    if returncode == 0:
+
+                        line=out.rstrip('\r\n')
+
+                        # Changes from (r)ight position of string the last
+                        # number (15) with LATEST
+                        branch=out.rpartition("/")[0]+"/LATEST"
+
+                        Log.debug ("need_merge: "+ ccpath + "," + line + ","+
+                                   branch)
+
+                        returncode, out, err = self._engine.run(
+                            [self._config.get_cleartool_path(),
+                             "des","-short"
+                             ,branch])
+
+                        Log.debug
+                        ("need_merge: compare:("+line+"=="+out.rstrip('\r\n')+")")
+
+                        result = (line != out.rstrip('\r\n'))
+
+                        if returncode == 0:
+
+                            self._cache.set_versions(ccpath, line,
+                                                     out.rstrip('\r\n'))
+
+                    else:
+
+                        Log.error ("need_merge:"+ str(returncode) & " ".join(out))
+
+
+                except:
+
+                    Log.error("need_merge: exception " + str(sys.exc_info()))
+
+                    result = False
 
-                
-            except:
-                
-                Log.error("need_merge: exception " + str(sys.exc_info()))
-                
-                result = False
-                
         else:
 
             Log.debug("need_merge: not_exist_path")
@@ -135,33 +181,39 @@ class ClearCase:
         
         result = False
 
+        cached = None
+
         if os.path.exists(ccpath):
 
+            cached = self._cache.get_versioned(ccpath)
+
+        if cached is not None:
+
+            result = cached
+
+        elif os.path.exists(ccpath):
+
             try:
                 if not os.path.isdir(ccpath):
 
-                    p = subprocess.Popen([self._config.get_cleartool_path(),
-                                          "ls",
-                                          "-vob_only", ccpath],
-                                         stdout=subprocess.PIPE,
-                                         stderr=subprocess.PIPE)
-
-                    out, err = p.communicate()
+                    returncode, out, err = self._engine.run(
+                        [self._config.get_cleartool_path(),
+                         "ls",
+                         "-vob_only", ccpath])
 
                 else:
 
-                    p = subprocess.Popen([self._config.get_cleartool_path(),
-                                          "ls",
-                                          "-vob_only","-directory", ccpath],
-                                         stdout=subprocess.PIPE,
-                                         stderr=subprocess.PIPE)
-
-                    out, err = p.communicate()
+                    returncode, out, err = self._engine.run(
+                        [self._config.get_cleartool_path(),
+                         "ls",
+                         "-vob_only","-directory", ccpath])
                     
-                if p.returncode == 0:
+                if returncode == 0:
 
                     result = not (out is None or out == "")
 
+                    self._cache.set_versioned(ccpath, result)
+
             except:
 
                 result = False
@@ -177,65 +229,101 @@ class ClearCase:
 
         Log.debug("Checks if resource is already checkout: " + ccpath)
         
-        result = False
+        result = self._cache.get_checkout(ccpath)
+
+        if result is None:
+
+            returncode, out, err = self._engine.run(
+                [self._config.get_cleartool_path(), "lsco",
+                 "-s", "-d", "-cvi", ccpath])
+
+            result = False
+
+            if returncode == 0 and out != "":
 
-        p = subprocess.Popen([self._config.get_cleartool_path(), "lsco",
-                              "-s", "-d", "-cvi", ccpath],
-                             stdout=subprocess.PIPE)
-        out = p.communicate()
+                result = out.rstrip('\r\n') == ccpath
 
-        if p.returncode == 0 and out[0] != "":
+            if returncode == 0:
 
-            result = out[0].rstrip('\r\n') == ccpath
+                self._cache.set_checkout(ccpath, result)
 
         Log.debug("Checks if resource is already checkout, result: " +
                   str(result))
         
         return result
 
-    def makelabel(self, ccpath, label):
+    def is_versioned_async(self, ccpath):
         """
-        Create file, and ignore errors"
+        Runs is_versioned in the background and returns a CommandFuture.
+
         """
-        
-        result = False
-        
-        Log.debug("Creating label (mklbtype): " + label)
-        
-        p_mklbtype = subprocess.Popen([self._config.get_cleartool_path(),
-                              "mklbtype","-nc","-pbr",label],
-                             cwd=os.path.dirname(ccpath),
-                             stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        
-        out_mklbtype = p_mklbtype.communicate()
-        
-        if p_mklbtype.returncode == 0 and out_mklbtype[0] != "":
 
-            result = out[0].rstrip('\r\n') == ccpath
-            Log.debug("Label (mklbtype) created OK: " + label)
+        return self._engine.submit("cleartool", self.is_versioned, ccpath)
 
-        else:
-            Log.warning("Label (mklbtype) not created: " + label)
-            
-        Log.debug("Attaching label (mklabel): " + label + " to " + ccpath)
-        
-        p_mklabel = subprocess.Popen([self._config.get_cleartool_path(),
-                                      "mklabel",label,ccpath],
-			             stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE)
-        
-        out_mklabel = p_mklabel.communicate()
-        
-        if p_mklabel.returncode == 0 and out_mklabel[0] != "":
+    def is_checkout_async(self, ccpath):
+        """
+        Runs is_checkout in the background and returns a CommandFuture.
 
-            result = out[0].rstrip('\r\n') == ccpath
-            Log.debug("Atached label " + label + " OK to " + ccpath)
-            
-        else:
-            
-            Log.warning("Error attching label (mklbtype) not created: " + label)
-            
-        return result
+        """
+
+        return self._engine.submit("cleartool", self.is_checkout, ccpath)
+
+    def need_merge_async(self, ccpath):
+        """
+        Runs need_merge in the background and returns a CommandFuture.
+
+        """
+
+        return self._engine.submit("cleartool", self.need_merge, ccpath)
+
+    def prefetch_states(self, ccpaths):
+        """
+        Resolves concurrently the ClearCase state (versioned, checkout and
+        versions) of the given existing elements. Results are kept in the
+        metadata cache, where the synchronization finds them. Returns the list
+        of CommandFuture objects of the queries.
+
+        """
+
+        futures = []
+
+        for ccpath in ccpaths:
+
+            if os.path.exists(ccpath):
+
+                futures.append(self.is_versioned_async(ccpath))
+                futures.append(self.is_checkout_async(ccpath))
+                futures.append(self.need_merge_async(ccpath))
+
+        return futures
+
+    def check_checkouts(self, ccpaths):
+        """
+        Checks, without changing anything, that every given element can be
+        checked out: it is versioned, not checked out and does not need a
+        merge. The queries run in the ClearCase workers.
+
+        Raises CCError exception for the first element that can not.
+
+        """
+
+        checks = [(ccpath, self.is_versioned_async(ccpath),
+                   self.is_checkout_async(ccpath),
+                   self.need_merge_async(ccpath)) for ccpath in ccpaths]
+
+        for ccpath, versioned, checkout, merge in checks:
+
+            if not versioned.result():
+
+                raise CCError(ccpath + self._("not_in_CC"))
+
+            if checkout.result():
+
+                raise CCError(ccpath + self._("already_co"))
+
+            if merge.result():
+
+                raise CCError(ccpath + self._("file_need_clearcase_merge"))
 
     def checkout(self, ccpath, comment, addVersion=False):
         """
@@ -274,17 +362,16 @@ class ClearCase:
                        cc_comment, ccpath]
 
         try:
-            p = subprocess.Popen(command,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            out, err = p.communicate()
+            returncode, out, err = self._engine.run(command)
 
         except:
             raise CCError(self._("co") + " " + ccpath +
                           self._("command_failed") +
                           str(sys.exc_info()))
 
-        if p.returncode != 0:
+        self._cache.invalidate(ccpath)
+
+        if returncode != 0:
 
             raise CCError(self._("co") + " " + ccpath +
                           self._("command_failed") +
@@ -301,13 +388,15 @@ class ClearCase:
 
         Log.debug("uncheckout:" + ccpath)
 
-        p = subprocess.Popen([self._config.get_cleartool_path(), "unco", "-rm",
-                              ccpath])
-        p.communicate()
+        returncode, out, err = self._engine.run(
+            [self._config.get_cleartool_path(), "unco", "-rm", ccpath])
 
-        if p.returncode != 0:
+        self._cache.invalidate(ccpath)
 
-            raise CCError(ccpath + " ct unco -rm" + self._("command_failed"))
+        if returncode != 0:
+
+            raise CCError(ccpath + " ct unco -rm" + self._("command_failed") +
+                          str(err))
 
     def set_label(self, label, ccpath):
         """
@@ -317,10 +406,11 @@ class ClearCase:
 
         """
 
-        p = subprocess.Popen([self._config.get_cleartool_path(), "mklabel", "-replace", label, ccpath], stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        out, err = p.communicate()
+        returncode, out, err = self._engine.run(
+            [self._config.get_cleartool_path(), "mklabel", "-replace", label,
+             ccpath])
 
-        if p.returncode != 0:
+        if returncode != 0:
 
             raise CCError(ccpath + " ct mklabel -replace " + self._("command_failed") + str(err))
 
@@ -337,30 +427,42 @@ class ClearCase:
         """
         result = False
 
-        prevdir = os.getcwd()
-
         parent = os.path.dirname(ccpath)
 
-        os.chdir(parent)
+        if self._cache.has_label_type(parent, label):
+
+            return True
+
+        returncode = None
 
         try:
-            p = subprocess.Popen([self._config.get_cleartool_path(), "lstype",
-                              "lbtype:" + label],
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-            out, err = p.communicate()
+            returncode, out, err = self._engine.run(
+                [self._config.get_cleartool_path(), "lstype",
+                 "lbtype:" + label],
+                cwd=parent)
 
         except:
             Log.error (ccpath + self._("exists_label_failed") + str(sys.exc_info()))
-            
-        os.chdir (prevdir)
 
-        if p.returncode == 0 and out[1] != "Error:":
+        if returncode == 0 and out[1] != "Error:":
 
             result = True
 
+            self._cache.add_label_type(parent, label)
+
         return result
 
+    @staticmethod
+    def _record_checkins(output):
+        """
+        Passes the versions printed by ci or mkelem -ci to the manifest and
+        the ledger.
+
+        """
+
+        Manifest().record_checkins(output)
+        Ledger().record_checkins(output)
+
     def checkin(self, ccpath, labels=[]):
         """
         Executes the check in of the given file or directory
@@ -381,20 +483,20 @@ class ClearCase:
 
         try:
             
-            p = subprocess.Popen([self._config.get_cleartool_path(),
-                                  "ci", "-nc", ccpath],
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-
-            out, err = p.communicate()
+            returncode, out, err = self._engine.run(
+                [self._config.get_cleartool_path(), "ci", "-nc", ccpath])
 
         except:
 
+            self._cache.invalidate(ccpath)
+
             raise CCError(self._("ci") + " " + ccpath +
                           self._("command_failed") +
                           str(sys.exc_info()))
 
-        if p.returncode != 0:
+        self._cache.invalidate(ccpath)
+
+        if returncode != 0:
 
             raise CCError(self._("ci") + " " + ccpath +
                           self._("command_failed") +
@@ -402,168 +504,187 @@ class ClearCase:
         else:
 
             Log.debug("checkin OK: " + ccpath)
+            self._record_checkins(out)
             self.create_and_set_labels (ccpath, labels);
 
-    def create_dir(self, ccpath):
+    def create_paths(self, ccpaths):
         """
-        Creates a new directory in ClearCase.
+        Creates every missing directory of the given paths. Directories are
+        grouped by parent: each parent is checked out once, all its new
+        children are created with one mkdir and every directory is checked in
+        once, bottom-up, when the whole tree of new directories exists.
 
-        Raises CCError exception when the command fails.
+        Raises CCError exception when the creation of any directory fails.
 
         """
 
-        Log.debug("create_dir:"+ccpath)
+        # Missing directories grouped by parent
+        missing = {}
+        known = set()
+
+        for ccpath in ccpaths:
+
+            current = os.path.normpath(ccpath)
+
+            while current not in known and not os.path.isdir(current):
+
+                known.add(current)
+                parent = os.path.dirname(current)
+                missing.setdefault(parent, set()).add(current)
+                current = parent
+
+            known.add(current)
 
-        if not os.path.isdir(ccpath):
+        if not missing:
 
-            parent = ccpath
+            return
 
-            # Remove last / when necessary
-            if parent[len(parent) - 1] == os.sep:
+        Log.debug("Creating new paths in " + str(len(missing)) +
+                  " parent directories")
 
-                parent = parent[:-1]
+        co_tree = CheckoutTree()
 
-            # Get parent directory
-            parent = os.path.dirname(parent)
+        # Parents are processed top-down so new parents exist before their
+        # children are created
+        for parent in sorted(missing, key=lambda x: x.count(os.sep)):
 
             if not os.path.isdir(parent):
 
                 raise CCError(parent + self._("not_in_CC"))
 
-            # Only create dir if not versioned in CC
-            if not self.is_versioned(ccpath):
-                
-                if not self.is_checkout(parent):
-                    # Check out parent directory
-                    self.checkout(parent, self._("CC_dir_modification_comment"))
+            if parent not in co_tree and not self.is_checkout(parent):
+
+                self.checkout(parent, self._("CC_dir_modification_comment"))
+                co_tree.add(parent)
+
+            children = sorted(missing[parent])
+
+            for i in range(0, len(children), self._MAX_PATHS_PER_COMMAND):
+
+                chunk = children[i:i + self._MAX_PATHS_PER_COMMAND]
+
+                Log.debug(lambda: "mkdir in " + parent + ": " +
+                          " ".join(chunk))
 
                 try:
 
-                    # Create new directory
-                    p = subprocess.Popen([self._config.get_cleartool_path(),
-                                          "mkdir", "-c",
-                                          self._("new_CC_folder"),
-                                          ccpath],
-                                         stdout=subprocess.PIPE,
-                                         stderr=subprocess.PIPE)
-                    out, err = p.communicate()
-                    
-                    self.checkin(parent)
-                    
-                    self.checkin(ccpath)
-                    
+                    # New directories are left checked out by mkdir
+                    returncode, out, err = self._engine.run(
+                        [self._config.get_cleartool_path(), "mkdir", "-c",
+                         self._("new_CC_folder")] + chunk)
+
                 except:
-                    
-                    raise CCError(ccpath + self._("creation_failed") +
+
+                    raise CCError(parent + self._("creation_failed") +
                                   str(sys.exc_info()))
 
-                if p.returncode != 0:
+                for child in chunk:
 
-                    raise CCError(ccpath + self._("creation_failed") + str(err))
+                    self._cache.invalidate(child)
 
-        else:
+                if returncode != 0:
 
-            raise CCError(ccpath + self._("already_in_CC"))
+                    raise CCError(parent + self._("creation_failed") + str(err))
 
-    def create_path(self, ccpath):
+                for child in chunk:
+
+                    co_tree.add(child)
+
+        self.checkin_list(co_tree)
+
+    def create_files(self, ccpaths, labels, list_co):
         """
-        Creates a complete route of directories matching the given path.
+        Adds new files to ClearCase grouping them by parent directory. Every
+        parent is checked out once and its new files are created and checked
+        in with one mkelem -ci call, which keeps the content already in the
+        view. The files must exist previously.
 
-        Raises CCError exception when the creation of any directory fails.
+        Raises CCError exception when a failure is detected.
 
         """
 
-        Log.debug("Creating new path:" + ccpath)
+        groups = {}
+
+        for ccpath in ccpaths:
+
+            if not os.path.isfile(ccpath):
 
-        # Split path in directories
-        dirs = ccpath.split(os.sep)
+                raise CCError(ccpath + self._("file_not_exists"))
 
-        # Because ccpath starts with os.sep the first element in dirs
-        # will be the "" and must be deleted
-        del dirs[0]
+            groups.setdefault(os.path.dirname(ccpath), []).append(ccpath)
 
-        current = os.sep
+        for parent_folder in sorted(groups):
 
-        for dir_name in dirs:
+            if (parent_folder not in list_co and
+                    not self.is_checkout(parent_folder)):
+
+                Log.debug("Chekout parent folder: " + parent_folder)
+                self.checkout(parent_folder, self._("new_file"))
+                list_co.add(parent_folder)
 
-            current += dir_name
+            files = sorted(groups[parent_folder])
 
-            # Create directory only if it did not exist previously
-            if not os.path.isdir(current):
+            for i in range(0, len(files), self._MAX_PATHS_PER_COMMAND):
+
+                chunk = files[i:i + self._MAX_PATHS_PER_COMMAND]
+
+                Log.debug("Creating " + str(len(chunk)) + " new files in " +
+                          parent_folder)
 
                 try:
 
-                    self.create_dir(current)
+                    returncode, out, err = self._engine.run(
+                        [self._config.get_cleartool_path(), "mkelem", "-nc",
+                         "-ci"] + chunk)
 
                 except:
 
-                    raise
+                    raise CCError(parent_folder + self._("creation_failed") +
+                                  str(sys.exc_info()))
 
-            current += os.sep
+                for ccpath in chunk:
 
-    def create_file(self, ccpath, labels, list_co):
-        """
-        Adds a new file to ClearCase. The file must exists previously.
+                    self._cache.invalidate(ccpath)
 
-        Raises CCError exception when a failure is detected.
+                if returncode != 0:
 
-        """
+                    raise CCError(parent_folder + self._("creation_failed") +
+                                  str(err))
 
-        Log.debug("Creating new file: " + ccpath)
+                self._record_checkins(out)
 
-        if not os.path.isfile(ccpath):
+            self.create_and_set_labels_list(files, labels)
 
-            raise CCError(ccpath + self._("file_not_exists"))
+    def check_branch(self, cc_branch):
+        """
+        Checks that the config spec of the view selects the given ClearCase
+        branch, so the synchronized GIT branch is checked in on it.
 
-        # Preserve current keep file if it exists (NOT NEEDED CC does it)
-        #if os.path.isfile(ccpath + ".keep"):
-        #    os.rename(ccpath + ".keep", ccpath + ".keep.old")
+        Raises CCError exception when it does not.
+
+        """
 
         try:
 
-            # Checkout file folder
-            parent_folder = os.path.dirname(ccpath)
+            returncode, out, err = self._engine.run(
+                [self._config.get_cleartool_path(), "catcs"], cwd=self._view)
 
-            if not self.is_checkout (parent_folder):
-                # Checkout file folder
-                Log.debug("Chekout parent folder: " + parent_folder)
-                self.checkout(os.path.dirname(ccpath), self._("new_file"))
-                Log.debug("Chekout parent folder OK: " + parent_folder)
-                list_co.append (os.path.dirname (ccpath))
-                
-            # Open the file avoids anyone changes it during the check out
-            with open(ccpath) as f:
-                p = subprocess.Popen([self._config.get_cleartool_path(),
-                                      "mkelem", "-nc", "-nco", ccpath],
-                                     #cwd=os.path.dirname(ccpath)
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE)
-                out, err = p.communicate()
-                f.close()
-            if p.returncode == 0:
-                """
-                Previous operation puts an empty new file in the main
-                ClearCase branch leaving the actual file as ccpath.keep
-                We must add the content to our branch performing co then
-                ci of the keep file.
-                """
-                self.checkout(ccpath + "@@/main/LATEST",
-                              self._("new_file"), True)
-                os.rename(ccpath + ".keep", ccpath)
-                self.checkin(ccpath, labels)
-            else:
-                raise CCError(ccpath + self._("creation_failed") + str(err))
+        except:
 
-        except IOError:
+            raise CCError("ct catcs" + self._("command_failed") +
+                          str(sys.exc_info()))
 
-            raise CCError(ccpath + self._("file_not_exists"))
+        if returncode != 0:
 
-        except CCError:
-            raise
+            raise CCError("ct catcs" + self._("command_failed") + str(err))
 
-        except:
-            raise CCError(ccpath + self._("creation_failed") +
-                          str(sys.exc_info()))
+        if not re.search(r"(/|mkbranch\s+)" + re.escape(cc_branch) +
+                         r"(/|\s|$)", out, re.M):
+
+            raise CCError(self._view + self._("cc_branch_not_selected") +
+                          cc_branch)
+
+        Log.debug("Config spec of " + self._view + " selects " + cc_branch)
 
     def list_checkouts_in_all_vobs(self):
         """
@@ -571,11 +692,10 @@ class ClearCase:
         """
         colist_in_vobs = []
 
-        vobs = self._config.get_vobs()
+        vobs = self._vobs
         
-        vobs_to_string = " ".join(str(x) for x in vobs)
-
-        Log.debug("list_checkouts in all vobs : " + vobs_to_string)
+        Log.debug(lambda: "list_checkouts in all vobs : " +
+                  " ".join(str(x) for x in vobs))
 
         if not vobs:
 
@@ -586,10 +706,9 @@ class ClearCase:
             for vob in vobs:
                 colist_in_vobs.extend (self.list_checkouts(vob))
 
-        list_of_checkouts = " ".join(str(x) for x in colist_in_vobs)
-        
-        Log.debug("Final list_checkout in all vobs : " + vobs_to_string +
-                     " list of checkouts : " + list_of_checkouts)
+        Log.debug(lambda: "Final list_checkout in all vobs : " +
+                  " ".join(str(x) for x in vobs) + " list of checkouts : " +
+                  " ".join(str(x) for x in colist_in_vobs))
         
         return colist_in_vobs
 
@@ -603,7 +722,7 @@ class ClearCase:
 
         colist = []
 
-        vob_path = self._config.get_view() + os.sep + vob
+        vob_path = self._view + os.sep + vob
 
         # list files in each vob.
         for i in os.listdir(vob_path):
@@ -624,12 +743,9 @@ class ClearCase:
                     
                 try:
                     # Get all checked out children (file/folder)of current path
-                    p = subprocess.Popen([self._config.get_cleartool_path(),
-                                          "lsco", "-s", "-r", "-cvi",
-                                          current_path],
-                                         stdout=subprocess.PIPE,
-                                         stderr=subprocess.PIPE)
-                    out, err = p.communicate()
+                    returncode, out, err = self._engine.run(
+                        [self._config.get_cleartool_path(), "lsco", "-s",
+                         "-r", "-cvi", current_path])
                     
                 except:
                     
@@ -638,7 +754,7 @@ class ClearCase:
                                   self._("command_failed") +
                                   str(sys.exc_info()))
                 
-                if p.returncode == 0:
+                if returncode == 0:
                     
                     if not (out is None or out == ""):
                     
@@ -653,7 +769,8 @@ class ClearCase:
         # Reverse check out list to get directories' children files and folders
         # first
         colist.reverse()
-        Log.debug("checkouts in vobs " + vob + " : " + ' '.join(colist))
+        Log.debug(lambda: "checkouts in vobs " + vob + " : " +
+                  ' '.join(colist))
         
         return colist
                 
@@ -700,6 +817,8 @@ class ClearCase:
 
         Log.debug("uncheckout_all")
 
+        Metrics().inc("git2cc_rollbacks_total")
+
         colist = []
         
         colist = self.list_checkouts_in_all_vobs()
@@ -735,44 +854,92 @@ class ClearCase:
                     not self.is_versioned(co)):
                 os.rmdir(co)
 
-    def remove_name(self, ccpath, colist):
+    @staticmethod
+    def plan_removals(ccpaths):
         """
-        Removes one file or folder from ClearCase.
+        Collapses a list of deleted paths to the minimal set of top-most
+        entries (children of a removed directory go away with it) and returns
+        them grouped by parent directory:
+
+            {<parent directory>: [<entry>, ...]}
 
         """
 
-        Log.debug("remove_name:"+ccpath)
+        removed = CheckoutTree()
+        plan = {}
 
-        # Parent dir must be checked out
-        parent = os.path.dirname(ccpath)
+        # Parents are visited before their children
+        for ccpath in sorted(ccpaths, key=lambda x: x.count(os.sep)):
 
-        if not self.is_checkout(parent):
-            
-            self.checkout(parent, self._("CC_dir_modification_comment"))
-            colist.append (parent)
-            
-        # Folders must be checked in before being deleted.
-        if os.path.isdir(ccpath) and self.is_checkout(ccpath):
+            if removed.has_ancestor(ccpath):
 
-            self.checkin(ccpath)
+                continue
 
-        try:
+            removed.add(ccpath)
+            ccpath = os.path.normpath(ccpath)
+            plan.setdefault(os.path.dirname(ccpath), []).append(ccpath)
 
-            p = subprocess.Popen([self._config.get_cleartool_path(),
-                                  "rmname", ccpath],
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            out, err = p.communicate()
+        return plan
 
-        except:
+    def remove_names(self, ccpaths, colist):
+        """
+        Removes several files and folders from ClearCase with one rmname per
+        parent directory.
 
-            raise CCError("ct rmname " + ccpath + self._("command_failed") +
-                          str(sys.exc_info()))
+        Raises CCError exception when the command fails.
 
-        if p.returncode != 0:
+        """
 
-            raise CCError("ct rmname " + ccpath + self._("command_failed") +
-                          str(err))
+        plan = self.plan_removals(ccpaths)
+
+        for parent in sorted(plan):
+
+            children = sorted([x for x in plan[parent] if os.path.lexists(x)])
+
+            if not children:
+
+                continue
+
+            Log.debug("remove_names in " + parent + ": " + str(len(children)) +
+                      " entries")
+
+            # Parent dir must be checked out
+            if parent not in colist and not self.is_checkout(parent):
+
+                self.checkout(parent, self._("CC_dir_modification_comment"))
+                colist.add(parent)
+
+            # Folders must be checked in before being deleted.
+            for child in children:
+
+                if os.path.isdir(child) and self.is_checkout(child):
+
+                    self.checkin(child)
+                    colist.remove(child)
+
+            for i in range(0, len(children), self._MAX_PATHS_PER_COMMAND):
+
+                chunk = children[i:i + self._MAX_PATHS_PER_COMMAND]
+
+                try:
+
+                    returncode, out, err = self._engine.run(
+                        [self._config.get_cleartool_path(), "rmname"] + chunk)
+
+                except:
+
+                    raise CCError("ct rmname " + parent +
+                                  self._("command_failed") +
+                                  str(sys.exc_info()))
+
+                for child in chunk:
+
+                    self._cache.invalidate(child)
+
+                if returncode != 0:
+
+                    raise CCError("ct rmname " + parent +
+                                  self._("command_failed") + str(err))
 
     def create_label(self, label, ccpath):
         """
@@ -784,13 +951,14 @@ class ClearCase:
         """
         if not self.exists_label (label, ccpath):
 
-            p = subprocess.Popen([self._config.get_cleartool_path(), "mklbtype", "-nc", "-pbr", label],cwd=os.path.dirname(ccpath),
-            stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-            out, err = p.communicate()
+            returncode, out, err = self._engine.run(
+                [self._config.get_cleartool_path(), "mklbtype", "-nc", "-pbr",
+                 label],
+                cwd=os.path.dirname(ccpath))
 
-            if p.returncode != 0 and out[0] != "":
+            if returncode != 0:
 
-                Log.error (out)
+                Log.error (err)
                 
                 raise CCError(ccpath + " ct mklbtype -nc -pbr" + self._("command_failed") + str(err))
             
@@ -798,6 +966,8 @@ class ClearCase:
 
                 Log.debug (out)
 
+                self._cache.add_label_type(os.path.dirname(ccpath), label)
+
         else:
 
             Log.debug ("CC Label " + label + "Already created")
@@ -827,12 +997,85 @@ class ClearCase:
                 Log.error(e)
                 continue
 
+    def group_by_vob(self, ccpaths):
+        """
+        Groups the given view paths by VOB, the first directory level of the
+        snapshot view:
+
+            {<VOB path in the view>: [<path>, ...]}
+
+        """
+
+        view = os.path.normpath(self._view)
+        groups = {}
+
+        for ccpath in ccpaths:
+
+            relative = os.path.relpath(os.path.normpath(ccpath), view)
+            vob = os.path.join(view, relative.split(os.sep)[0])
+            groups.setdefault(vob, []).append(ccpath)
+
+        return groups
+
+    def set_label_list(self, label, ccpaths):
+        """
+        Sets a CC label to several elements with one mklabel call per group
+        of paths.
+
+        Raises CCError exception when the command fails.
+
+        """
+
+        for i in range(0, len(ccpaths), self._MAX_PATHS_PER_COMMAND):
+
+            chunk = ccpaths[i:i + self._MAX_PATHS_PER_COMMAND]
+
+            returncode, out, err = self._engine.run(
+                [self._config.get_cleartool_path(), "mklabel", "-replace",
+                 label] + chunk)
+
+            if returncode != 0:
+
+                raise CCError(" ".join(chunk) + " ct mklabel -replace " +
+                              self._("command_failed") + str(err))
+
+        Log.debug ("Label : " + label + " set in " + str(len(ccpaths)) +
+                   " elements")
+
+    def create_and_set_labels_list(self, ccpaths, labels):
+        """
+        Creates the CC labels when necessary and sets them to every given
+        element. The label type is created from the first element path.
+
+        """
+
+        if not ccpaths:
+
+            return
+
+        for label in labels:
+
+            try:
+
+                if not self.exists_label (label, ccpaths[0]):
+                    self.create_label (label, ccpaths[0])
+
+                self.set_label_list (label, ccpaths)
+
+            except:
+                # Log.error warning and continue executing check in
+                Log.error("{0} {1}".format(self._("WARNING"),
+                                    label + self._("impossible_label")))
+                e = sys.exc_info()
+                Log.error(e)
+                continue
+
     def checkin_list(self, co_list, labels=[]):
         """
-        Creates new CC labels.
+        Checks in the directories recorded in the given CheckoutTree, children
+        before their parents.
 
-        Raises CCError exception when the command fails or the label already 
-        exists.
+        Raises CCError exception when the command fails.
 
         """
         # Checkout dirs are check-in.
@@ -841,10 +1084,68 @@ class ClearCase:
 
             Log.debug("checkin checkout dir in delete")
         
-            for co_dir in co_list:
+            for co_dir in co_list.checkin_order():
                 self.checkin (co_dir)
+                co_list.remove(co_dir)
 
         else:
 
             Log.debug("No files to checkin")
-            
+
+    def iter_history(self, ccpath, since=None):
+        """
+        Yields the HistoryEvent objects of every element under the given path,
+        optionally only those since the given date (yyyymmdd.hhmmss). Events
+        are yielded as cleartool prints them, not in chronological order.
+
+        Raises CCError exception when the command fails.
+
+        """
+
+        command = [self._config.get_cleartool_path(), "lshistory", "-recurse",
+                   "-fmt", self._HISTORY_FORMAT]
+
+        if since is not None:
+
+            command += ["-since", time.strftime(
+                "%d-%b-%Y.%H:%M:%S", time.strptime(since, "%Y%m%d.%H%M%S"))]
+
+        lines = []
+
+        try:
+
+            for line in self._engine.stream(command + [ccpath]):
+
+                if line.rstrip("\r\n") != self._HISTORY_END:
+
+                    lines.append(line)
+                    continue
+
+                fields = "".join(lines).rstrip("\r\n").split("\t", 6)
+                lines = []
+
+                if len(fields) == 7:
+
+                    yield HistoryEvent(*fields)
+
+        except CommandError as e:
+
+            raise CCError("ct lshistory " + ccpath + self._("command_failed") +
+                          str(e))
+
+    def get_version(self, element, version, target):
+        """
+        Copies the given version of an element to the target file.
+
+        Raises CCError exception when the command fails.
+
+        """
+
+        returncode, out, err = self._engine.run(
+            [self._config.get_cleartool_path(), "get", "-to", target,
+             element + "@@" + version])
+
+        if returncode != 0:
+
+            raise CCError("ct get " + element + "@@" + version +
+                          self._("command_failed") + str(err))
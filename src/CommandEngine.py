@@ -0,0 +1,473 @@
+"""
+@summary: This module runs the GIT and ClearCase commands of the hooks. Every
+tool has a bounded number of commands running at the same time and every
+command has a timeout. Independent queries can be submitted to a pool of
+worker threads per tool so they overlap; their results are collected later
+through CommandFuture objects.
+
+@note: The hooks run on Python 2, which has no asyncio. Worker threads are
+used instead: they spend their time waiting for child processes, so they do
+not compete for the interpreter lock.
+
+"""
+
+import atexit
+import os
+import sys
+import threading
+import time
+
+import Log
+
+from HooksConfig import HooksConfig
+from Metrics import Metrics
+
+
+class CommandError(Exception):
+
+    """
+    Exception class to represent errors occurred while running a command in
+    the engine.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class CommandFuture(object):
+
+    """
+    Result of a function submitted to the engine.
+    """
+
+    def __init__(self):
+
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def _set_result(self, result):
+
+        self._result = result
+        self._event.set()
+
+    def _set_exception(self, exc_info):
+
+        self._exc_info = exc_info
+        self._event.set()
+
+    def done(self):
+
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the submitted function and returns its result. Exceptions
+        raised by the function are raised again here.
+
+        """
+
+        if not self._event.wait(timeout):
+
+            raise CommandError("Timeout waiting for a command result")
+
+        if self._exc_info is not None:
+
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+
+class _WorkerPool(object):
+
+    """
+    Fixed number of daemon threads running submitted functions.
+    """
+
+    def __init__(self, name, size):
+
+        import Queue
+
+        self._queue = Queue.Queue()
+        self._workers = []
+
+        for i in range(size):
+
+            worker = threading.Thread(target=self._work,
+                                      name=name + "-" + str(i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+        # Idle daemon threads must be stopped before the interpreter exits
+        atexit.register(self.shutdown)
+
+    def _work(self):
+
+        while True:
+
+            task = self._queue.get()
+
+            if task is None:
+
+                return
+
+            future, function, args, kwargs = task
+
+            try:
+
+                future._set_result(function(*args, **kwargs))
+
+            except:
+
+                future._set_exception(sys.exc_info())
+
+    def submit(self, function, args, kwargs):
+
+        future = CommandFuture()
+        self._queue.put((future, function, args, kwargs))
+
+        return future
+
+    def shutdown(self):
+        """
+        Stops the workers once the queued functions have finished.
+
+        """
+
+        for worker in self._workers:
+
+            self._queue.put(None)
+
+        for worker in self._workers:
+
+            worker.join()
+
+        self._workers = []
+
+
+class CommandEngine(object):
+
+    """
+    Runs commands with bounded concurrency per tool. Only one instance exists
+    per process.
+    """
+
+    __instance = None
+
+    _DEFAULT_WORKERS = 4
+    _DEFAULT_TIMEOUT = 3600
+
+    _initialized = False
+
+    def __new__(cls, *args, **kargs):
+
+        if cls.__instance is None:
+
+            cls.__instance = object.__new__(cls, *args, **kargs)
+
+        return cls.__instance
+
+    def __init__(self):
+
+        if self._initialized:
+
+            return
+
+        self._initialized = True
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._pools = {}
+        self._workers = {}
+        self._timeout = self._DEFAULT_TIMEOUT
+
+        try:
+
+            config = HooksConfig()
+            self._workers["git"] = config.get_engine_workers("git")
+            self._workers["cleartool"] = config.get_engine_workers("cleartool")
+            self._timeout = config.get_command_timeout()
+
+        except:
+
+            Log.debug("Command engine using default limits: " +
+                      str(sys.exc_info()[1]))
+
+    @staticmethod
+    def tool(command):
+        """
+        Returns the tool name of a command line: git or cleartool.
+
+        """
+
+        return os.path.basename(command[0])
+
+    @staticmethod
+    def operation(command):
+        """
+        Returns the subcommand of a command line: diff, co, mkelem...
+
+        """
+
+        return command[1] if len(command) > 1 else ""
+
+    def _workers_for(self, tool):
+
+        return self._workers.get(tool, self._DEFAULT_WORKERS)
+
+    def _semaphore(self, tool):
+
+        with self._lock:
+
+            if tool not in self._semaphores:
+
+                self._semaphores[tool] = threading.BoundedSemaphore(
+                    self._workers_for(tool))
+
+            return self._semaphores[tool]
+
+    def _pool(self, tool):
+
+        with self._lock:
+
+            if tool not in self._pools:
+
+                self._pools[tool] = _WorkerPool(tool,
+                                                self._workers_for(tool))
+
+            return self._pools[tool]
+
+    @staticmethod
+    def _kill(p, state):
+
+        state["timed_out"] = True
+
+        try:
+
+            p.kill()
+
+        except OSError:
+
+            pass
+
+    def run(self, command, stdin_data=None, env=None, cwd=None, timeout=None):
+        """
+        Runs one command and returns the tuple (return code, stdout, stderr).
+        No more commands of the same tool than the configured limit run at the
+        same time.
+
+        Raises CommandError exception when the command exceeds its timeout.
+
+        """
+
+        import subprocess
+
+        if timeout is None:
+
+            timeout = self._timeout
+
+        state = {"timed_out": False}
+
+        tool = self.tool(command)
+        semaphore = self._semaphore(tool)
+        semaphore.acquire()
+
+        start = time.time()
+
+        try:
+
+            p = subprocess.Popen(command,
+                                 stdin=(subprocess.PIPE
+                                        if stdin_data is not None else None),
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 env=env,
+                                 cwd=cwd)
+
+            timer = threading.Timer(timeout, self._kill, [p, state])
+            timer.start()
+
+            try:
+
+                out, err = p.communicate(stdin_data)
+
+            finally:
+
+                timer.cancel()
+                timer.join()
+
+        finally:
+
+            semaphore.release()
+
+            Metrics().observe("git2cc_command_duration_seconds",
+                              time.time() - start, tool=tool,
+                              command=self.operation(command))
+
+        if state["timed_out"]:
+
+            raise CommandError(" ".join(command[:3]) + " timed out after " +
+                               str(timeout) + "s")
+
+        return p.returncode, out, err
+
+    def stream(self, command, env=None, cwd=None, timeout=None):
+        """
+        Runs one command and yields its standard output line by line while
+        it is still running, so the caller can start working on the first
+        lines. The command counts against the limit of its tool until it
+        finishes.
+
+        Raises CommandError exception when the command fails or exceeds its
+        timeout.
+
+        """
+
+        import subprocess
+        import tempfile
+
+        if timeout is None:
+
+            timeout = self._timeout
+
+        state = {"timed_out": False}
+
+        tool = self.tool(command)
+        semaphore = self._semaphore(tool)
+        semaphore.acquire()
+
+        start = time.time()
+
+        try:
+
+            # A file avoids blocking the command when stderr is large
+            errfile = tempfile.TemporaryFile()
+
+            p = subprocess.Popen(command,
+                                 stdout=subprocess.PIPE,
+                                 stderr=errfile,
+                                 env=env,
+                                 cwd=cwd)
+
+            timer = threading.Timer(timeout, self._kill, [p, state])
+            timer.start()
+
+            try:
+
+                for line in iter(p.stdout.readline, ""):
+
+                    yield line
+
+                p.wait()
+
+            finally:
+
+                timer.cancel()
+                timer.join()
+
+                # The caller could stop reading before the end
+                if p.poll() is None:
+
+                    self._kill(p, {})
+                    p.wait()
+
+                p.stdout.close()
+
+        finally:
+
+            semaphore.release()
+
+            Metrics().observe("git2cc_command_duration_seconds",
+                              time.time() - start, tool=tool,
+                              command=self.operation(command))
+
+        if state["timed_out"]:
+
+            raise CommandError(" ".join(command[:3]) + " timed out after " +
+                               str(timeout) + "s")
+
+        if p.returncode != 0:
+
+            errfile.seek(0)
+
+            raise CommandError(" ".join(command[:3]) + " failed: " +
+                               errfile.read())
+
+    def submit(self, tool, function, *args, **kwargs):
+        """
+        Runs function(*args, **kwargs) in the worker pool of the given tool
+        and returns a CommandFuture.
+
+        """
+
+        return self._pool(tool).submit(function, args, kwargs)
+
+    @staticmethod
+    def wait_all(futures):
+        """
+        Waits for every given future. Returns the list of exceptions raised
+        by the failed ones.
+
+        """
+
+        errors = []
+
+        for future in futures:
+
+            try:
+
+                future.result()
+
+            except:
+
+                errors.append(sys.exc_info()[1])
+
+        return errors
+
+    @staticmethod
+    def parallel(name, function, work):
+        """
+        Calls function(*args) for every args of work, each in its own thread
+        (not in a worker pool, so the functions may submit commands), and
+        returns their results in the same order. The first exception raised
+        is raised again when every call has finished.
+
+        """
+
+        if len(work) == 1:
+
+            return [function(*work[0])]
+
+        results = [None] * len(work)
+        errors = []
+
+        def target(i, args):
+
+            try:
+
+                results[i] = function(*args)
+
+            except:
+
+                errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=target, args=(i, args),
+                                    name=name + "-" + str(i))
+                   for i, args in enumerate(work)]
+
+        for thread in threads:
+
+            thread.start()
+
+        for thread in threads:
+
+            thread.join()
+
+        if errors:
+
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+        return results
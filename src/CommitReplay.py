@@ -0,0 +1,411 @@
+"""
+@summary: This module synchronizes a push commit by commit (sync_mode:
+replay). Every commit of the pushed branch, following first parents, becomes
+its own ClearCase change set with its own checkout comment and labels, instead
+of one checkout per file with the comments of the whole push.
+
+ClearCase operations are pipelined: the checkins of a commit run in the
+cleartool workers while the next commit is checked out and written in the
+view. A commit only waits for the pending checkins of the files it changes
+again, or for all of them when it adds or removes elements, because the
+directories are then checked out. The labels of a commit are set on all its
+files at once, when their checkins have finished.
+
+When a commit fails its checkouts are cancelled, the view goes back to the
+last commit completely written and that commit is saved in the view
+(.git/git2cc-replay), so the next replay of the branch resumes from it.
+
+"""
+
+import os
+import sys
+import Log
+
+from CheckoutTree import CheckoutTree
+from ClearCase import CCError
+from CommandEngine import CommandEngine
+from GIT import GITError
+from HooksConfig import HooksConfig
+from PushMetadata import PushMetadata
+
+
+class CommitReplay(object):
+
+    """
+    Replays the commits of one push in the ClearCase view.
+    """
+
+    _ = None
+
+    def __init__(self, git, shard, ref):
+        """
+        Class constructor. Only the files of the given shard (see ShardMap)
+        are written, in its view; ref is the pushed reference
+        (refs/heads/<branch>).
+
+        """
+
+        self._ = HooksConfig.get_translations()
+        self._git = git
+        self._shard = shard
+        self._cc = shard.cc
+        self._engine = CommandEngine()
+        self._view = shard.view + os.sep
+        self._ref = ref
+
+        # Checkins still running: {<ccpath>: <CommandFuture>}
+        self._pending = {}
+
+        # Commits written whose checkins or labels may be pending, oldest
+        # first: [<commit>, <labels>, <modified ccpaths>]
+        self._written = []
+
+        # Last commit completely written in ClearCase
+        self.last = None
+
+        self.labels = []
+        self.files = 0
+
+    def _wait(self, ccpaths=None):
+        """
+        Waits for the pending checkins of the given files, or for all of
+        them. Raises the first error found; failed checkins stay pending.
+
+        """
+
+        if ccpaths is None:
+
+            ccpaths = list(self._pending)
+
+        else:
+
+            # The files of a labelled commit are labelled together, before
+            # any of them is checked out again
+            ccpaths = set(ccpaths)
+
+            for commit, labels, files in self._written:
+
+                if labels and ccpaths.intersection(files):
+
+                    ccpaths.update(files)
+
+        futures = dict((ccpath, self._pending[ccpath]) for ccpath in ccpaths
+                       if ccpath in self._pending)
+        errors = CommandEngine.wait_all(futures.values())
+
+        if errors:
+
+            raise errors[0]
+
+        for ccpath in futures:
+
+            del self._pending[ccpath]
+
+        self._finish()
+
+    def _finish(self):
+        """
+        Sets the labels of the commits whose checkins have finished and
+        advances the last commit completely written. Every label type is
+        created once per VOB and set with one mklabel per group of files, in
+        this thread.
+
+        """
+
+        written = []
+
+        for commit, labels, files in self._written:
+
+            done = not any(ccpath in self._pending for ccpath in files)
+
+            if done and labels:
+
+                for vob_paths in self._cc.group_by_vob(files).values():
+
+                    self._cc.create_and_set_labels_list(vob_paths, labels)
+
+                labels = []
+
+            if done and not written:
+
+                self.last = commit
+
+            else:
+
+                written.append([commit, labels, files])
+
+        self._written = written
+
+    def _resume_file(self):
+
+        return os.path.join(self._view, ".git", "git2cc-replay")
+
+    def _resume_points(self):
+        """
+        Returns the last commit written by the failed replays of this view:
+
+            {<ref>: <commit>}
+
+        """
+
+        points = {}
+
+        if os.path.isfile(self._resume_file()):
+
+            with open(self._resume_file()) as f:
+
+                for line in f:
+
+                    fields = line.split()
+
+                    if len(fields) == 2:
+
+                        points[fields[0]] = fields[1]
+
+        return points
+
+    def _save_resume_point(self, commit):
+        """
+        Saves the commit the next replay of the reference resumes from, or
+        forgets it when commit is None.
+
+        """
+
+        points = self._resume_points()
+
+        if commit is None and self._ref not in points:
+
+            return
+
+        if commit is None:
+
+            del points[self._ref]
+
+            if not points:
+
+                os.remove(self._resume_file())
+                return
+
+        else:
+
+            points[self._ref] = commit
+
+        tmp = self._resume_file() + "." + str(os.getpid()) + ".tmp"
+
+        with open(tmp, "w") as f:
+
+            for ref in sorted(points):
+
+                f.write(ref + " " + points[ref] + "\n")
+
+        os.rename(tmp, self._resume_file())
+
+    def replay(self, old_revision, new_revision, view_revision=None):
+        """
+        Writes in ClearCase every commit between old_revision and
+        new_revision changing the shard. The view is at view_revision, which
+        is old_revision unless previous pushes did not touch the shard. A
+        previous replay of the reference that failed is resumed from the
+        last commit it wrote.
+
+        Raises CCError or GITError exception when any operation fails, after
+        undoing the commit being written (see _rollback).
+
+        """
+
+        previous = view_revision or old_revision
+        resumed = self._resume_points().get(self._ref)
+
+        if (resumed is not None and resumed != new_revision and
+                self._git.is_ancestor(resumed, new_revision)):
+
+            Log.warning("Resuming the replay interrupted after " + resumed)
+            old_revision = previous = resumed
+
+        commits = self._git.list_commits(old_revision, new_revision)
+
+        Log.info("Replaying " + str(len(commits)) + " commits in " +
+                 self._view)
+
+        self.last = previous
+        fetch = True
+
+        try:
+
+            for commit, committer, message, file_status_list in commits:
+
+                shard_files = [git_file for git_file in file_status_list
+                               if self._shard.owns(git_file[1])]
+
+                # Commits changing only other shards are left to their views
+                if file_status_list and not shard_files:
+
+                    continue
+
+                # The branch is fetched in the view by the first commit
+                self._replay_commit(previous, commit, committer, message,
+                                    shard_files, fetch)
+                previous = commit
+                fetch = False
+
+            self._wait()
+
+        except:
+
+            exc_info = sys.exc_info()
+            self._rollback()
+
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        self._save_resume_point(None)
+
+    def _rollback(self):
+        """
+        Undoes the commit being written after a failure: its checkouts are
+        cancelled, the view goes back to the last commit completely written
+        and that commit is saved, so the next replay of the reference
+        resumes after it instead of losing the rest of the push.
+
+        """
+
+        # Let the running checkins finish, the failed ones stay pending
+        CommandEngine.wait_all(self._pending.values())
+
+        for ccpath, future in self._pending.items():
+
+            try:
+
+                future.result()
+                del self._pending[ccpath]
+
+            except:
+
+                pass
+
+        try:
+
+            self._finish()
+
+        except CCError as e:
+
+            # The files stay checked in, the rollback goes on
+            Log.error("Replay labels not set in " + self._view + ": " +
+                      str(e.value))
+
+        self._pending = {}
+        self._written = []
+
+        try:
+
+            self._cc.uncheckout_all()
+
+            head = self._git.view_head(self._view)
+
+            if head != self.last:
+
+                self._git.update_view(self._view, self._ref, head, self.last,
+                                      False)
+
+        except (CCError, GITError) as e:
+
+            Log.error("Replay not undone in " + self._view + ": " +
+                      str(e.value))
+
+        self._save_resume_point(self.last)
+
+        Log.error("ClearCase has the commits of " + self._ref + " up to " +
+                  self.last + ", the next push resumes from it")
+
+    def _replay_commit(self, previous, commit, committer, message,
+                       file_status_list, fetch):
+        """
+        Writes one commit in ClearCase and leaves the checkins of its modified
+        files running.
+
+        """
+
+        metadata = PushMetadata(committer, [message])
+        added = []
+        modified = []
+        deleted = False
+
+        # Ignored files (see IgnoreRules) are not in the list
+        for git_file in file_status_list:
+
+            if git_file[0] == 'A':
+
+                added.append(self._view + git_file[1])
+
+            elif git_file[0] == 'M':
+
+                modified.append(self._view + git_file[1])
+
+            elif git_file[0] == 'D':
+
+                deleted = True
+
+            else:
+
+                raise CCError(self._("filestatus_not_supported") + " " +
+                              self._view + git_file[1])
+
+        Log.info("  " + commit[:10] + " " + message.split("\n", 1)[0] +
+                 ": " + str(len(file_status_list)) + " files")
+
+        self.files += len(file_status_list)
+
+        for label in metadata.labels:
+
+            if label not in self.labels:
+
+                self.labels.append(label)
+
+        if added or deleted:
+
+            self._wait()
+
+        else:
+
+            self._wait(modified)
+
+        # Checkouts of the commit run in the workers
+        errors = CommandEngine.wait_all([
+            self._engine.submit("cleartool", self._cc.checkout, ccpath,
+                                metadata.checkout_comment)
+            for ccpath in modified])
+
+        if errors:
+
+            raise errors[0]
+
+        co_list = CheckoutTree()
+
+        if added:
+
+            self._cc.create_paths([os.path.dirname(ccpath)
+                                   for ccpath in added])
+
+        if deleted:
+
+            self._cc.remove_names([self._view + deletion for deletion in
+                                   self._git.list_deletions(previous,
+                                                            commit)
+                                   if self._shard.owns(deletion)],
+                                  co_list)
+
+        self._git.update_view(self._view, self._ref, previous, commit, fetch)
+
+        if added:
+
+            self._cc.create_files(added, metadata.labels, co_list)
+
+        self._cc.checkin_list(co_list, metadata.labels)
+
+        # Labels are set once the checkins finish, see _finish
+        for ccpath in modified:
+
+            self._pending[ccpath] = self._engine.submit(
+                "cleartool", self._cc.checkin, ccpath)
+
+        self._written.append([commit, metadata.labels, modified])
+        self._finish()
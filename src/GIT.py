@@ -5,10 +5,14 @@ result in an easy access way.
 """
 
 import os
-import subprocess
 import sys
 
+import Log
+
+from CommandEngine import CommandEngine
+from CommandEngine import CommandError
 from HooksConfig import HooksConfig
+from IgnoreRules import IgnoreRules
 
 
 class GITError(Exception):
@@ -27,7 +31,12 @@ class GITError(Exception):
 
 class GIT:
 
+    # Maximum number of paths given to one git command
+    _MAX_PATHS_PER_COMMAND = 200
+
     _ = None
+    _engine = None
+    _ignore = None
 
     def __init__(self):
 
@@ -36,6 +45,13 @@ class GIT:
             # Load user messages
             self._ = HooksConfig.get_translations()
 
+            # Bounded command execution shared by the whole process
+            self._engine = CommandEngine()
+
+            # Paths never synchronized with ClearCase are left out of the
+            # diffs
+            self._ignore = IgnoreRules()
+
         except:
 
             raise
@@ -66,17 +82,13 @@ class GIT:
 
             [<File status>, <Path to file>]
 
-        """
+        Ignored paths (see IgnoreRules) are left out.
 
-        filestatus = []
+        """
 
         lines = diff.splitlines()
 
-        for line in lines:
-
-            filestatus.append(line.split())
-
-        return filestatus
+        return list(self._ignore.filter(line.split() for line in lines))
 
     def _set_env(self, gitpath):
         """
@@ -108,18 +120,17 @@ class GIT:
 
         try:
 
-            p = subprocess.Popen(["git", "diff", old_revision, new_revision,
-                                  "--name-status"],
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            diff, err = p.communicate()
+            returncode, diff, err = self._engine.run(["git", "diff",
+                                                      old_revision,
+                                                      new_revision,
+                                                      "--name-status"])
 
         except:
 
             raise GITError("git diff" + self._("command_failed") +
                            str(sys.exc_info()))
 
-        if p.returncode == 0:
+        if returncode == 0:
 
             filestatus = self._parse_diff(diff)
 
@@ -129,6 +140,38 @@ class GIT:
 
         return filestatus
 
+    def iter_commit_files(self, old_revision, new_revision):
+        """
+        Same as get_commit_files, but yields every [<File status>, <Path to
+        file>] element as soon as GIT prints it.
+
+        Raises GITError exception when GIT command fails.
+
+        """
+
+        try:
+
+            for line in self._engine.stream(["git", "diff", old_revision,
+                                             new_revision, "--name-status"]):
+
+                if line.strip() and \
+                        not self._ignore.ignored(line.split()[1]):
+
+                    yield line.split()
+
+        except CommandError as e:
+
+            raise GITError("git diff" + self._("command_failed") + e.value)
+
+        except (GITError, GeneratorExit):
+
+            raise
+
+        except:
+
+            raise GITError("git diff" + self._("command_failed") +
+                           str(sys.exc_info()))
+
     def get_comments_list(self, old_revision, new_revision):
         """
         This function returns a comments list of all commits between the
@@ -144,17 +187,15 @@ class GIT:
 
         try:
 
-            p = subprocess.Popen(["git", "rev-list", revision_range],
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            revisions, err = p.communicate()
+            returncode, revisions, err = self._engine.run(["git", "rev-list",
+                                                           revision_range])
 
         except:
 
             raise GITError("git rev-list" + self._("command_failed") +
                            str(sys.exc_info()))
 
-        if p.returncode == 0:
+        if returncode == 0:
 
             for revision in revisions.splitlines():
                 """
@@ -165,23 +206,20 @@ class GIT:
                 """
                 try:
 
-                    p1 = subprocess.Popen(["git", "cat-file", "commit",
-                                           revision],
-                                          stdout=subprocess.PIPE)
-                    p2 = subprocess.Popen(["sed", "1,/^$/d"], stdin=p1.stdout,
-                                          stdout=subprocess.PIPE,
-                                          stderr=subprocess.PIPE)
-                    # Allow p1 to receive a SIGPIPE if p2 exits
-                    p1.stdout.close()
-                    comment, err = p2.communicate()
+                    returncode, commit, err = self._engine.run(["git",
+                                                                "cat-file",
+                                                                "commit",
+                                                                revision])
 
                 except:
 
                     raise GITError("git cat-file" + self._("command_failed") +
                                    str(sys.exc_info()))
 
-                if p.returncode == 0:
+                if returncode == 0:
 
+                    # The message follows the first empty line (sed 1,/^$/d)
+                    comment = commit.partition("\n\n")[2]
                     comments.append(comment.strip())
 
                 else:
@@ -211,27 +249,96 @@ class GIT:
 
         try:
 
-            p = subprocess.Popen(["git", "log", "-1", "--pretty=%cn",
-                                  revision],
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            committer, err = p.communicate()
+            returncode, committer, err = self._engine.run(["git", "log", "-1",
+                                                           "--pretty=%cn",
+                                                           revision])
 
         except:
 
             raise GITError("git log" + self._("command_failed") +
                            str(sys.exc_info()))
 
-        if p.returncode != 0:
+        if returncode != 0:
 
             raise GITError("git log" + self._("command_failed") +
                            str(err))
 
         return committer.rstrip('\r\n')
 
+    def rev_list(self, old_revision, new_revision):
+        """
+        Returns the commits reachable from new_revision and not from
+        old_revision (every ancestor when old_revision is None), oldest
+        first.
+
+        Raises GITError exception when GIT command fails.
+
+        """
+
+        revisions = [new_revision]
+
+        if old_revision is not None and not self.isNullRevision(old_revision):
+
+            revisions = [old_revision + ".." + new_revision]
+
+        return self._execute(["git", "rev-list", "--reverse"] + revisions,
+                             None).split()
+
+    def list_commits(self, old_revision, new_revision):
+        """
+        Returns the commits from old_revision to new_revision following first
+        parents, oldest first, with the files each one changes compared with
+        its first parent:
+
+            (<commit id>, <committer>, <message>,
+             [[<File status>, <Path to file>], ...])
+
+        Ignored paths are left out of the files.
+
+        Raises GITError exception when GIT command fails.
+
+        """
+
+        # Records: \x01<commit>\0<committer>\0<message>\0\n<status>\0<path>\0...
+        out = self._execute(["git", "log", "--reverse", "--first-parent", "-m",
+                             "--no-renames", "--name-status", "-z",
+                             "--format=%x01%H%x00%cn%x00%B",
+                             old_revision + ".." + new_revision], None)
+        commits = []
+
+        for record in out.split("\x01")[1:]:
+
+            fields = record.split("\0")
+            changes = [field.lstrip("\n") for field in fields[3:]]
+            files = [[changes[i], changes[i + 1]]
+                     for i in range(0, len(changes) - 1, 2)
+                     if changes[i] and not self._ignore.ignored(changes[i + 1])]
+
+            commits.append((fields[0], fields[1], fields[2], files))
+
+        return commits
+
+    def get_comments_list_async(self, old_revision, new_revision):
+        """
+        Runs get_comments_list in the background and returns a CommandFuture.
+
+        """
+
+        return self._engine.submit("git", self.get_comments_list,
+                                   old_revision, new_revision)
+
+    def get_committer_async(self, revision):
+        """
+        Runs get_committer in the background and returns a CommandFuture.
+
+        """
+
+        return self._engine.submit("git", self.get_committer, revision)
+
     def list_deletions(self, old_revision, new_revision):
         """
-        Returns a list of files and folders deleted between the given revisions
+        Returns a list of files and folders deleted between the given
+        revisions, ignored paths left out.
 
         """
 
@@ -239,21 +346,29 @@ class GIT:
 
         try:
 
-            p = subprocess.Popen(["git", "diff-tree", "-t", old_revision,
-                                  new_revision, "--diff-filter=D",
-                                  "--name-only"],
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            pathlist, err = p.communicate()
+            returncode, pathlist, err = self._engine.run(["git", "diff-tree",
+                                                          "-t", old_revision,
+                                                          new_revision,
+                                                          "--diff-filter=D",
+                                                          "--raw"])
 
         except:
 
             raise GITError("git diff-tree" + self._("command_failed") +
                            str(sys.exc_info()))
 
-        if p.returncode == 0:
+        if returncode == 0:
 
-            deletions_list = pathlist.splitlines()
+            # Deleted directories are listed too, with tree mode in
+            # old_revision: ":040000 000000 <old> <new> D\t<path>"
+            for line in pathlist.splitlines():
+
+                status, path = line.split("\t", 1)
+                is_dir = status.startswith(":040000 ")
+
+                if not self._ignore.ignored(path, is_dir):
+
+                    deletions_list.append(path)
 
         else:
 
@@ -274,21 +389,166 @@ class GIT:
 
         try:
 
-            p = subprocess.Popen(["git pull"],
-                                 shell=True,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE,
-                                 env=gitenv)
-            out, err = p.communicate()
+            returncode, out, err = self._engine.run(["git", "pull"],
+                                                    env=gitenv)
 
         except:
 
             raise GITError(self._("CC_update_failed") + str(sys.exc_info()))
 
-        if p.returncode != 0:
+        if returncode != 0:
 
             raise GITError(self._("CC_update_failed") + str(err))
 
+    def _execute(self, command, gitenv, stdin_data=None):
+        """
+        Executes a GIT plumbing command in the given environment and returns
+        its standard output.
+
+        Raises GITError exception when GIT command fails.
+
+        """
+
+        try:
+
+            returncode, out, err = self._engine.run(command, stdin_data,
+                                                    env=gitenv)
+
+        except:
+
+            raise GITError(" ".join(command[:2]) + self._("command_failed") +
+                           str(sys.exc_info()))
+
+        if returncode != 0:
+
+            raise GITError(" ".join(command[:2]) + self._("command_failed") +
+                           str(err))
+
+        return out
+
+    def view_head(self, gitpath):
+        """
+        Returns the revision checked out in the snapshot view repository.
+
+        Raises GITError exception when GIT command fails.
+
+        """
+
+        return self._execute(["git", "rev-parse", "HEAD"],
+                             self._set_env(gitpath)).rstrip('\r\n')
+
+    def update_view(self, gitpath, ref, old_revision, new_revision,
+                    fetch=True):
+        """
+        Updates the snapshot view repository to new_revision touching only the
+        paths changed between old_revision and new_revision. Instead of a full
+        git pull, the pushed branch is fetched from the bare repository and
+        the index and working tree are updated with plumbing commands:
+
+            * git diff-tree gives the changed paths and their new blobs.
+            * git update-index --index-info stages exactly those entries.
+            * git checkout-index writes added and modified files.
+            * Deleted files are unlinked from the working tree.
+
+        The resulting index must match the tree of new_revision, otherwise
+        GITError is raised. When the view is not at old_revision the method
+        falls back to a regular pull. With fetch False the branch must have
+        been fetched by a previous call.
+
+        Raises GITError exception when GIT command fails.
+
+        """
+
+        gitenv = self._set_env(gitpath)
+
+        head = self.view_head(gitpath)
+
+        if head != old_revision:
+
+            Log.warning("View HEAD " + head + " differs from " + old_revision +
+                        ", falling back to git pull")
+            self.pull(gitpath)
+            return
+
+        # Fetch only the pushed branch. Storing it in the remote tracking ref
+        # lets git follow the tags pointing into the fetched history.
+        if fetch:
+
+            branch = ref.split('/', 2)[2]
+            self._execute(["git", "fetch", "origin",
+                           "+" + ref + ":refs/remotes/origin/" + branch],
+                          gitenv)
+            self._execute(["git", "cat-file", "-e",
+                           new_revision + "^{commit}"], gitenv)
+
+        # Raw diff lines:
+        # :<old mode> <new mode> <old sha> <new sha> <status>\0<path>\0
+        raw = self._execute(["git", "diff-tree", "-r", "-z", "--no-renames",
+                             old_revision, new_revision], gitenv)
+        fields = raw.split('\0')
+
+        index_info = []
+        checkout_paths = []
+        deleted_paths = []
+
+        for i in range(0, len(fields) - 1, 2):
+
+            meta = fields[i].lstrip(':').split()
+            path = fields[i + 1]
+
+            if meta[4] == 'D':
+
+                index_info.append("0 " + GIT.nullRevision() + "\t" + path)
+                deleted_paths.append(path)
+
+            else:
+
+                index_info.append(meta[1] + " " + meta[3] + "\t" + path)
+                checkout_paths.append(path)
+
+        Log.debug("Incremental view update: " + str(len(checkout_paths)) +
+                  " paths to write, " + str(len(deleted_paths)) +
+                  " paths to remove")
+
+        if index_info:
+
+            self._execute(["git", "update-index", "-z", "--index-info"],
+                          gitenv, '\0'.join(index_info) + '\0')
+
+        if checkout_paths:
+
+            self._execute(["git", "checkout-index", "-f", "-z", "--stdin"],
+                          gitenv, '\0'.join(checkout_paths) + '\0')
+
+        for path in deleted_paths:
+
+            # Deletions could be already done by ClearCase rmname
+            if os.path.lexists(gitpath + path):
+
+                os.remove(gitpath + path)
+
+        # The staged tree must be exactly the pushed one
+        index_tree = self._execute(["git", "write-tree"],
+                                   gitenv).rstrip('\r\n')
+        expected_tree = self._execute(["git", "rev-parse",
+                                       new_revision + "^{tree}"],
+                                      gitenv).rstrip('\r\n')
+
+        if index_tree != expected_tree:
+
+            raise GITError(self._("CC_update_failed") +
+                           self._("tree_mismatch") + new_revision)
+
+        for path in checkout_paths:
+
+            if not os.path.lexists(gitpath + path):
+
+                raise GITError(self._("CC_update_failed") + gitpath + path +
+                               self._("file_not_exists"))
+
+        self._execute(["git", "update-ref", "-m", "git2cc: incremental update",
+                       "HEAD", new_revision, old_revision], gitenv)
+
     def last_commit_labels(self, gitpath):
         """
         Executes git describe command in the HEAD to return labels
@@ -303,18 +563,14 @@ class GIT:
 
         try:
 
-            p = subprocess.Popen(["git tag --points-at HEAD"],
-                              shell=True,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE,
-                              env=gitenv)
-            pathlist, err = p.communicate()
+            returncode, pathlist, err = self._engine.run(
+                ["git", "tag", "--points-at", "HEAD"], env=gitenv)
 
         except:
 
             raise GITError(self._("GIT_labels_failed") + str(sys.exc_info()))
 
-        if p.returncode == 0:
+        if returncode == 0:
 
             labels_list = pathlist.splitlines()
 
@@ -324,3 +580,277 @@ class GIT:
                           str(err))
 
         return labels_list
+
+    def resolve(self, ref):
+        """
+        Returns the commit id the given reference points to, or None when it
+        does not exist.
+
+        """
+
+        try:
+
+            returncode, out, err = self._engine.run(["git", "rev-parse",
+                                                     "--verify", "-q",
+                                                     ref + "^{commit}"])
+
+        except:
+
+            raise GITError("git rev-parse" + self._("command_failed") +
+                           str(sys.exc_info()))
+
+        if returncode != 0:
+
+            return None
+
+        return out.strip()
+
+    def is_ancestor(self, ancestor, revision):
+        """
+        Checks if ancestor is revision or one of its ancestors.
+
+        Raises GITError exception when GIT command fails.
+
+        """
+
+        try:
+
+            returncode, out, err = self._engine.run(["git", "merge-base",
+                                                     "--is-ancestor",
+                                                     ancestor, revision])
+
+        except:
+
+            raise GITError("git merge-base" + self._("command_failed") +
+                           str(sys.exc_info()))
+
+        if returncode not in (0, 1):
+
+            raise GITError("git merge-base" + self._("command_failed") +
+                           str(err))
+
+        return returncode == 0
+
+    def tree_entries(self, revision, paths):
+        """
+        Returns the files of the revision tree matching the given paths (files
+        or directories) as:
+
+            {<path>: (<mode>, <blob id>)}
+
+        Raises GITError exception when GIT command fails.
+
+        """
+
+        entries = {}
+
+        for i in range(0, len(paths), self._MAX_PATHS_PER_COMMAND):
+
+            chunk = paths[i:i + self._MAX_PATHS_PER_COMMAND]
+            out = self._execute(["git", "ls-tree", "-r", "-z", revision,
+                                 "--"] + chunk, None)
+
+            for record in out.split("\0"):
+
+                if record:
+
+                    info, path = record.split("\t", 1)
+                    mode, kind, blob = info.split()
+                    entries[path] = (mode, blob)
+
+        return entries
+
+
+    def list_tree(self, revision):
+        """
+        Returns every file of the revision tree (submodules are left out) as:
+
+            {<path>: (<mode>, <blob id>, <size>)}
+
+        Raises GITError exception when GIT command fails.
+
+        """
+
+        entries = {}
+        out = self._execute(["git", "ls-tree", "-r", "-l", "-z", revision],
+                            None)
+
+        for record in out.split("\0"):
+
+            if record:
+
+                info, path = record.split("\t", 1)
+                mode, kind, blob, size = info.split()
+
+                if kind == "blob":
+
+                    entries[path] = (mode, blob, int(size))
+
+        return entries
+
+
+class FastImport(object):
+
+    """
+    Commits written to git fast-import in the repository of the current
+    directory. Data is sent as it is produced, so memory use does not depend
+    on the size of the import.
+    """
+
+    _checkpoints = 0
+
+    _ = None
+
+    def __init__(self, options=()):
+
+        import subprocess
+        import tempfile
+
+        self._ = HooksConfig.get_translations()
+        self._errfile = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(["git", "fast-import", "--quiet",
+                                          "--date-format=raw"] + list(options),
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=self._errfile)
+
+    @staticmethod
+    def _path(path):
+        """
+        Quotes a path when fast-import requires it.
+
+        """
+
+        if '"' in path or "\n" in path or "\\" in path:
+
+            return ('"' + path.replace("\\", "\\\\").replace('"', '\\"')
+                    .replace("\n", "\\n") + '"')
+
+        return path
+
+    def _data(self, data):
+
+        self._process.stdin.write("data " + str(len(data)) + "\n")
+        self._process.stdin.write(data)
+        self._process.stdin.write("\n")
+
+    def blob(self, mark, data):
+        """
+        Writes a blob that later commits reference as :mark.
+
+        """
+
+        self._process.stdin.write("blob\nmark :" + str(mark) + "\n")
+        self._data(data)
+
+    def commit(self, ref, author, date, message, parent=None, changes=(),
+               mark=None):
+        """
+        Writes one commit of the given reference. Author is "name <email>"
+        and date a raw GIT date. Changes are tuples:
+
+            ("M", <mode>, <path>, <content or :mark>)
+            ("D", <path>)
+
+        """
+
+        write = self._process.stdin.write
+
+        write("commit " + ref + "\n")
+
+        if mark is not None:
+
+            write("mark :" + str(mark) + "\n")
+
+        write("author " + author + " " + date + "\n")
+        write("committer " + author + " " + date + "\n")
+        self._data(message)
+
+        if parent is not None:
+
+            write("from " + parent + "\n")
+
+        for change in changes:
+
+            if change[0] == "D":
+
+                write("D " + self._path(change[1]) + "\n")
+
+            elif change[3].startswith(":"):
+
+                write("M " + change[1] + " " + change[3] + " " +
+                      self._path(change[2]) + "\n")
+
+            else:
+
+                write("M " + change[1] + " inline " + self._path(change[2]) +
+                      "\n")
+                self._data(change[3])
+
+        write("\n")
+
+    def checkpoint(self):
+        """
+        Makes fast-import update the references and write its pack, so the
+        commits sent so far survive an interruption. Returns once the
+        references are updated.
+
+        Raises GITError exception when fast-import fails.
+
+        """
+
+        self._checkpoints += 1
+        progress = "progress checkpoint " + str(self._checkpoints) + "\n"
+
+        try:
+
+            self._process.stdin.write("checkpoint\n\n" + progress)
+            self._process.stdin.flush()
+
+            line = self._process.stdout.readline()
+
+        except IOError:
+
+            line = ""
+
+        if line != progress:
+
+            self.abort()
+            self._errfile.seek(0)
+
+            raise GITError("git fast-import" + self._("command_failed") +
+                           self._errfile.read())
+
+    def close(self):
+        """
+        Finishes the import and updates the references.
+
+        Raises GITError exception when fast-import fails.
+
+        """
+
+        self._process.stdin.close()
+        self._process.wait()
+
+        if self._process.returncode != 0:
+
+            self._errfile.seek(0)
+
+            raise GITError("git fast-import" + self._("command_failed") +
+                           self._errfile.read())
+
+    def abort(self):
+        """
+        Stops the import without updating any reference.
+
+        """
+
+        try:
+
+            self._process.kill()
+
+        except OSError:
+
+            pass
+
+        self._process.wait()
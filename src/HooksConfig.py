@@ -4,8 +4,7 @@
 """
 
 import ConfigParser
-import gettext
-import locale
+import logging
 import os
 
 
@@ -31,6 +30,8 @@ class HooksConfig(object):
     __instance = None
 
     _ = None
+    _ugettext = None
+    _initialized = False
     _config = ConfigParser.ConfigParser()
     _CONFIG_FILE = "hooks_config" + os.sep + "bridge.cfg"
 
@@ -40,7 +41,10 @@ class HooksConfig(object):
         return ('en_US', 'UTF8')
 
     @staticmethod
-    def get_translations():
+    def _load_translations():
+
+        import gettext
+        import locale
 
         user_locale = locale.getdefaultlocale()
 
@@ -61,6 +65,24 @@ class HooksConfig(object):
 
         return t.ugettext
 
+    @staticmethod
+    def get_translations():
+        """
+        Returns the function translating user messages. Message catalogs are
+        loaded the first time a message is translated.
+
+        """
+
+        def translate(message):
+
+            if HooksConfig._ugettext is None:
+
+                HooksConfig._ugettext = HooksConfig._load_translations()
+
+            return HooksConfig._ugettext(message)
+
+        return translate
+
     def __new__(cls, *args, **kargs):
 
         if cls.__instance is None:
@@ -76,6 +98,11 @@ class HooksConfig(object):
 
         """
 
+        # The file is read only once per process
+        if self._initialized:
+
+            return
+
         # Load user messages
         self._ = HooksConfig.get_translations()
 
@@ -83,6 +110,8 @@ class HooksConfig(object):
         self._config.readfp(open(self._CONFIG_FILE))
         self._validate_config()
 
+        self._initialized = True
+
     def _validate_config(self):
         """
         This procedure checks the configuration file and ensures every section,
@@ -171,8 +200,343 @@ class HooksConfig(object):
                                         "sync_branches").split(',')
             branches = [x.strip() for x in branches]
 
+        # Branches with their own view are synchronized too
+        for section in sorted(self._config.sections()):
+
+            if (section.startswith("branch:") and
+                    section[len("branch:"):] not in branches):
+
+                branches.append(section[len("branch:"):])
+
         return branches
 
+    def get_view_update_mode(self):
+        """
+        Returns how the snapshot view is updated after a push:
+            * pull: git pull in the view (default).
+            * incremental: only the paths changed in the push are updated.
+
+        """
+
+        mode = "pull"
+
+        if self._config.has_option("git_config", "view_update_mode"):
+
+            mode = self._config.get("git_config", "view_update_mode").strip()
+
+        if mode not in ("pull", "incremental"):
+
+            raise ConfigException(mode + self._("invalid_value") +
+                                  " view_update_mode " +
+                                  self._("in_section") + " git_config.")
+
+        return mode
+
+    def get_sync_mode(self):
+        """
+        Returns how a push is written in ClearCase:
+            * squash: one checkout per file with the comments of every commit
+              (default).
+            * replay: every commit is its own change set with its comment and
+              labels.
+
+        """
+
+        mode = "squash"
+
+        if self._config.has_option("git_config", "sync_mode"):
+
+            mode = self._config.get("git_config", "sync_mode").strip()
+
+        if mode not in ("squash", "replay"):
+
+            raise ConfigException(mode + self._("invalid_value") +
+                                  " sync_mode " +
+                                  self._("in_section") + " git_config.")
+
+        return mode
+
+    def get_lock_timeout(self):
+        """
+        Returns the seconds a push waits for the ClearCase view lock before
+        being rejected
+
+        """
+
+        timeout = 600
+
+        if self._config.has_option("cc_view", "lock_timeout"):
+
+            timeout = self._config.getint("cc_view", "lock_timeout")
+
+        return timeout
+
+    def get_cache_enabled(self):
+        """
+        Returns True when the persistent ClearCase metadata cache is enabled
+
+        """
+
+        enabled = False
+
+        if self._config.has_option("cc_cache", "enabled"):
+
+            enabled = self._config.getboolean("cc_cache", "enabled")
+
+        return enabled
+
+    def get_cache_ttl(self):
+        """
+        Returns the seconds a cached ClearCase fact is trusted. Changes made by
+        other ClearCase users are detected once this time has passed.
+
+        """
+
+        ttl = 300
+
+        if self._config.has_option("cc_cache", "ttl"):
+
+            ttl = self._config.getint("cc_cache", "ttl")
+
+        return ttl
+
+    def get_manifest_enabled(self):
+        """
+        Returns True when the manifest of the synchronized tree is kept
+
+        """
+
+        enabled = False
+
+        if self._config.has_option("manifest", "enabled"):
+
+            enabled = self._config.getboolean("manifest", "enabled")
+
+        return enabled
+
+    def get_ledger_enabled(self):
+        """
+        Returns True when the ledger of synchronizations is kept and used to
+        detect commits coming from ClearCase
+
+        """
+
+        enabled = False
+
+        if self._config.has_option("ledger", "enabled"):
+
+            enabled = self._config.getboolean("ledger", "enabled")
+
+        return enabled
+
+    def get_engine_workers(self, tool):
+        """
+        Returns the maximum number of commands of the given tool (git or
+        cleartool) running at the same time
+
+        """
+
+        workers = 4
+
+        if self._config.has_option("command_engine", tool + "_workers"):
+
+            workers = self._config.getint("command_engine", tool + "_workers")
+
+        return max(1, workers)
+
+    def get_command_timeout(self):
+        """
+        Returns the seconds a single GIT or ClearCase command may run before
+        being killed
+
+        """
+
+        timeout = 3600
+
+        if self._config.has_option("command_engine", "timeout"):
+
+            timeout = self._config.getint("command_engine", "timeout")
+
+        return timeout
+
+    def _get_level(self, option, default):
+
+        level = default
+
+        if self._config.has_option("log", option):
+
+            name = self._config.get("log", option).strip().upper()
+            level = logging.getLevelName(name)
+
+            if not isinstance(level, int):
+
+                raise ConfigException(name + self._("invalid_value") + " " +
+                                      option + " " + self._("in_section") +
+                                      " log.")
+
+        return level
+
+    def get_log_levels(self):
+        """
+        Returns the (console level, file level) tuple of the hooks log
+
+        """
+
+        return (self._get_level("console_level", logging.INFO),
+                self._get_level("file_level", logging.DEBUG))
+
+    def get_log_collector(self):
+        """
+        Returns the unix socket of the central log collector, or None when
+        every hook writes its own log records
+
+        """
+
+        collector = None
+
+        if (self._config.has_option("log", "collector") and
+                self._config.getboolean("log", "collector")):
+
+            collector = "/tmp/Git2CC.sock"
+
+            if self._config.has_option("log", "collector_socket"):
+
+                collector = self._config.get("log", "collector_socket").strip()
+
+        return collector
+
+    def get_metrics_dir(self):
+        """
+        Returns the textfile directory of the Prometheus node exporter where
+        metrics are written, or None when metrics are not exported
+
+        """
+
+        directory = None
+
+        if self._config.has_option("metrics", "textfile_dir"):
+
+            directory = self._config.get("metrics", "textfile_dir").strip()
+
+        return directory or None
+
+    def get_profile_enabled(self):
+        """
+        Returns True when the hooks must run under the profiler
+
+        """
+
+        enabled = False
+
+        if self._config.has_option("profile", "enabled"):
+
+            enabled = self._config.getboolean("profile", "enabled")
+
+        return enabled
+
+    def get_profile_dir(self):
+        """
+        Returns the directory where the profile of every push is saved
+
+        """
+
+        directory = "/tmp/Git2CC-profiles"
+
+        if self._config.has_option("profile", "directory"):
+
+            directory = self._config.get("profile", "directory").strip()
+
+        return directory
+
+    def get_profile_top(self):
+        """
+        Returns the number of functions of the profile summary written in the
+        log
+
+        """
+
+        top = 25
+
+        if self._config.has_option("profile", "top"):
+
+            top = self._config.getint("profile", "top")
+
+        return top
+
+    def get_profile_min_files(self):
+        """
+        Returns the minimum number of files of a push to keep its profile
+
+        """
+
+        min_files = 0
+
+        if self._config.has_option("profile", "min_files"):
+
+            min_files = self._config.getint("profile", "min_files")
+
+        return min_files
+
+    def get_export_branch(self):
+        """
+        Returns the GIT branch receiving the ClearCase changes exported by
+        cc_export.py. Defaults to the first synchronized branch.
+
+        """
+
+        branch = self.get_sync_branches()[0]
+
+        if self._config.has_option("cc_export", "git_branch"):
+
+            branch = self._config.get("cc_export", "git_branch").strip()
+
+        return branch
+
+    def get_export_cc_branch(self):
+        """
+        Returns the ClearCase branch (for example /main/rel_1) whose versions
+        are exported, or None to export versions of any branch
+
+        """
+
+        branch = None
+
+        if self._config.has_option("cc_export", "cc_branch"):
+
+            branch = self._config.get("cc_export", "cc_branch").strip()
+
+        return branch or None
+
+    def get_export_window(self):
+        """
+        Returns the seconds between checkins of the same user and comment
+        exported in the same GIT commit
+
+        """
+
+        window = 300
+
+        if self._config.has_option("cc_export", "window"):
+
+            window = self._config.getint("cc_export", "window")
+
+        return window
+
+    def get_import_checkpoint(self):
+        """
+        Returns the number of change sets written by cc_import.py between two
+        checkpoints. An interrupted import resumes from the last checkpoint.
+
+        """
+
+        checkpoint = 100
+
+        if self._config.has_option("cc_import", "checkpoint"):
+
+            checkpoint = self._config.getint("cc_import", "checkpoint")
+
+        return max(1, checkpoint)
+
     def get_vobs(self):
         """
         Return the configured CC vobs
@@ -184,3 +548,171 @@ class HooksConfig(object):
 
         return vobs
 
+
+    def get_shards(self):
+        """
+        Returns the snapshot views the tree is split into, one per
+        [shard:<name>] section, as (<name>, <view path>, [<path prefixes>],
+        [<vobs>]) tuples. The VOBs of a shard default to the first directory
+        of its prefixes.
+
+        """
+
+        shards = []
+
+        for section in sorted(self._config.sections()):
+
+            if not section.startswith("shard:"):
+
+                continue
+
+            for option in ("path", "prefixes"):
+
+                if not self._config.has_option(section, option):
+
+                    raise ConfigException(self._("missing_field") + " " +
+                                          option + " " +
+                                          self._("in_section") + " " +
+                                          section + ".")
+
+            view = self._config.get(section, "path").strip()
+
+            if not os.path.isdir(view):
+
+                raise ConfigException(view + self._("folder_not_exists"))
+
+            prefixes = [prefix.strip("/") for prefix
+                        in self._config.get(section, "prefixes").split()]
+
+            if self._config.has_option(section, "vobs"):
+
+                vobs = self._config.get(section, "vobs").split()
+
+            else:
+
+                vobs = sorted(set(prefix.split("/")[0]
+                                  for prefix in prefixes))
+
+            shards.append((section[len("shard:"):], view, prefixes, vobs))
+
+        return shards
+
+    def get_branch_mapping(self, branch):
+        """
+        Returns the (<view path>, [<vobs>], <ClearCase branch>) of the
+        [branch:<branch>] section, or None when the branch is synchronized in
+        the [cc_view] view. The ClearCase branch is None when it is not
+        checked.
+
+        """
+
+        section = "branch:" + branch
+
+        if not self._config.has_section(section):
+
+            return None
+
+        if not self._config.has_option(section, "path"):
+
+            raise ConfigException(self._("missing_field") + " path " +
+                                  self._("in_section") + " " + section + ".")
+
+        view = self._config.get(section, "path").strip()
+
+        if not os.path.isdir(view):
+
+            raise ConfigException(view + self._("folder_not_exists"))
+
+        vobs = [""]
+        cc_branch = None
+
+        if self._config.has_option(section, "vobs"):
+
+            vobs = self._config.get(section, "vobs").split() or [""]
+
+        if self._config.has_option(section, "cc_branch"):
+
+            cc_branch = self._config.get(section, "cc_branch").strip() or None
+
+        return view, vobs, cc_branch
+
+    def get_ignore_patterns(self):
+        """
+        Returns the gitignore-style patterns of the paths not synchronized
+        with ClearCase, one per line of [ignore] patterns.
+
+        """
+
+        patterns = []
+
+        if self._config.has_option("ignore", "patterns"):
+
+            patterns = self._config.get("ignore", "patterns").splitlines()
+
+        return [pattern.strip() for pattern in patterns if pattern.strip()]
+
+    def get_admission_enabled(self):
+        """
+        Returns True when the update hook estimates the cost of every push
+        before synchronizing it (see Admission)
+
+        """
+
+        enabled = False
+
+        if self._config.has_option("admission", "enabled"):
+
+            enabled = self._config.getboolean("admission", "enabled")
+
+        return enabled
+
+    def get_admission_limits(self):
+        """
+        Returns the estimated seconds above which a push is deferred to the
+        post-receive hook and above which it is rejected. 0 disables a limit.
+
+        """
+
+        limits = []
+
+        for option in ("defer_seconds", "reject_seconds"):
+
+            limit = 0
+
+            if self._config.has_option("admission", option):
+
+                limit = self._config.getint("admission", option)
+
+            limits.append(max(0, limit))
+
+        return tuple(limits)
+
+    def get_default_latency(self):
+        """
+        Returns the seconds a cleartool command is estimated to take while the
+        metrics have too few observations of it
+
+        """
+
+        latency = 1.0
+
+        if self._config.has_option("admission", "default_latency"):
+
+            latency = self._config.getfloat("admission", "default_latency")
+
+        return latency
+
+    def get_latency_samples(self):
+        """
+        Returns the observations of a cleartool command the metrics need
+        before its mean duration is used in the estimates
+
+        """
+
+        samples = 20
+
+        if self._config.has_option("admission", "min_samples"):
+
+            samples = self._config.getint("admission", "min_samples")
+
+        return max(1, samples)
@@ -0,0 +1,285 @@
+"""
+@summary: This module decides which paths of the repository are never
+synchronized with ClearCase. The rules are the patterns of the [ignore]
+section, written as in .gitignore files:
+
+    * A pattern without '/' (or only a trailing one) matches the name of a
+      file or directory at any level: *.o, build/
+    * A pattern with '/' is relative to the root of the repository:
+      /vendor, docs/generated
+    * A trailing '/' only matches directories, '*' and '?' do not match '/'
+      and '**' matches any number of directories.
+    * A pattern starting with '!' synchronizes again a path excluded by a
+      previous pattern, unless one of its directories is excluded.
+
+The root .gitignore file is always ignored. The rules are compiled once per
+process: patterns without wildcards are stored in a prefix tree of path
+components (anchored ones) or a dictionary of names, and the rest are joined
+in one regular expression (per 99 patterns) whose alternatives are tried from
+the last pattern to the first, so its first match is the pattern that
+decides. Every directory
+of a path is checked once, while walking the prefix tree.
+
+"""
+
+import re
+
+from HooksConfig import HooksConfig
+
+# Always first, so it can be negated in the configuration
+DEFAULT_PATTERNS = ["/.gitignore"]
+
+_WILDCARDS = re.compile(r"[*?[]")
+
+# Python 2 regular expressions support at most 100 named groups
+_MAX_GROUPS = 99
+
+
+def _translate(pattern):
+    """
+    Returns the regular expression of a gitignore pattern with wildcards,
+    without anchors.
+
+    """
+
+    regex = ""
+    i = 0
+
+    while i < len(pattern):
+
+        if pattern.startswith("**/", i):
+
+            regex += "(?:.*/)?"
+            i += 3
+
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+
+            regex += "/.*"
+            i += 3
+
+        elif pattern.startswith("**", i):
+
+            regex += ".*"
+            i += 2
+
+        elif pattern[i] == "*":
+
+            regex += "[^/]*"
+            i += 1
+
+        elif pattern[i] == "?":
+
+            regex += "[^/]"
+            i += 1
+
+        elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+
+            end = pattern.index("]", i + 2)
+            content = pattern[i + 1:end]
+
+            if content.startswith("!"):
+
+                content = "^" + content[1:]
+
+            regex += "[" + content.replace("\\", "\\\\") + "]"
+            i = end + 1
+
+        else:
+
+            regex += re.escape(pattern[i])
+            i += 1
+
+    return regex
+
+
+class IgnoreRules(object):
+
+    """
+    Compiled ignore rules. Only one instance exists per process.
+    """
+
+    __instance = None
+
+    _initialized = False
+    _negated = None
+    _tree = None
+    _names = None
+    _dir_regexes = None
+    _file_regexes = None
+
+    def __new__(cls, *args, **kargs):
+
+        if cls.__instance is None:
+
+            cls.__instance = object.__new__(cls, *args, **kargs)
+
+        return cls.__instance
+
+    def __init__(self):
+        """
+        Class constructor that compiles the configured patterns the first time
+        the rules are used in the process.
+
+        """
+
+        if self._initialized:
+
+            return
+
+        self._initialized = True
+        self._compile(DEFAULT_PATTERNS + HooksConfig().get_ignore_patterns())
+
+    def _compile(self, patterns):
+
+        # Prefix tree: {<component>: [<children>, <file rules>, <dir rules>]}
+        self._tree = {}
+
+        # Names matched at any level: {<name>: [<file rules>, <dir rules>]}
+        self._names = {}
+
+        self._negated = []
+        dir_alternatives = []
+        file_alternatives = []
+
+        for pattern in patterns:
+
+            pattern = pattern.strip()
+
+            if not pattern or pattern.startswith("#"):
+
+                continue
+
+            index = len(self._negated)
+            negated = pattern.startswith("!")
+            pattern = pattern.lstrip("!")
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            anchored = "/" in pattern
+            pattern = pattern.lstrip("/")
+
+            if not pattern:
+
+                continue
+
+            self._negated.append(negated)
+
+            if _WILDCARDS.search(pattern):
+
+                regex = _translate(pattern)
+
+                if not anchored:
+
+                    regex = "(?:.*/)?" + regex
+
+                alternative = "(?P<r" + str(index) + ">" + regex + ")"
+                dir_alternatives.insert(0, alternative)
+
+                if not dir_only:
+
+                    file_alternatives.insert(0, alternative)
+
+            else:
+
+                if anchored:
+
+                    node = [self._tree, None, None]
+
+                    for component in pattern.split("/"):
+
+                        node = node[0].setdefault(component, [{}, [], []])
+
+                    rules = node[1:]
+
+                else:
+
+                    rules = self._names.setdefault(pattern, [[], []])
+
+                rules[1].append(index)
+
+                if not dir_only:
+
+                    rules[0].append(index)
+
+        self._dir_regexes = self._join(dir_alternatives)
+        self._file_regexes = self._join(file_alternatives)
+
+    @staticmethod
+    def _join(alternatives):
+        """
+        Returns the regular expressions joining the alternatives, the last
+        patterns first.
+
+        """
+
+        return [re.compile("(?:" +
+                           "|".join(alternatives[i:i + _MAX_GROUPS]) +
+                           ")\\Z")
+                for i in range(0, len(alternatives), _MAX_GROUPS)]
+
+    def _rule(self, path, name, node, is_dir):
+        """
+        Returns the index of the last pattern matching the path, -1 if none.
+
+        """
+
+        kind = 2 if is_dir else 1
+        rule = -1
+
+        if node is not None and node[kind]:
+
+            rule = node[kind][-1]
+
+        if name in self._names and self._names[name][kind - 1]:
+
+            rule = max(rule, self._names[name][kind - 1][-1])
+
+        for regex in self._dir_regexes if is_dir else self._file_regexes:
+
+            match = regex.match(path)
+
+            if match is not None:
+
+                return max(rule, int(match.lastgroup[1:]))
+
+        return rule
+
+    def ignored(self, path, is_dir=False):
+        """
+        Checks if the repository path (GIT separator) must not be synchronized.
+
+        """
+
+        components = path.split("/")
+        node = [self._tree]
+        prefix = None
+
+        for i, name in enumerate(components):
+
+            prefix = name if prefix is None else prefix + "/" + name
+            last = i == len(components) - 1
+
+            if node is not None:
+
+                node = node[0].get(name)
+
+            rule = self._rule(prefix, name, node, is_dir or not last)
+
+            if rule >= 0 and not self._negated[rule]:
+
+                return True
+
+            if last:
+
+                return False
+
+    def filter(self, file_status_list):
+        """
+        Yields the [<File status>, <Path to file>] elements not ignored.
+
+        """
+
+        for git_file in file_status_list:
+
+            if not self.ignored(git_file[1]):
+
+                yield git_file
@@ -0,0 +1,309 @@
+"""
+@summary: This module keeps the ledger of the synchronizations between GIT and
+ClearCase in a SQLite database inside the hooks_config directory. Every
+synchronization records its direction (git2cc for pushes, cc2git for
+cc_export.py and cc_import.py), the GIT commits, the ClearCase versions and
+the labels, so commits and versions can be traced to each other with an
+indexed lookup (see cc_ledger.py).
+
+When the ledger is enabled it also prevents loops: the hooks do not send back
+to ClearCase the commits written by the ClearCase to GIT synchronization,
+instead of comparing the committer with cc_pusher_user.
+
+"""
+
+import os
+import sys
+import threading
+import time
+
+import Log
+
+from HooksConfig import HooksConfig
+from Manifest import CHECKIN_PATTERN
+
+GIT_TO_CC = "git2cc"
+CC_TO_GIT = "cc2git"
+
+
+class Ledger(object):
+
+    """
+    Ledger of the synchronizations. Only one instance exists per process, it
+    collects the versions checked in during the push.
+    """
+
+    __instance = None
+
+    _LEDGER_FILE = "hooks_config" + os.sep + "ledger.db"
+
+    _initialized = False
+    _enabled = False
+    _db = None
+    _lock = None
+    _versions = None
+
+    def __new__(cls, *args, **kargs):
+
+        if cls.__instance is None:
+
+            cls.__instance = object.__new__(cls, *args, **kargs)
+
+        return cls.__instance
+
+    def __init__(self):
+        """
+        Class constructor that opens the ledger the first time it is used in
+        the process when it is enabled.
+
+        """
+
+        if self._initialized:
+
+            return
+
+        self._initialized = True
+        self._lock = threading.Lock()
+        self._versions = []
+        self._enabled = HooksConfig().get_ledger_enabled()
+
+        if self._enabled:
+
+            try:
+
+                self._open(os.path.abspath(self._LEDGER_FILE))
+
+            except:
+
+                Log.warning("Ledger disabled: " + str(sys.exc_info()))
+                self._enabled = False
+
+    def _open(self, ledger_file):
+        """
+        Opens (and creates if necessary) the ledger database.
+
+        """
+
+        import sqlite3
+
+        self._db = sqlite3.connect(ledger_file, timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute("CREATE TABLE IF NOT EXISTS syncs ("
+                         "id INTEGER PRIMARY KEY, "
+                         "direction TEXT, "
+                         "ref TEXT, "
+                         "old_revision TEXT, "
+                         "new_revision TEXT, "
+                         "push_id INTEGER, "
+                         "time REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS commits ("
+                         "commit_id TEXT, "
+                         "sync_id INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS commits_id "
+                         "ON commits (commit_id)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS versions ("
+                         "sync_id INTEGER, "
+                         "commit_id TEXT, "
+                         "element TEXT, "
+                         "version TEXT)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS versions_element "
+                         "ON versions (element, version)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS versions_sync "
+                         "ON versions (sync_id)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS labels ("
+                         "sync_id INTEGER, "
+                         "label TEXT)")
+
+    def is_enabled(self):
+
+        return self._enabled
+
+    def record_checkins(self, output):
+        """
+        Keeps the versions created by a cleartool command (ci, mkelem -ci)
+        until the push is recorded.
+
+        """
+
+        if not self._enabled:
+
+            return
+
+        with self._lock:
+
+            self._versions.extend((os.path.normpath(ccpath), version)
+                                  for ccpath, version
+                                  in CHECKIN_PATTERN.findall(output))
+
+    def _record(self, direction, ref, old_revision, new_revision, commits,
+                versions, labels):
+        """
+        Records one synchronization. Versions are (commit, element, version)
+        tuples, commit being None when it is not known.
+
+        """
+
+        with self._lock:
+
+            with self._db:
+
+                self._db.execute("BEGIN")
+                sync_id = self._db.execute(
+                    "INSERT INTO syncs (direction, ref, old_revision, "
+                    "new_revision, push_id, time) VALUES (?, ?, ?, ?, ?, ?)",
+                    (direction, ref, old_revision, new_revision, os.getppid(),
+                     time.time())).lastrowid
+                self._db.executemany("INSERT INTO commits (commit_id, "
+                                     "sync_id) VALUES (?, ?)",
+                                     [(c, sync_id) for c in commits])
+                self._db.executemany("INSERT INTO versions (sync_id, "
+                                     "commit_id, element, version) "
+                                     "VALUES (?, ?, ?, ?)",
+                                     [(sync_id,) + v for v in versions])
+                self._db.executemany("INSERT INTO labels (sync_id, label) "
+                                     "VALUES (?, ?)",
+                                     [(sync_id, l) for l in labels])
+
+        Log.debug(lambda: "Ledger: " + direction + " " + ref + " " +
+                  str(len(commits)) + " commits, " + str(len(versions)) +
+                  " versions")
+
+    def record_push(self, ref, old_revision, new_revision, commits, labels,
+                    views=None):
+        """
+        Records the synchronization of a push to ClearCase with the versions
+        checked in during it. When views are given, only the versions checked
+        in inside them belong to the push: other branches of the same push
+        are synchronized in other views.
+
+        """
+
+        if not self._enabled:
+
+            return
+
+        prefixes = tuple(os.path.normpath(view) + os.sep
+                         for view in views or [])
+
+        with self._lock:
+
+            versions = [(None,) + v for v in self._versions
+                        if not prefixes or v[0].startswith(prefixes)]
+            self._versions = [v for v in self._versions
+                              if prefixes and not v[0].startswith(prefixes)]
+
+        self._record(GIT_TO_CC, ref, old_revision, new_revision, commits,
+                     versions, labels)
+
+    def record_export(self, ref, old_revision, new_revision, commits):
+        """
+        Records commits written from ClearCase. Commits are (commit id,
+        [(element, version)]) tuples.
+
+        """
+
+        if not self._enabled:
+
+            return
+
+        self._record(CC_TO_GIT, ref, old_revision, new_revision,
+                     [c[0] for c in commits],
+                     [(c[0],) + v for c in commits for v in c[1]], [])
+
+    def is_from_clearcase(self, commit):
+        """
+        Returns True when the commit was written by cc_export.py or
+        cc_import.py.
+
+        """
+
+        row = self._db.execute("SELECT 1 FROM commits JOIN syncs "
+                               "ON syncs.id = commits.sync_id "
+                               "WHERE commit_id = ? AND direction = ? "
+                               "LIMIT 1", (commit, CC_TO_GIT)).fetchone()
+
+        return row is not None
+
+    def _syncs(self, where, args):
+
+        return self._db.execute("SELECT id, direction, ref, old_revision, "
+                                "new_revision, push_id, time FROM syncs "
+                                "WHERE " + where + " ORDER BY id",
+                                args).fetchall()
+
+    def find_commit(self, commit):
+        """
+        Returns the synchronizations of the commit as (sync, versions,
+        labels) tuples.
+
+        """
+
+        result = []
+
+        for sync in self._syncs("id IN (SELECT sync_id FROM commits "
+                                "WHERE commit_id = ?)", (commit,)):
+
+            versions = self._db.execute(
+                "SELECT element, version FROM versions WHERE sync_id = ? "
+                "AND (commit_id IS NULL OR commit_id = ?)",
+                (sync[0], commit)).fetchall()
+            labels = [r[0] for r in self._db.execute(
+                "SELECT label FROM labels WHERE sync_id = ?", (sync[0],))]
+
+            result.append((sync, versions, labels))
+
+        return result
+
+    def find_version(self, element, version):
+        """
+        Returns the synchronizations which created or exported the version as
+        (sync, commits) tuples.
+
+        """
+
+        result = []
+        element = os.path.normpath(element)
+
+        for sync in self._syncs("id IN (SELECT sync_id FROM versions "
+                                "WHERE element = ? AND version = ?)",
+                                (element, version)):
+
+            commits = [r[0] for r in self._db.execute(
+                "SELECT commit_id FROM versions WHERE sync_id = ? AND "
+                "element = ? AND version = ? AND commit_id IS NOT NULL",
+                (sync[0], element, version))]
+
+            if not commits:
+
+                commits = [r[0] for r in self._db.execute(
+                    "SELECT commit_id FROM commits WHERE sync_id = ?",
+                    (sync[0],))]
+
+            result.append((sync, commits))
+
+        return result
+
+
+def from_clearcase(git, revision):
+    """
+    Returns True when the revision comes from the ClearCase to GIT
+    synchronization and must not be sent back to ClearCase: it is in the
+    ledger or, when the ledger is disabled, its committer is cc_pusher_user.
+
+    """
+
+    if Ledger().is_enabled():
+
+        return Ledger().is_from_clearcase(revision)
+
+    cc_pusher_user = HooksConfig().get_cc_pusher_user()
+
+    if git.get_committer(revision) == cc_pusher_user:
+
+        Log.debug("Commiter is the Clearcase pusher: " + cc_pusher_user +
+                  ", no sync is done, it is a push from Clearcase")
+        return True
+
+    return False
@@ -3,68 +3,409 @@
 """
 @summary: This module provides logging methods.
 
+Messages can be given as a string with %-style arguments, formatted only when
+the record is written, or as a function returning the message, called only
+when its level is enabled:
+
+    Log.debug("Files: %s", files)
+    Log.debug(lambda: "Files: " + "\n".join(files))
+
+Records are written to the log file by a background thread so disk writes
+never block the hooks. Optionally (see use_collector) records are shipped
+through a unix socket to a single collector process (log_collector.py) which
+is the only writer of the log file. File records are tagged with the push id
+(pid of the git receive-pack running the hooks), the reference and the pid of
+the hook, so one push can be followed across both hooks.
+
+Handlers are created when the first message is written, so hook runs that
+exit without logging (references not synchronized) do not pay for them.
+
 """
 
+import atexit
 import logging
-import logging.handlers
+import os
+import sys
+import threading
+import types
 
 LOG_FILENAME = "/tmp/Git2CC.log"
 
+LOG_SOCKET = "/tmp/Git2CC.sock"
+
 LOG_FORMATTER = '%(asctime)s %(levelname)-8s %(message)s'
 
+FILE_FORMATTER = ('%(asctime)s %(levelname)-8s '
+                  '[%(push_id)s %(ref)s %(process)d] %(message)s')
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+CRITICAL = logging.CRITICAL
+
+
+class BackgroundHandler(logging.Handler):
+
+    """
+    Handler that queues records and writes them with the target handler in a
+    background thread.
+    """
+
+    def __init__(self, target):
+
+        import Queue
+
+        logging.Handler.__init__(self, target.level)
+
+        self._target = target
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._work,
+                                        name="Git2CC-log")
+        self._thread.daemon = True
+        self._thread.start()
+
+        # Pending records are written before the interpreter exits
+        atexit.register(self.close)
+
+    def setLevel(self, level):
+
+        logging.Handler.setLevel(self, level)
+        self._target.setLevel(level)
+
+    def emit(self, record):
+
+        try:
+
+            # Arguments and tracebacks are resolved in the calling thread
+            record.msg = record.getMessage()
+            record.args = None
+
+            if record.exc_info:
+
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+                record.exc_info = None
+
+            self._queue.put_nowait(record)
+
+        except:
+
+            self.handleError(record)
+
+    def _work(self):
+
+        while True:
+
+            record = self._queue.get()
+
+            if record is None:
+
+                return
+
+            self._target.handle(record)
+
+    def close(self):
+
+        if self._thread is not None:
+
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._target.close()
+
+        logging.Handler.close(self)
+
+
+class ContextFilter(logging.Filter):
+
+    """
+    Adds the push id and the reference being updated to every record.
+    """
+
+    push_id = str(os.getppid())
+    ref = "-"
+
+    def filter(self, record):
+
+        record.push_id = self.push_id
+        record.ref = self.ref
+
+        return True
+
+
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
-# define a Handler which writes INFO messages or higher to the sys.stderr
-handler = logging.StreamHandler()
-handler.setLevel(logging.INFO)
-formatter = logging.Formatter(LOG_FORMATTER)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+context = ContextFilter()
+
+# Created by _setup when the first message is written
+console_handler = None
+file_handler = None
 
-# create error file handler and set level to error
+# Levels of the handlers (see configure) and collector socket (see
+# use_collector) applied by _setup
+_levels = (logging.INFO, logging.DEBUG)
+_collector = None
 
-handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=1000000, backupCount=5)
-handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter(LOG_FORMATTER)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+_setup_lock = threading.Lock()
 
-def debug (comment):
+
+def _setup():
     """
-    Logs a debug trace.
+    Creates the console and file handlers.
 
     """
-    logger.debug(comment)
 
+    global console_handler, file_handler
+
+    fallback = False
+
+    with _setup_lock:
+
+        if console_handler is not None:
+
+            return
+
+        import logging.handlers
+
+        # define a Handler which writes INFO messages or higher to the sys.stderr
+        handler = logging.StreamHandler()
+        handler.setLevel(_levels[0])
+        formatter = logging.Formatter(LOG_FORMATTER)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+        console_handler = handler
+
+        handler = None
+
+        if _collector is not None:
+
+            handler = _collector_handler(_collector)
+            fallback = handler is None
 
-def error (comment):
+        if handler is None:
+
+            handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=1000000, backupCount=5)
+            formatter = logging.Formatter(FILE_FORMATTER)
+            handler.setFormatter(formatter)
+
+        handler.setLevel(_levels[1])
+        handler = BackgroundHandler(handler)
+        handler.addFilter(context)
+        logger.addHandler(handler)
+
+        file_handler = handler
+
+    if fallback:
+
+        warning("Log collector not available in %s, using %s", _collector,
+                LOG_FILENAME)
+
+
+def set_context(ref=None, push_id=None):
+    """
+    Sets the reference and push id written with every file record.
+
+    """
+
+    if ref is not None:
+
+        ContextFilter.ref = ref
+
+    if push_id is not None:
+
+        ContextFilter.push_id = push_id
+
+
+def _collector_available(socket_path):
+
+    import socket
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+
+        s.connect(socket_path)
+
+    except socket.error:
+
+        return False
+
+    finally:
+
+        s.close()
+
+    return True
+
+
+def _start_collector(socket_path):
+    """
+    Starts a detached log collector and waits a moment until it listens.
+
+    """
+
+    import subprocess
+    import time
+
+    location = os.path.dirname(os.path.abspath(__file__))
+
+    if os.path.isfile(location):
+
+        # Running from the bundle built by install.py
+        command = [sys.executable, location, "log_collector"]
+
+    else:
+
+        command = [sys.executable, os.path.join(location, "log_collector.py")]
+
+    with open(os.devnull, "r+") as devnull:
+
+        subprocess.Popen(command + [socket_path, LOG_FILENAME],
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid)
+
+    for i in range(20):
+
+        if _collector_available(socket_path):
+
+            return True
+
+        time.sleep(0.1)
+
+    return False
+
+
+def _collector_handler(socket_path):
+    """
+    Returns the handler sending records to the log collector listening in
+    socket_path, starting it when necessary, or None when the collector is
+    not available.
+
+    """
+
+    from log_collector import UnixSocketHandler
+
+    if not _collector_available(socket_path) and \
+            not _start_collector(socket_path):
+
+        return None
+
+    return UnixSocketHandler(socket_path)
+
+
+def use_collector(socket_path=LOG_SOCKET):
+    """
+    Ships file records to the log collector listening in socket_path. The
+    collector is contacted, and started when necessary, when the first
+    message is written. Records keep being written to the local file when the
+    collector is not available.
+
+    """
+
+    global _collector, file_handler
+
+    _collector = socket_path
+
+    if file_handler is None:
+
+        return
+
+    handler = _collector_handler(socket_path)
+
+    if handler is None:
+
+        warning("Log collector not available in %s, using %s", socket_path,
+                LOG_FILENAME)
+        return
+
+    handler.setLevel(file_handler.level)
+    handler = BackgroundHandler(handler)
+    handler.addFilter(context)
+
+    logger.removeHandler(file_handler)
+    file_handler.close()
+    logger.addHandler(handler)
+
+    file_handler = handler
+
+
+def configure(console_level, file_level):
+    """
+    Sets the levels of the console and file handlers. Messages below both
+    levels are discarded before being built.
+
+    """
+
+    global _levels
+
+    _levels = (console_level, file_level)
+
+    if console_handler is not None:
+
+        console_handler.setLevel(console_level)
+        file_handler.setLevel(file_level)
+
+    logger.setLevel(min(console_level, file_level))
+
+
+def is_enabled_for(level):
+    """
+    Returns True when messages of the given level are written somewhere.
+
+    """
+
+    return logger.isEnabledFor(level)
+
+
+def _log(level, comment, args):
+
+    if logger.isEnabledFor(level):
+
+        if console_handler is None:
+
+            _setup()
+
+        if isinstance(comment, (types.FunctionType, types.MethodType)):
+
+            comment = comment()
+
+        logger.log(level, comment, *args)
+
+
+def debug (comment, *args):
     """
     Logs a debug trace.
 
     """
-    logger.error(comment)
+    _log(logging.DEBUG, comment, args)
 
-def info (comment):
+
+def error (comment, *args):
     """
     Logs a debug trace.
 
     """
-    logger.info(comment)
+    _log(logging.ERROR, comment, args)
 
-def warning (comment):
+def info (comment, *args):
     """
     Logs a debug trace.
 
     """
-    logger.warning(comment)
+    _log(logging.INFO, comment, args)
 
-def critical (comment):
+def warning (comment, *args):
     """
     Logs a debug trace.
 
     """
-    logger.critical(comment)
+    _log(logging.WARNING, comment, args)
 
+def critical (comment, *args):
+    """
+    Logs a debug trace.
 
-    
+    """
+    _log(logging.CRITICAL, comment, args)
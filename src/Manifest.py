@@ -0,0 +1,273 @@
+"""
+@summary: This module keeps the manifest of the synchronized tree: for every
+path of the branch, its GIT blob, the ClearCase version created for it by the
+hooks and the size and modification time of the file in the view after the
+synchronization. It is stored in a SQLite database inside the hooks_config
+directory and updated by the post-receive hook with the files of every push,
+so the state of the view is known without hashing or describing it again.
+
+The manifest describes one revision. When a push does not start from it (the
+first push or pushes made while the manifest was disabled) the blobs are taken
+from the whole tree of the pushed revision, keeping the versions of the files
+whose blob did not change.
+
+"""
+
+import os
+import re
+import sys
+import threading
+
+import Log
+
+from HooksConfig import HooksConfig
+
+# Printed by cleartool ci and mkelem -ci for every version created
+CHECKIN_PATTERN = re.compile(r'Checked in "(.+)" version "(.+)"\.')
+
+
+class Manifest(object):
+
+    """
+    Persistent manifest of the synchronized tree. Only one instance exists per
+    process, it collects the versions checked in during the push.
+    """
+
+    __instance = None
+
+    _MANIFEST_FILE = "hooks_config" + os.sep + "manifest.db"
+
+    _initialized = False
+    _enabled = False
+    _db = None
+    _lock = None
+    _versions = None
+
+    def __new__(cls, *args, **kargs):
+
+        if cls.__instance is None:
+
+            cls.__instance = object.__new__(cls, *args, **kargs)
+
+        return cls.__instance
+
+    def __init__(self):
+        """
+        Class constructor that opens the manifest the first time it is used in
+        the process when it is enabled.
+
+        """
+
+        if self._initialized:
+
+            return
+
+        self._initialized = True
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._enabled = HooksConfig().get_manifest_enabled()
+
+        if self._enabled:
+
+            try:
+
+                self._open(os.path.abspath(self._MANIFEST_FILE))
+
+            except:
+
+                # A broken manifest must never stop the synchronization
+                Log.warning("Manifest disabled: " + str(sys.exc_info()))
+                self._enabled = False
+
+    def _open(self, manifest_file):
+        """
+        Opens (and creates if necessary) the manifest database.
+
+        """
+
+        import sqlite3
+
+        self._db = sqlite3.connect(manifest_file, timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute("CREATE TABLE IF NOT EXISTS files ("
+                         "path TEXT PRIMARY KEY, "
+                         "blob TEXT, "
+                         "version TEXT, "
+                         "size INTEGER, "
+                         "mtime REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS info ("
+                         "name TEXT PRIMARY KEY, "
+                         "value TEXT)")
+
+    def is_enabled(self):
+
+        return self._enabled
+
+    def record_checkins(self, output):
+        """
+        Keeps the versions created by a cleartool command (ci, mkelem -ci)
+        until the manifest is updated.
+
+        """
+
+        if not self._enabled:
+
+            return
+
+        with self._lock:
+
+            for ccpath, version in CHECKIN_PATTERN.findall(output):
+
+                self._versions[os.path.normpath(ccpath)] = version
+
+    def revision(self):
+        """
+        Returns the revision the manifest describes or None.
+
+        """
+
+        if not self._enabled:
+
+            return None
+
+        row = self._db.execute("SELECT value FROM info WHERE name = ?",
+                               ("revision",)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def files(self):
+        """
+        Returns the whole manifest as:
+
+            {<path>: (<blob id>, <version>, <size>, <mtime>)}
+
+        """
+
+        if not self._enabled:
+
+            return {}
+
+        return dict((row[0], row[1:]) for row in self._db.execute(
+            "SELECT path, blob, version, size, mtime FROM files"))
+
+    def update(self, git, shards, old_revision, new_revision,
+               file_status_list):
+        """
+        Updates the manifest to new_revision with the files of a push, once
+        they are synchronized in the views of their shards (see ShardMap).
+        When the update fails the manifest is rebuilt by the next push.
+
+        """
+
+        if not self._enabled:
+
+            return
+
+        try:
+
+            self._update(git, shards, old_revision, new_revision,
+                         file_status_list)
+
+        except:
+
+            # A broken manifest must never stop the synchronization
+            Log.warning("Manifest not updated: " + str(sys.exc_info()))
+
+            with self._lock:
+
+                self._versions = {}
+
+                try:
+
+                    self._db.execute("DELETE FROM info WHERE name = ?",
+                                     ("revision",))
+
+                except:
+
+                    Log.warning("Manifest revision not cleared: " +
+                                str(sys.exc_info()))
+
+    def _update(self, git, shards, old_revision, new_revision,
+                file_status_list):
+
+        full = self.revision() != old_revision
+
+        if full:
+
+            Log.debug("Manifest rebuilt from the tree of " + new_revision)
+
+            entries = git.list_tree(new_revision)
+            deleted = []
+
+        else:
+
+            entries = git.tree_entries(new_revision,
+                                       [f[1] for f in file_status_list
+                                        if f[0] != "D"])
+            deleted = [f[1] for f in file_status_list if f[0] == "D"]
+
+        with self._lock:
+
+            known = {}
+
+            if full:
+
+                known = dict((row[0], row[1:]) for row in self._db.execute(
+                    "SELECT path, blob, version FROM files"))
+
+            rows = []
+
+            for path, entry in entries.items():
+
+                blob = entry[1]
+                ccpath = os.path.join(
+                    os.path.normpath(shards.shard_of(path).view), path)
+                version = self._versions.get(ccpath)
+
+                if version is None:
+
+                    if not full:
+
+                        known[path] = self._db.execute(
+                            "SELECT blob, version FROM files WHERE path = ?",
+                            (path,)).fetchone()
+
+                    # Unchanged files keep their version
+                    if known.get(path) is not None and known[path][0] == blob:
+
+                        version = known[path][1]
+
+                try:
+
+                    st = os.lstat(ccpath)
+                    size, mtime = st.st_size, st.st_mtime
+
+                except OSError:
+
+                    size, mtime = None, None
+
+                rows.append((path, blob, version, size, mtime))
+
+            with self._db:
+
+                self._db.execute("BEGIN")
+
+                if full:
+
+                    self._db.execute("DELETE FROM files")
+
+                self._db.executemany("DELETE FROM files WHERE path = ?",
+                                     [(path,) for path in deleted])
+                self._db.executemany("INSERT OR REPLACE INTO files "
+                                     "(path, blob, version, size, mtime) "
+                                     "VALUES (?, ?, ?, ?, ?)", rows)
+                self._db.execute("INSERT OR REPLACE INTO info (name, value) "
+                                 "VALUES (?, ?)", ("revision", new_revision))
+
+            self._versions = {}
+
+        Log.debug(lambda: "Manifest updated to " + new_revision + ": " +
+                  str(len(rows)) + " files written, " + str(len(deleted)) +
+                  " removed")
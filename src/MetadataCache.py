@@ -0,0 +1,323 @@
+"""
+@summary: This module keeps a persistent cache of ClearCase element metadata
+shared by every hook invocation. Facts about elements (selected version,
+LATEST version, versioned flag) and known label types are stored in a SQLite
+database inside the hooks_config directory of the bare repository.
+
+Entries are invalidated when the hooks operate on an element and expire after
+a configurable TTL to catch changes made by other ClearCase users.
+
+Facts are also kept in memory for the current process, even when the
+persistent cache is disabled, so ClearCase state resolved concurrently before
+the synchronization (see ClearCase.prefetch_states) is reused by it. The
+checkout state is only kept in memory: the view lock guarantees no other push
+changes it during the current one.
+
+"""
+
+import os
+import sys
+import threading
+import time
+
+import Log
+
+from HooksConfig import HooksConfig
+from Metrics import Metrics
+
+
+class MetadataCache(object):
+
+    """
+    Persistent ClearCase metadata cache. Only one instance exists per process
+    so hit and miss counters cover the whole push.
+    """
+
+    __instance = None
+
+    _CACHE_FILE = "hooks_config" + os.sep + "cc_metadata.db"
+
+    # Element facts stored in the database, the rest live only in memory
+    _PERSISTENT_COLUMNS = ("version", "latest", "versioned")
+
+    _initialized = False
+    _enabled = False
+    _ttl = 0
+    _db = None
+    _lock = None
+    _memory = None
+    _hits = 0
+    _misses = 0
+
+    def __new__(cls, *args, **kargs):
+
+        if cls.__instance is None:
+
+            cls.__instance = object.__new__(cls, *args, **kargs)
+
+        return cls.__instance
+
+    def __init__(self):
+        """
+        Class constructor that reads the cache configuration and opens the
+        database the first time the cache is used in the process.
+
+        """
+
+        if self._initialized:
+
+            return
+
+        self._initialized = True
+        self._lock = threading.RLock()
+        self._memory = {}
+
+        config = HooksConfig()
+        self._enabled = config.get_cache_enabled()
+        self._ttl = config.get_cache_ttl()
+
+        if self._enabled:
+
+            try:
+
+                self._open(os.path.abspath(self._CACHE_FILE))
+
+            except:
+
+                # A broken cache must never stop the synchronization
+                Log.warning("ClearCase metadata cache disabled: " +
+                            str(sys.exc_info()))
+                self._enabled = False
+
+    def _open(self, cache_file):
+        """
+        Opens (and creates if necessary) the cache database.
+
+        """
+
+        import sqlite3
+
+        self._db = sqlite3.connect(cache_file, timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute("CREATE TABLE IF NOT EXISTS elements ("
+                         "path TEXT PRIMARY KEY, "
+                         "version TEXT, "
+                         "latest TEXT, "
+                         "versioned INTEGER, "
+                         "updated REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS label_types ("
+                         "path TEXT, "
+                         "label TEXT, "
+                         "updated REAL, "
+                         "PRIMARY KEY (path, label))")
+
+    def _count(self, found):
+
+        if found:
+
+            self._hits += 1
+
+        else:
+
+            self._misses += 1
+
+        Metrics().inc("git2cc_cache_requests_total",
+                      result="hit" if found else "miss")
+
+    def _get(self, ccpath, column):
+        """
+        Returns the cached value of column for the given element or None when
+        the element is unknown, the value was never stored or it is expired.
+
+        """
+
+        path = os.path.normpath(ccpath)
+
+        with self._lock:
+
+            value = self._memory.get(path, {}).get(column)
+
+            if (value is None and self._enabled and
+                    column in self._PERSISTENT_COLUMNS):
+
+                row = self._db.execute("SELECT " + column + ", updated "
+                                       "FROM elements WHERE path = ?",
+                                       (path,)).fetchone()
+
+                if row is not None and time.time() - row[1] < self._ttl:
+
+                    value = row[0]
+
+                    if value is not None:
+
+                        self._memory.setdefault(path, {})[column] = value
+
+            self._count(value is not None)
+
+        return value
+
+    def _set(self, ccpath, column, value):
+        """
+        Stores one value of the given element.
+
+        """
+
+        path = os.path.normpath(ccpath)
+
+        with self._lock:
+
+            self._memory.setdefault(path, {})[column] = value
+
+            if self._enabled and column in self._PERSISTENT_COLUMNS:
+
+                self._db.execute("INSERT OR IGNORE INTO elements "
+                                 "(path, updated) VALUES (?, ?)",
+                                 (path, time.time()))
+                self._db.execute("UPDATE elements SET " + column + " = ?, "
+                                 "updated = ? WHERE path = ?",
+                                 (value, time.time(), path))
+
+    def get_versioned(self, ccpath):
+        """
+        Returns True or False when the versioned flag is cached, None
+        otherwise.
+
+        """
+
+        value = self._get(ccpath, "versioned")
+
+        if value is not None:
+
+            value = value == 1
+
+        return value
+
+    def set_versioned(self, ccpath, versioned):
+
+        self._set(ccpath, "versioned", 1 if versioned else 0)
+
+    def get_checkout(self, ccpath):
+        """
+        Returns True or False when the checkout state of the element is known
+        in this process, None otherwise.
+
+        """
+
+        value = self._get(ccpath, "checkout")
+
+        if value is not None:
+
+            value = value == 1
+
+        return value
+
+    def set_checkout(self, ccpath, checkout):
+
+        self._set(ccpath, "checkout", 1 if checkout else 0)
+
+    def get_versions(self, ccpath):
+        """
+        Returns the cached (selected version, LATEST version) tuple of the
+        element or None.
+
+        """
+
+        version = self._get(ccpath, "version")
+
+        if version is None:
+
+            return None
+
+        latest = self._get(ccpath, "latest")
+
+        if latest is None:
+
+            return None
+
+        return (version, latest)
+
+    def set_versions(self, ccpath, version, latest):
+
+        self._set(ccpath, "version", version)
+        self._set(ccpath, "latest", latest)
+
+    def has_label_type(self, ccpath, label):
+        """
+        Returns True when the label type is known to exist from the given
+        path, None when it is unknown.
+
+        """
+
+        path = os.path.normpath(ccpath)
+
+        with self._lock:
+
+            found = label in self._memory.get(path, {}).get("label_types", ())
+
+            if not found and self._enabled:
+
+                row = self._db.execute("SELECT updated FROM label_types "
+                                       "WHERE path = ? AND label = ?",
+                                       (path, label)).fetchone()
+
+                found = row is not None and time.time() - row[0] < self._ttl
+
+            self._count(found)
+
+        return True if found else None
+
+    def add_label_type(self, ccpath, label):
+
+        path = os.path.normpath(ccpath)
+
+        with self._lock:
+
+            self._memory.setdefault(path, {}).setdefault("label_types",
+                                                         set()).add(label)
+
+            if self._enabled:
+
+                self._db.execute("INSERT OR REPLACE INTO label_types "
+                                 "(path, label, updated) VALUES (?, ?, ?)",
+                                 (path, label, time.time()))
+
+    def invalidate(self, ccpath):
+        """
+        Forgets everything known about the given element. Must be called after
+        any operation that changes the element.
+
+        """
+
+        path = os.path.normpath(ccpath)
+
+        with self._lock:
+
+            entry = self._memory.pop(path, None)
+
+            # Label types belong to the VOB, not to the element
+            if entry is not None and "label_types" in entry:
+
+                self._memory[path] = {"label_types": entry["label_types"]}
+
+            if self._enabled:
+
+                self._db.execute("DELETE FROM elements WHERE path = ?",
+                                 (path,))
+
+    def log_statistics(self):
+        """
+        Logs the hit and miss counters of the current process.
+
+        """
+
+        total = self._hits + self._misses
+        ratio = 0.0
+
+        if total > 0:
+
+            ratio = 100.0 * self._hits / total
+
+        Log.info("ClearCase metadata cache: " + str(self._hits) + " hits, " +
+                 str(self._misses) + " misses (" + "%.1f" % ratio + "%)")
@@ -0,0 +1,349 @@
+"""
+@summary: This module keeps the operational metrics of the hooks (counters and
+histograms) and exports them in the Prometheus text format to the textfile
+directory of the node exporter.
+
+Every hook process accumulates its own values and, when it exits, adds them to
+the cumulative values stored in the textfile directory (git2cc.state.json) and
+rewrites git2cc.prom atomically. Both files are updated under flock so
+concurrent hooks do not lose values.
+
+"""
+
+import atexit
+import fcntl
+import os
+import sys
+import threading
+
+import Log
+
+from HooksConfig import HooksConfig
+
+# Histogram buckets
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300,
+                   900, 3600)
+FILES_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+# name: (type, help, buckets)
+DEFINITIONS = {
+    "git2cc_pushes_total":
+        ("counter", "Pushes synchronized by the hooks by result.", None),
+    "git2cc_push_files":
+        ("histogram", "Files per push by git status.", FILES_BUCKETS),
+    "git2cc_command_duration_seconds":
+        ("histogram", "Duration of git and cleartool commands.",
+         SECONDS_BUCKETS),
+    "git2cc_lock_wait_seconds":
+        ("histogram", "Time waiting for the ClearCase view lock.",
+         SECONDS_BUCKETS),
+    "git2cc_cache_requests_total":
+        ("counter", "ClearCase metadata cache lookups by result.", None),
+    "git2cc_rollbacks_total":
+        ("counter", "Synchronizations undone with uncheckout_all.", None),
+    "git2cc_exported_commits_total":
+        ("counter", "Commits exported from ClearCase to GIT.", None),
+    "git2cc_sync_duration_seconds":
+        ("histogram", "Duration of the synchronization by hook.",
+         SECONDS_BUCKETS),
+}
+
+
+class Metrics(object):
+
+    """
+    Metrics registry of the process. Only one instance exists per process.
+    """
+
+    __instance = None
+
+    _STATE_FILE = "git2cc.state.json"
+    _PROM_FILE = "git2cc.prom"
+    _LOCK_FILE = "git2cc.lock"
+
+    _initialized = False
+
+    def __new__(cls, *args, **kargs):
+
+        if cls.__instance is None:
+
+            cls.__instance = object.__new__(cls, *args, **kargs)
+
+        return cls.__instance
+
+    def __init__(self):
+        """
+        Class constructor that reads the textfile directory from the
+        configuration. Metrics are only exported when it is configured.
+
+        """
+
+        if self._initialized:
+
+            return
+
+        self._initialized = True
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._history = None
+        self._directory = None
+
+        try:
+
+            self._directory = HooksConfig().get_metrics_dir()
+
+        except:
+
+            Log.debug("Metrics not exported: " + str(sys.exc_info()[1]))
+
+        if self._directory is not None:
+
+            atexit.register(self.export)
+
+    @staticmethod
+    def _key(name, labels):
+        """
+        Returns the Prometheus series name: name{label="value",...}
+
+        """
+
+        if not labels:
+
+            return name
+
+        return name + "{" + ",".join('%s="%s"' % (k, labels[k])
+                                     for k in sorted(labels)) + "}"
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increments a counter.
+
+        """
+
+        key = self._key(name, labels)
+
+        with self._lock:
+
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Adds one observation to a histogram.
+
+        """
+
+        key = self._key(name, labels)
+        buckets = DEFINITIONS[name][2]
+
+        with self._lock:
+
+            histogram = self._histograms.setdefault(
+                key, {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0})
+
+            for i, bound in enumerate(buckets):
+
+                if value <= bound:
+
+                    histogram["buckets"][i] += 1
+
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def record_push(self, hook, result, duration):
+        """
+        Records the result (synced, deferred, rejected or failed) and the
+        duration of the synchronization made by one hook.
+
+        """
+
+        self.inc("git2cc_pushes_total", hook=hook, result=result)
+        self.observe("git2cc_sync_duration_seconds", duration, hook=hook)
+
+    def mean(self, name, min_count=1, **labels):
+        """
+        Returns the mean of the observations of a histogram recorded by every
+        previous hook (the cumulative state of the textfile directory), or
+        None when it has less than min_count observations.
+
+        """
+
+        if self._history is None:
+
+            self._history = self._load().get("histograms", {})
+
+        histogram = self._history.get(self._key(name, labels))
+
+        if histogram is None or histogram["count"] < max(1, min_count):
+
+            return None
+
+        return histogram["sum"] / histogram["count"]
+
+    def _load(self):
+        """
+        Returns the cumulative state of the textfile directory. It is replaced
+        atomically, so it is read without the lock.
+
+        """
+
+        if self._directory is None:
+
+            return {}
+
+        import json
+
+        state_file = os.path.join(self._directory, self._STATE_FILE)
+
+        try:
+
+            if os.path.isfile(state_file):
+
+                with open(state_file) as f:
+
+                    return json.load(f)
+
+        except (IOError, ValueError):
+
+            Log.warning("Metrics state not read: " + str(sys.exc_info()[1]))
+
+        return {}
+
+    def _merge(self, state):
+        """
+        Adds the values of this process to the cumulative state.
+
+        """
+
+        counters = state.setdefault("counters", {})
+        histograms = state.setdefault("histograms", {})
+
+        for key, value in self._counters.items():
+
+            counters[key] = counters.get(key, 0) + value
+
+        for key, histogram in self._histograms.items():
+
+            total = histograms.setdefault(
+                key, {"buckets": [0] * len(histogram["buckets"]),
+                      "sum": 0.0, "count": 0})
+
+            total["buckets"] = [a + b for a, b in zip(total["buckets"],
+                                                      histogram["buckets"])]
+            total["sum"] += histogram["sum"]
+            total["count"] += histogram["count"]
+
+        self._counters = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _split_key(key):
+
+        name, brace, labels = key.partition("{")
+
+        return name, labels.rstrip("}")
+
+    @staticmethod
+    def _render(state):
+        """
+        Returns the cumulative state in the Prometheus text format.
+
+        """
+
+        series = {}
+
+        for key, value in sorted(state.get("counters", {}).items()):
+
+            name, labels = Metrics._split_key(key)
+            series.setdefault(name, []).append("%s %s" % (key, value))
+
+        for key, histogram in sorted(state.get("histograms", {}).items()):
+
+            name, labels = Metrics._split_key(key)
+            prefix = labels + "," if labels else ""
+            lines = series.setdefault(name, [])
+
+            for bound, count in zip(DEFINITIONS[name][2],
+                                    histogram["buckets"]):
+
+                lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, bound,
+                                                          count))
+
+            lines.append('%s_bucket{%sle="+Inf"} %d' % (name, prefix,
+                                                        histogram["count"]))
+
+            suffix = "{" + labels + "}" if labels else ""
+            lines.append("%s_sum%s %f" % (name, suffix, histogram["sum"]))
+            lines.append("%s_count%s %d" % (name, suffix, histogram["count"]))
+
+        text = []
+
+        for name in sorted(series):
+
+            text.append("# HELP %s %s" % (name, DEFINITIONS[name][1]))
+            text.append("# TYPE %s %s" % (name, DEFINITIONS[name][0]))
+            text.extend(series[name])
+
+        return "\n".join(text) + "\n"
+
+    def _write(self, filename, content):
+        """
+        Replaces a file of the textfile directory atomically.
+
+        """
+
+        path = os.path.join(self._directory, filename)
+        tmp = path + "." + str(os.getpid()) + ".tmp"
+
+        with open(tmp, "w") as f:
+
+            f.write(content)
+
+        os.rename(tmp, path)
+
+    def export(self):
+        """
+        Adds the values of this process to the cumulative ones and rewrites
+        the Prometheus textfile.
+
+        """
+
+        if self._directory is None:
+
+            return
+
+        import json
+
+        try:
+
+            with self._lock:
+
+                lock = open(os.path.join(self._directory, self._LOCK_FILE),
+                            "a")
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+                try:
+
+                    state = {}
+                    state_file = os.path.join(self._directory,
+                                              self._STATE_FILE)
+
+                    if os.path.isfile(state_file):
+
+                        with open(state_file) as f:
+
+                            state = json.load(f)
+
+                    self._merge(state)
+                    self._write(self._STATE_FILE, json.dumps(state))
+                    self._write(self._PROM_FILE, self._render(state))
+
+                finally:
+
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                    lock.close()
+
+        except:
+
+            # Metrics must never break a push
+            Log.warning("Metrics export failed: " + str(sys.exc_info()[1]))
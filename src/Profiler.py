@@ -0,0 +1,137 @@
+"""
+@summary: This module runs the main function of a hook under cProfile when
+profiling is enabled in the [profile] section of the configuration or with the
+GIT2CC_PROFILE environment variable (1/true/yes enables it, 0/false/no
+disables it whatever the configuration says).
+
+The profile of every push is saved as <directory>/<hook>-<push id>-<time>.prof
+(readable with pstats or snakeviz) and a summary of the top functions by
+cumulative time is written in the log at debug level. Pushes with less files
+than min_files are not saved, so profiling can be left enabled waiting for a
+slow big push.
+
+@note: cProfile only sees the main thread. Work done by the command engine
+workers shows up as time waiting for their results.
+
+"""
+
+import os
+import sys
+import time
+
+import Log
+
+from HooksConfig import HooksConfig
+
+ENVIRONMENT_VARIABLE = "GIT2CC_PROFILE"
+
+# Files of the push being profiled, see record_files
+_push_files = None
+
+
+def record_files(count):
+    """
+    Records the number of files of the push, compared with min_files before
+    saving the profile.
+
+    """
+
+    global _push_files
+
+    _push_files = count
+
+
+def _enabled(config):
+
+    value = os.environ.get(ENVIRONMENT_VARIABLE, "").strip().lower()
+
+    if value in ("1", "true", "yes", "on"):
+
+        return True
+
+    if value in ("0", "false", "no", "off"):
+
+        return False
+
+    return config.get_profile_enabled()
+
+
+def _save(profile, hook, config):
+    """
+    Saves the profile and logs its summary when the push is big enough.
+
+    """
+
+    import pstats
+    import StringIO
+
+    min_files = config.get_profile_min_files()
+
+    if min_files > 0 and (_push_files is None or _push_files < min_files):
+
+        Log.debug("Profile discarded: push below " + str(min_files) +
+                  " files")
+        return
+
+    directory = config.get_profile_dir()
+
+    if not os.path.isdir(directory):
+
+        os.makedirs(directory)
+
+    filename = os.path.join(directory, "%s-%d-%s.prof" % (
+        hook, os.getppid(), time.strftime("%Y%m%d%H%M%S")))
+
+    profile.dump_stats(filename)
+
+    summary = StringIO.StringIO()
+    stats = pstats.Stats(profile, stream=summary)
+    stats.sort_stats("cumulative").print_stats(config.get_profile_top())
+
+    Log.debug("Profile of " + hook + " saved in " + filename)
+    Log.debug(lambda: "Profile summary of " + hook + ":\n" +
+              summary.getvalue())
+
+
+def run(hook, main):
+    """
+    Runs main, under the profiler when profiling is enabled.
+
+    """
+
+    try:
+
+        config = HooksConfig()
+        enabled = _enabled(config)
+
+    except:
+
+        # Configuration errors are reported by the hook itself
+        enabled = False
+
+    if not enabled:
+
+        return main()
+
+    import cProfile
+
+    profile = cProfile.Profile()
+    profile.enable()
+
+    try:
+
+        return main()
+
+    finally:
+
+        profile.disable()
+
+        try:
+
+            _save(profile, hook, config)
+
+        except:
+
+            # Profiling must never break a push
+            Log.warning("Profile of " + hook + " not saved: " +
+                        str(sys.exc_info()[1]))
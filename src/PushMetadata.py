@@ -0,0 +1,50 @@
+"""
+@summary: This module holds the information shared by every file of one push:
+committer, ClearCase labels requested in the commit messages and the checkout
+comment. It is computed once per push instead of once per file.
+
+Labels are requested writing @LABEL_NAME (capital letters, digits and
+underscores) anywhere in a commit message.
+
+"""
+
+import os
+import re
+
+LABEL_PATTERN = re.compile('@([A-Z_0-9]+)')
+
+# Written after the committer in the comment of every checkout made by the
+# hooks, so ClearCase versions coming from GIT can be recognized
+PUSH_COMMENT_MARK = ".GIT push:"
+
+
+class PushMetadata(object):
+
+    """
+    Push level data used by all the per file ClearCase operations.
+    """
+
+    def __init__(self, committer, comments):
+        """
+        Class constructor that parses the comments of the push commits in
+        chronological order.
+
+        """
+
+        self.committer = committer
+        self.comments = comments
+        self.labels = []
+
+        co_comment = committer + PUSH_COMMENT_MARK + os.linesep
+
+        for comment in comments:
+
+            for label in LABEL_PATTERN.findall(comment):
+
+                if label not in self.labels:
+
+                    self.labels.append(label)
+
+            co_comment += LABEL_PATTERN.sub("", comment) + os.linesep
+
+        self.checkout_comment = co_comment
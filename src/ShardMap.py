@@ -0,0 +1,178 @@
+"""
+@summary: This module splits the synchronized tree among several ClearCase
+snapshot views, the shards. Every [shard:<name>] section of the configuration
+gives the path prefixes of the repository (usually VOBs) synchronized in its
+own snapshot view, which may be on another disk. Paths of no shard are
+synchronized in the [cc_view] view.
+
+A push is split by shard and only the views of the shards it touches are
+locked. Every shard is synchronized in its own thread with its own ClearCase
+object and view lock, so pushes to different shards do not wait on each
+other.
+
+Branches with their own view ([branch:<name>] sections) are not split: the
+view of the branch is their only shard.
+
+"""
+
+import sys
+
+from ClearCase import ClearCase
+from HooksConfig import HooksConfig
+from ViewLock import ViewLock
+
+DEFAULT_SHARD = "default"
+
+
+class Shard(object):
+
+    """
+    One snapshot view and the path prefixes synchronized in it.
+    """
+
+    def __init__(self, shards, name, view, prefixes, vobs, cc_branch=None):
+
+        self._shards = shards
+        self.name = name
+        self.view = view
+        self.prefixes = prefixes
+        self.cc_branch = cc_branch
+        self.cc = ClearCase(view, vobs)
+        self.lock = ViewLock(view)
+
+    def owns(self, path):
+        """
+        Checks if the given repository path is synchronized in this shard.
+
+        """
+
+        return self._shards.shard_of(path) is self
+
+
+class ShardMap(object):
+
+    """
+    Shards of the synchronized tree read from the configuration.
+    """
+
+    def __init__(self, branch=None):
+        """
+        Class constructor. The [cc_view] view is always the last shard. A
+        branch with its own view ([branch:<branch>] section) has only that
+        view as shard.
+
+        Raises ConfigException when a shard is not valid.
+
+        """
+
+        config = HooksConfig()
+        mapping = None
+
+        if branch is not None:
+
+            mapping = config.get_branch_mapping(branch)
+
+        self.mapped = mapping is not None
+
+        if self.mapped:
+
+            view, vobs, cc_branch = mapping
+            self.shards = [Shard(self, branch, view, [""], vobs, cc_branch)]
+            self._prefixes = []
+
+            return
+
+        self.shards = [Shard(self, name, view, prefixes, vobs)
+                       for name, view, prefixes, vobs in config.get_shards()]
+        self.shards.append(Shard(self, DEFAULT_SHARD, config.get_view(), [""],
+                                 config.get_vobs()))
+
+        # Longest prefixes first
+        self._prefixes = sorted([(prefix, shard) for shard in self.shards[:-1]
+                                 for prefix in shard.prefixes],
+                                key=lambda entry: len(entry[0]), reverse=True)
+
+    def is_sharded(self):
+
+        return len(self.shards) > 1
+
+    def shard_of(self, path):
+        """
+        Returns the shard of a repository path: the one with the longest
+        prefix of the path or the [cc_view] one.
+
+        """
+
+        for prefix, shard in self._prefixes:
+
+            if path == prefix or path.startswith(prefix + "/"):
+
+                return shard
+
+        return self.shards[-1]
+
+    def touched(self, file_status_list):
+        """
+        Returns the shards changed by the given files in lock order. Without
+        shards the [cc_view] view is always returned.
+
+        """
+
+        if not self.is_sharded():
+
+            return list(self.shards)
+
+        touched = set(self.shard_of(git_file[1])
+                      for git_file in file_status_list)
+
+        return sorted(touched, key=lambda shard: shard.view)
+
+    def split(self, file_status_list):
+        """
+        Returns the [<shard>, <files of the shard>] pairs of the shards
+        changed by the given files.
+
+        """
+
+        shards = self.touched(file_status_list)
+        files = dict((shard, []) for shard in shards)
+
+        for git_file in file_status_list:
+
+            files[self.shard_of(git_file[1])].append(git_file)
+
+        return [[shard, files[shard]] for shard in shards]
+
+    @staticmethod
+    def acquire(shards, timeout):
+        """
+        Takes the view lock of every given shard, always in the same order so
+        pushes touching several shards cannot block each other. Locks already
+        taken are released when one fails.
+
+        Raises ViewLockError exception when the timeout expires.
+
+        """
+
+        acquired = []
+
+        try:
+
+            for shard in shards:
+
+                shard.lock.acquire(timeout)
+                acquired.append(shard)
+
+        except:
+
+            exc_info = sys.exc_info()
+            ShardMap.release(acquired)
+
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    @staticmethod
+    def release(shards):
+
+        for shard in shards:
+
+            shard.lock.release()
@@ -0,0 +1,271 @@
+"""
+@summary: This module serializes the pushes working on the same ClearCase
+snapshot view. Waiting pushes are queued in arrival order (FIFO) so every
+push gets the view in turn instead of failing on concurrent checkouts.
+
+The queue lives in the view GIT directory (.git/git2cc-lock). Every waiting
+or running push owns one ticket file named <sequence>-<owner pid>. The owner is
+the git receive-pack process running the hooks, so the ticket taken by the
+update hook is kept until the post-receive hook of the same push releases it.
+Tickets of dead owners are discarded. Queue operations are made atomic with
+flock.
+
+"""
+
+import errno
+import fcntl
+import os
+import time
+
+import Log
+
+from Metrics import Metrics
+
+class ViewLockError(Exception):
+
+    """
+    Exception class to represent errors occurred while waiting for the view
+    lock.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def alive(pid):
+    """
+    Checks if the given process is still running
+
+    """
+
+    try:
+
+        os.kill(pid, 0)
+
+    except OSError as e:
+
+        return e.errno == errno.EPERM
+
+    return True
+
+
+class ViewLock(object):
+
+    """
+    FIFO lock of one ClearCase snapshot view shared by every hook process.
+    """
+
+    _POLL_INTERVAL = 0.5
+
+    def __init__(self, view_path, owner=None):
+        """
+        Class constructor. By default the lock owner is the parent process,
+        which is the git receive-pack running both hooks of the push.
+
+        """
+
+        self._path = os.path.join(view_path, ".git", "git2cc-lock")
+        self._owner = owner if owner is not None else os.getppid()
+        self._ticket = None
+
+    def _lock_queue(self):
+
+        queue_lock = open(os.path.join(self._path, "queue.lock"), "a")
+        fcntl.flock(queue_lock, fcntl.LOCK_EX)
+
+        return queue_lock
+
+    def _unlock_queue(self, queue_lock):
+
+        fcntl.flock(queue_lock, fcntl.LOCK_UN)
+        queue_lock.close()
+
+    def _live_tickets(self):
+        """
+        Returns the sorted list of tickets whose owner is alive, removing the
+        tickets of dead owners. Must be called with the queue locked.
+
+        """
+
+        tickets = []
+
+        for name in os.listdir(self._path):
+
+            if not name.endswith(".ticket"):
+
+                continue
+
+            owner = int(name[:-len(".ticket")].split('-')[1])
+
+            if alive(owner):
+
+                tickets.append(name)
+
+            else:
+
+                Log.warning("Removing stale view lock ticket " + name)
+                os.remove(os.path.join(self._path, name))
+
+        tickets.sort()
+
+        return tickets
+
+    def _own_ticket(self, tickets):
+
+        for ticket in tickets:
+
+            if ticket.endswith("-" + str(self._owner) + ".ticket"):
+
+                return ticket
+
+        return None
+
+    def _take_ticket(self):
+        """
+        Returns the ticket of the owner, creating a new one at the end of the
+        queue when the owner has none.
+
+        """
+
+        queue_lock = self._lock_queue()
+
+        try:
+
+            tickets = self._live_tickets()
+            ticket = self._own_ticket(tickets)
+
+            if ticket is None:
+
+                sequence = 0
+
+                if tickets:
+
+                    sequence = int(tickets[-1].split('-')[0]) + 1
+
+                ticket = "%012d-%d.ticket" % (sequence, self._owner)
+                open(os.path.join(self._path, ticket), "w").close()
+
+        finally:
+
+            self._unlock_queue(queue_lock)
+
+        return ticket
+
+    def _position(self):
+        """
+        Returns the number of live tickets ahead of ours.
+
+        """
+
+        queue_lock = self._lock_queue()
+
+        try:
+
+            tickets = self._live_tickets()
+
+            if self._ticket not in tickets:
+
+                raise ViewLockError("View lock ticket lost: " + self._ticket)
+
+            position = tickets.index(self._ticket)
+
+        finally:
+
+            self._unlock_queue(queue_lock)
+
+        return position
+
+    def acquire(self, timeout):
+        """
+        Waits until every push queued before this one has finished. Returns
+        the seconds spent waiting.
+
+        Raises ViewLockError exception when the timeout expires.
+
+        """
+
+        start = time.time()
+
+        if not os.path.isdir(self._path):
+
+            try:
+
+                os.makedirs(self._path)
+
+            except OSError as e:
+
+                if e.errno != errno.EEXIST:
+
+                    raise
+
+        self._ticket = self._take_ticket()
+
+        last_position = None
+
+        while True:
+
+            position = self._position()
+
+            if position == 0:
+
+                break
+
+            if position != last_position:
+
+                Log.info("Waiting for ClearCase view lock: " + str(position) +
+                         " push(es) ahead in the queue")
+                last_position = position
+
+            if time.time() - start > timeout:
+
+                self.release()
+
+                raise ViewLockError("Timeout waiting " + str(timeout) +
+                                    "s for the ClearCase view lock with " +
+                                    str(position) + " push(es) ahead")
+
+            time.sleep(self._POLL_INTERVAL)
+
+        waited = time.time() - start
+
+        Log.info("ClearCase view lock acquired in " + "%.2f" % waited + "s")
+        Metrics().observe("git2cc_lock_wait_seconds", waited)
+
+        return waited
+
+    def release(self):
+        """
+        Releases the view lock of the owner, letting the next queued push
+        start.
+
+        """
+
+        if not os.path.isdir(self._path):
+
+            return
+
+        queue_lock = self._lock_queue()
+
+        try:
+
+            ticket = self._ticket
+
+            if ticket is None:
+
+                ticket = self._own_ticket(sorted(os.listdir(self._path)))
+
+            if ticket is not None:
+
+                if os.path.exists(os.path.join(self._path, ticket)):
+
+                    os.remove(os.path.join(self._path, ticket))
+                    Log.debug("ClearCase view lock released: " + ticket)
+
+            self._ticket = None
+
+        finally:
+
+            self._unlock_queue(queue_lock)
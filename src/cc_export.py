@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+
+"""
+@summary: This script exports to the bare repository the changes made directly
+in ClearCase, so GIT users see them. It must be run from the bare repository
+(or receive its path) periodically, for example from cron:
+
+    cc_export.py [<bare repository>]
+
+Only the history since the last run is read (cleartool lshistory -since), the
+watermark of every VOB is saved in hooks_config/cc_export.json. Versions
+checked in by the hooks are skipped, their changes are already in GIT.
+Checkins of the same user and comment close in time are written as one commit
+with git fast-import, which never touches the working tree of any view.
+
+"""
+
+import fcntl
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+import Log
+
+from CCHistory import blob_id
+from CCHistory import git_date
+from CCHistory import group_changesets
+from ClearCase import CCError
+from ClearCase import ClearCase
+from CommandEngine import CommandEngine
+from GIT import FastImport
+from GIT import GIT
+from GIT import GITError
+from HooksConfig import ConfigException
+from HooksConfig import HooksConfig
+from Ledger import Ledger
+from Metrics import Metrics
+from PushMetadata import PUSH_COMMENT_MARK
+
+STATE_FILE = "hooks_config" + os.sep + "cc_export.json"
+LOCK_FILE = "hooks_config" + os.sep + "cc_export.lock"
+
+
+def load_state():
+    """
+    Returns the watermark of every VOB:
+
+        {<vob>: {"since": <yyyymmdd.hhmmss>, "seen": [<event keys>]}}
+
+    "seen" keeps the events of the last second already exported, because
+    lshistory -since includes that second again.
+
+    """
+
+    import json
+
+    if not os.path.isfile(STATE_FILE):
+
+        return {}
+
+    with open(STATE_FILE) as f:
+
+        return json.load(f)
+
+
+def save_state(state):
+
+    import json
+
+    tmp = STATE_FILE + "." + str(os.getpid()) + ".tmp"
+
+    with open(tmp, "w") as f:
+
+        json.dump(state, f)
+
+    os.rename(tmp, STATE_FILE)
+
+
+def new_events(cc, vob_path, mark, cc_branch):
+    """
+    Yields the events of the VOB not exported yet and updates mark, its
+    watermark, with every event read. Events not changing the GIT tree, made
+    by the hooks or on other ClearCase branches are left out.
+
+    """
+
+    since = mark.get("since")
+    seen = set(mark.get("seen", []))
+    last = since
+    last_keys = set(seen)
+
+    for event in cc.iter_history(vob_path, since):
+
+        if since is not None and (event.date < since or
+                                  (event.date == since and
+                                   event.key() in seen)):
+            continue
+
+        # Watermark
+        if last is None or event.date > last:
+
+            last = event.date
+            last_keys = set()
+
+        if event.date == last:
+
+            last_keys.add(event.key())
+
+        mark["since"] = last
+        mark["seen"] = sorted(last_keys)
+
+        if not event.is_file_version() and not event.deleted_elements():
+
+            continue
+
+        if PUSH_COMMENT_MARK in event.comment:
+
+            continue
+
+        if cc_branch is not None and event.branch() != cc_branch:
+
+            continue
+
+        yield event
+
+
+def fetch_contents(cc, events, directory):
+    """
+    Returns the content of the version of every event, read with cleartool
+    get in the ClearCase workers.
+
+    """
+
+    def fetch(event, target):
+
+        cc.get_version(event.element, event.version, target)
+
+        try:
+
+            with open(target, "rb") as f:
+
+                return f.read()
+
+        finally:
+
+            os.remove(target)
+
+    engine = CommandEngine()
+    futures = [(event, engine.submit("cleartool", fetch, event,
+                                     os.path.join(directory, str(i))))
+               for i, event in enumerate(events)]
+
+    return dict((event.element, future.result())
+                for event, future in futures)
+
+
+def changeset_changes(cc, changeset, view, tree, directory):
+    """
+    Returns the fast-import changes of a change set and updates tree, the
+    entries of the paths touched by the export. Files already with the same
+    content in GIT (for example changed by a push) give no change.
+
+    """
+
+    versions, deletions = changeset.changes()
+    contents = fetch_contents(cc, versions.values(), directory)
+    changes = []
+
+    for element in sorted(deletions):
+
+        path = os.path.relpath(element, view)
+        removed = [p for p in tree if p == path or p.startswith(path + "/")]
+
+        if removed:
+
+            changes.append(("D", path))
+
+            for p in removed:
+
+                del tree[p]
+
+    for element in sorted(versions):
+
+        path = os.path.relpath(element, view)
+        data = contents[element]
+        mode, blob = tree.get(path, ("100644", None))
+
+        if blob == blob_id(data):
+
+            continue
+
+        changes.append(("M", mode, path, data))
+        tree[path] = (mode, blob_id(data))
+
+    return changes
+
+
+def changeset_versions(changeset):
+    """
+    Returns the (element, version) tuples of a change set for the ledger.
+
+    """
+
+    return [(event.element, event.version) for event in changeset.events]
+
+
+def export(config, git, cc, state):
+    """
+    Writes the new ClearCase changes as commits of the export branch and
+    updates the watermarks in state. Returns the number of commits.
+
+    """
+
+    _ = HooksConfig.get_translations()
+
+    ref = "refs/heads/" + config.get_export_branch()
+    parent = git.resolve(ref)
+
+    if parent is None:
+
+        raise GITError(ref + _("ref_not_found"))
+
+    view = os.path.normpath(config.get_view())
+    cc_branch = config.get_export_cc_branch()
+    events = []
+    marks = {}
+
+    for vob in [v for v in config.get_vobs() if v] or [""]:
+
+        vob_path = os.path.normpath(os.path.join(view, vob))
+        marks[vob] = dict(state.get(vob, {}))
+        events.extend(new_events(cc, vob_path, marks[vob], cc_branch))
+
+    # Stable: events of the same second keep the lshistory order
+    events.sort(key=lambda event: event.timestamp)
+
+    changesets = list(group_changesets(events, config.get_export_window()))
+
+    Log.debug(lambda: str(len(events)) + " ClearCase events in " +
+              str(len(changesets)) + " change sets")
+
+    if not changesets:
+
+        state.update(marks)
+        return 0
+
+    paths = set()
+
+    for event in events:
+
+        if event.is_file_version():
+
+            paths.add(os.path.relpath(event.element, view))
+
+        for element in event.deleted_elements():
+
+            paths.add(os.path.relpath(element, view))
+
+    tree = git.tree_entries(parent, sorted(paths))
+    author = config.get_cc_pusher_user() + " <>"
+    directory = tempfile.mkdtemp(prefix="git2cc-export-")
+    fast_import = FastImport()
+    commits = 0
+    versions = []
+
+    try:
+
+        for changeset in changesets:
+
+            changes = changeset_changes(cc, changeset, view, tree, directory)
+
+            if not changes:
+
+                continue
+
+            # Next commits of the stream follow the previous one
+            fast_import.commit(ref, author, git_date(changeset.timestamp),
+                               changeset.message(_("cc_export_commit")),
+                               parent if commits == 0 else None, changes)
+            commits += 1
+            versions.append(changeset_versions(changeset))
+
+        fast_import.close()
+
+    except:
+
+        fast_import.abort()
+        raise
+
+    finally:
+
+        shutil.rmtree(directory, ignore_errors=True)
+
+    state.update(marks)
+
+    if commits > 0 and Ledger().is_enabled():
+
+        new_revision = git.resolve(ref)
+        Ledger().record_export(ref, parent, new_revision,
+                               zip(git.rev_list(parent, new_revision),
+                                   versions))
+
+    return commits
+
+
+def main():
+    """
+    Exports the ClearCase changes made since the last run. Only one export
+    runs at the same time.
+
+    """
+
+    # Load user messages
+    _ = HooksConfig.get_translations()
+
+    if len(sys.argv) > 1:
+
+        os.chdir(sys.argv[1])
+
+    try:
+
+        config = HooksConfig()
+        Log.configure(*config.get_log_levels())
+
+        if config.get_log_collector() is not None:
+
+            Log.use_collector(config.get_log_collector())
+
+        Log.set_context(ref="cc_export")
+
+    except ConfigException as e:
+        Log.error("{0} {1}".format(_("cc_export_error"), e.value))
+        sys.exit(1)
+
+    lock = open(LOCK_FILE, "a")
+
+    try:
+
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    except IOError:
+
+        Log.debug("Another ClearCase export is running")
+        return
+
+    try:
+
+        state = load_state()
+        commits = export(config, GIT(), ClearCase(), state)
+        save_state(state)
+
+        Metrics().inc("git2cc_exported_commits_total", commits)
+        Log.info(str(commits) + " commits exported from ClearCase to " +
+                 config.get_export_branch())
+
+    except (GITError, CCError, ConfigException) as e:
+        Log.error("{0} {1}".format(_("cc_export_error"), e.value))
+        sys.exit(1)
+
+    except:
+        Log.error("{0} {1}".format(_("cc_export_error"),
+                                   traceback.format_exc()))
+        sys.exit(1)
+
+    finally:
+
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+
+if __name__ == "__main__":
+
+    main()
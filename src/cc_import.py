@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+
+"""
+@summary: This script imports the whole ClearCase history of the view into a
+new branch of the bare repository, to bootstrap a bridge keeping the
+ClearCase history. It must be run from the bare repository (or receive its
+path):
+
+    cc_import.py [<bare repository>]
+
+The history (cleartool lshistory) is first stored in hooks_config/cc_import.db
+and then read in chronological order, grouped in change sets and written to
+git fast-import with the contents read by cleartool get. Memory use does not
+depend on the size of the history. Every [cc_import] checkpoint change sets
+the branch is updated and the position saved, so an interrupted import
+resumes from its last checkpoint when it is run again.
+
+Once finished, the watermarks of cc_export.py are set to the end of the
+imported history, so it goes on with the later ClearCase changes.
+
+"""
+
+import fcntl
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+import Log
+
+from CCHistory import HistoryEvent
+from CCHistory import git_date
+from CCHistory import group_changesets
+from ClearCase import CCError
+from ClearCase import ClearCase
+from CommandEngine import CommandEngine
+from GIT import FastImport
+from GIT import GIT
+from GIT import GITError
+from HooksConfig import ConfigException
+from HooksConfig import HooksConfig
+from Ledger import Ledger
+from Metrics import Metrics
+from cc_export import LOCK_FILE
+from cc_export import changeset_versions
+from cc_export import load_state
+from cc_export import new_events
+from cc_export import save_state
+
+IMPORT_DB = "hooks_config" + os.sep + "cc_import.db"
+
+
+class ImportState(object):
+
+    """
+    History read from ClearCase and progress of the import, kept in SQLite.
+    """
+
+    # Events read from the database at once
+    _PAGE = 1000
+
+    def __init__(self, filename):
+        """
+        Class constructor that opens (and creates if necessary) the import
+        database.
+
+        """
+
+        import sqlite3
+
+        self._db = sqlite3.connect(filename, isolation_level=None)
+        self._db.text_factory = str
+        self._db.execute("CREATE TABLE IF NOT EXISTS events ("
+                         "seq INTEGER PRIMARY KEY, "
+                         "ts INTEGER, "
+                         "date TEXT, "
+                         "user TEXT, "
+                         "operation TEXT, "
+                         "kind TEXT, "
+                         "element TEXT, "
+                         "version TEXT, "
+                         "comment TEXT)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS events_order "
+                         "ON events (ts, seq)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS progress ("
+                         "name TEXT PRIMARY KEY, "
+                         "value TEXT)")
+
+    def get(self, name):
+
+        row = self._db.execute("SELECT value FROM progress WHERE name = ?",
+                               (name,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def set(self, **values):
+
+        with self._db:
+
+            self._db.execute("BEGIN")
+            self._db.executemany("INSERT OR REPLACE INTO progress "
+                                 "(name, value) VALUES (?, ?)",
+                                 values.items())
+
+    def clear_events(self):
+
+        self._db.execute("DELETE FROM events")
+
+    def add_events(self, events):
+        """
+        Stores the events in batches, so they are never all in memory.
+
+        """
+
+        batch = []
+
+        for event in events:
+
+            batch.append((event.timestamp, event.date, event.user,
+                          event.operation, event.kind, event.element,
+                          event.version, event.comment))
+
+            if len(batch) == self._PAGE:
+
+                self._insert(batch)
+                batch = []
+
+        self._insert(batch)
+
+    def _insert(self, batch):
+
+        with self._db:
+
+            self._db.execute("BEGIN")
+            self._db.executemany("INSERT INTO events (ts, date, user, "
+                                 "operation, kind, element, version, "
+                                 "comment) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                 batch)
+
+    def events(self, after=None):
+        """
+        Yields the stored events in chronological order after the given
+        position (timestamp, seq), with their seq attribute set.
+
+        """
+
+        ts, seq = after if after is not None else (-1, -1)
+
+        while True:
+
+            rows = self._db.execute(
+                "SELECT seq, ts, date, user, operation, kind, element, "
+                "version, comment FROM events "
+                "WHERE ts > ? OR (ts = ? AND seq > ?) "
+                "ORDER BY ts, seq LIMIT ?",
+                (ts, ts, seq, self._PAGE)).fetchall()
+
+            if not rows:
+
+                return
+
+            for row in rows:
+
+                event = HistoryEvent(*row[2:])
+                event.seq = row[0]
+
+                yield event
+
+            seq, ts = rows[-1][0], rows[-1][1]
+
+
+def collect_history(config, cc, state):
+    """
+    Stores the history of every VOB in the import database. It is read only
+    once, a resumed import reuses it.
+
+    """
+
+    import json
+
+    view = os.path.normpath(config.get_view())
+    cc_branch = config.get_export_cc_branch()
+    marks = {}
+
+    state.clear_events()
+
+    for vob in [v for v in config.get_vobs() if v] or [""]:
+
+        vob_path = os.path.normpath(os.path.join(view, vob))
+        marks[vob] = {}
+
+        Log.info("Reading the ClearCase history of " + vob_path + "...")
+        state.add_events(new_events(cc, vob_path, marks[vob], cc_branch))
+
+    state.set(history="complete", marks=json.dumps(marks))
+
+
+def fetch_files(cc, events, directory):
+    """
+    Reads the version of every event with cleartool get in the ClearCase
+    workers and yields the (event, file) tuples in the given order. The
+    caller removes every file once used.
+
+    """
+
+    engine = CommandEngine()
+    futures = []
+
+    for i, event in enumerate(events):
+
+        target = os.path.join(directory, str(i))
+        futures.append((event, target,
+                        engine.submit("cleartool", cc.get_version,
+                                      event.element, event.version, target)))
+
+    for event, target, future in futures:
+
+        future.result()
+
+        yield event, target
+
+
+def import_history(config, git, cc, state):
+    """
+    Writes the ClearCase history as commits of the import branch from the
+    last checkpoint on. Returns the number of commits written by this run.
+
+    """
+
+    import json
+
+    _ = HooksConfig.get_translations()
+
+    ref = "refs/heads/" + config.get_export_branch()
+    parent = git.resolve(ref)
+    checkpoint = state.get("commit")
+
+    if checkpoint is None and parent is not None:
+
+        raise GITError(ref + _("ref_exists"))
+
+    if checkpoint is not None and parent != checkpoint:
+
+        raise GITError(ref + _("ref_moved"))
+
+    if state.get("history") != "complete":
+
+        collect_history(config, cc, state)
+
+    after = None
+
+    if state.get("position") is not None:
+
+        after = tuple(json.loads(state.get("position")))
+
+    view = os.path.normpath(config.get_view())
+    author = config.get_cc_pusher_user() + " <>"
+    every = config.get_import_checkpoint()
+    directory = tempfile.mkdtemp(prefix="git2cc-import-")
+    fast_import = FastImport()
+    commits = 0
+    mark = 0
+    position = after
+
+    # Versions of the commits written since the last checkpoint and commit
+    # of the branch at that checkpoint, for the ledger
+    pending = []
+    last_commit = [checkpoint]
+
+    def save_checkpoint():
+
+        fast_import.checkpoint()
+
+        if position is None:
+
+            return
+
+        commit = git.resolve(ref)
+
+        if pending and Ledger().is_enabled():
+
+            Ledger().record_export(ref, last_commit[0], commit,
+                                   zip(git.rev_list(last_commit[0], commit),
+                                       pending))
+
+        del pending[:]
+        last_commit[0] = commit
+        state.set(position=json.dumps(position), commit=commit)
+
+    try:
+
+        for changeset in group_changesets(state.events(after),
+                                          config.get_export_window()):
+
+            versions, deletions = changeset.changes()
+            changes = []
+
+            # Deleting a path not in the tree does nothing
+            for element in sorted(deletions):
+
+                changes.append(("D", os.path.relpath(element, view)))
+
+            for event, target in fetch_files(
+                    cc, [versions[e] for e in sorted(versions)], directory):
+
+                mark += 1
+
+                with open(target, "rb") as f:
+
+                    fast_import.blob(mark, f.read())
+
+                os.remove(target)
+                changes.append(("M", "100644",
+                                os.path.relpath(event.element, view),
+                                ":" + str(mark)))
+
+            last = changeset.events[-1]
+            position = (last.timestamp, last.seq)
+
+            if not changes:
+
+                continue
+
+            # Next commits of the stream follow the previous one
+            fast_import.commit(ref, author, git_date(changeset.timestamp),
+                               changeset.message(_("cc_export_commit")),
+                               parent if commits == 0 else None, changes)
+            commits += 1
+            pending.append(changeset_versions(changeset))
+
+            if commits % every == 0:
+
+                save_checkpoint()
+                Log.info(str(commits) + " commits imported, up to " +
+                         last.date)
+
+        save_checkpoint()
+        fast_import.close()
+
+    except:
+
+        fast_import.abort()
+        raise
+
+    finally:
+
+        shutil.rmtree(directory, ignore_errors=True)
+
+    # cc_export.py goes on from the end of the imported history
+    export_state = load_state()
+    export_state.update(json.loads(state.get("marks")))
+    save_state(export_state)
+
+    return commits
+
+
+def main():
+    """
+    Imports (or resumes the import of) the ClearCase history. The import
+    and cc_export.py never run at the same time.
+
+    """
+
+    # Load user messages
+    _ = HooksConfig.get_translations()
+
+    if len(sys.argv) > 1:
+
+        os.chdir(sys.argv[1])
+
+    try:
+
+        config = HooksConfig()
+        Log.configure(*config.get_log_levels())
+
+        if config.get_log_collector() is not None:
+
+            Log.use_collector(config.get_log_collector())
+
+        Log.set_context(ref="cc_import")
+
+    except ConfigException as e:
+        Log.error("{0} {1}".format(_("cc_import_error"), e.value))
+        sys.exit(1)
+
+    lock = open(LOCK_FILE, "a")
+
+    try:
+
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    except IOError:
+
+        Log.error("{0} {1}".format(_("cc_import_error"),
+                                   "a ClearCase export or import is running"))
+        sys.exit(1)
+
+    try:
+
+        state = ImportState(IMPORT_DB)
+
+        if state.get("done") is not None:
+
+            Log.info("ClearCase history already imported")
+            return
+
+        commits = import_history(config, GIT(), ClearCase(), state)
+        state.set(done="1")
+
+        Metrics().inc("git2cc_exported_commits_total", commits)
+        Log.info("ClearCase history imported in " +
+                 config.get_export_branch())
+
+    except (GITError, CCError, ConfigException) as e:
+        Log.error("{0} {1}".format(_("cc_import_error"), e.value))
+        sys.exit(1)
+
+    except:
+        Log.error("{0} {1}".format(_("cc_import_error"),
+                                   traceback.format_exc()))
+        sys.exit(1)
+
+    finally:
+
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+
+if __name__ == "__main__":
+
+    main()
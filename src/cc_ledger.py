@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+@summary: This script queries the ledger of synchronizations ([ledger] enabled
+in the configuration) from the bare repository:
+
+    cc_ledger.py commit <commit> [<bare repository>]
+        Synchronizations of the commit with the ClearCase versions and labels
+        they produced or came from.
+
+    cc_ledger.py version <element>@@<version> [<bare repository>]
+        Synchronizations that created or exported the ClearCase version, with
+        their commits.
+
+The exit code is 1 when nothing is found.
+
+"""
+
+import os
+import sys
+import time
+
+from GIT import GIT
+from GIT import GITError
+from HooksConfig import ConfigException
+from HooksConfig import HooksConfig
+from Ledger import Ledger
+
+USAGE = ("Usage: cc_ledger.py commit <commit> [<bare repository>]\n"
+         "       cc_ledger.py version <element>@@<version> "
+         "[<bare repository>]\n")
+
+
+def describe(sync):
+    """
+    Returns one line describing a synchronization.
+
+    """
+
+    sync_id, direction, ref, old_revision, new_revision, push_id, when = sync
+
+    return "%s %s %s (push %s): %s..%s" % (
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when)), direction,
+        ref, push_id, old_revision, new_revision)
+
+
+def main():
+    """
+    Runs one query of the ledger.
+
+    """
+
+    if len(sys.argv) not in (3, 4) or sys.argv[1] not in ("commit", "version"):
+
+        sys.stderr.write(USAGE)
+        sys.exit(2)
+
+    if len(sys.argv) == 4:
+
+        os.chdir(sys.argv[3])
+
+    try:
+
+        HooksConfig()
+        ledger = Ledger()
+
+        if not ledger.is_enabled():
+
+            raise ConfigException("[ledger] enabled is false")
+
+        if sys.argv[1] == "commit":
+
+            commit = GIT().resolve(sys.argv[2]) or sys.argv[2]
+            result = ledger.find_commit(commit)
+
+            for sync, versions, labels in result:
+
+                sys.stdout.write(describe(sync) + "\n")
+
+                for element, version in versions:
+
+                    sys.stdout.write("    " + element + "@@" + version + "\n")
+
+                if labels:
+
+                    sys.stdout.write("    labels: " + " ".join(labels) + "\n")
+
+        else:
+
+            element, sep, version = sys.argv[2].partition("@@")
+            result = ledger.find_version(element, version)
+
+            for sync, commits in result:
+
+                sys.stdout.write(describe(sync) + "\n")
+
+                for commit in commits:
+
+                    sys.stdout.write("    " + commit + "\n")
+
+    except (GITError, ConfigException) as e:
+
+        sys.stderr.write(str(e.value) + "\n")
+        sys.exit(2)
+
+    if not result:
+
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    main()
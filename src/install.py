@@ -1,10 +1,58 @@
 #!/usr/bin/env python
 
+"""
+@summary: Installs the hooks in the bare repository containing the current
+directory (<repository>.git/hooks/<this directory>).
+
+With --bundle the hooks are installed as one precompiled file (git2cc.pyz, a
+zip with the bytecode of every module) instead of links to the scripts. The
+bundle starts faster and must be run by the same Python version that built it.
+
+"""
+
 import os
+import py_compile
 import shutil
 import subprocess
 import sys
+import tempfile
 import traceback
+import zipfile
+
+BUNDLE_NAME = "git2cc.pyz"
+
+# Entry point of the bundle. The module to run is its first argument when it
+# names one or else the name the bundle is called with (hooks/update,
+# hooks/post-receive).
+BUNDLE_MAIN = """
+import os
+import sys
+
+# Entry points which are not hooks
+COMMANDS = ("log_collector", "cc_export", "cc_import", "reconcile",
+            "cc_ledger")
+
+ENTRY_POINTS = ("update", "post-receive") + COMMANDS
+
+if len(sys.argv) > 1 and sys.argv[1] in ENTRY_POINTS:
+
+    name = sys.argv.pop(1)
+
+else:
+
+    name = os.path.basename(sys.argv[0])
+
+module = __import__(name)
+
+if name in COMMANDS:
+
+    module.main()
+
+else:
+
+    import Profiler
+    Profiler.run(name, module.main)
+"""
 
 
 class InstallerError(Exception):
@@ -22,9 +70,57 @@ class InstallerError(Exception):
         return repr(self.value)
 
 
-def install_executables(cwd, hookspath):
+def build_bundle(cwd):
+    """
+    Builds the hooks bundle with the bytecode of every module and returns its
+    path.
+
+    """
+
+    bundle_file = cwd + os.sep + BUNDLE_NAME
+    tmpdir = tempfile.mkdtemp()
+
+    try:
+
+        main_file = tmpdir + os.sep + "__main__.py"
+
+        with open(main_file, "w") as f:
+
+            f.write(BUNDLE_MAIN)
+
+        sources = [main_file] + [cwd + os.sep + x for x in
+                                 sorted(os.listdir(cwd))
+                                 if x.endswith(".py") and x != "install.py"]
+
+        with open(bundle_file, "wb") as f:
+
+            f.write("#!" + sys.executable + "\n")
+
+        bundle = zipfile.ZipFile(bundle_file, "a", zipfile.ZIP_DEFLATED)
+
+        try:
+
+            for source in sources:
+
+                compiled = tmpdir + os.sep + os.path.basename(source) + "c"
+                py_compile.compile(source, compiled, doraise=True)
+                bundle.write(compiled, os.path.basename(compiled))
+
+        finally:
+
+            bundle.close()
+
+    finally:
+
+        shutil.rmtree(tmpdir)
+
+    return bundle_file
+
+
+def install_executables(cwd, hookspath, bundle_file=None):
     """
     Enables hooks scripts execution flag and creates the necessary links.
+    When a bundle is given both hooks are linked to it.
 
     """
 
@@ -32,6 +128,11 @@ def install_executables(cwd, hookspath):
     update_file = cwd + os.sep + "update.py"
     post_receive_file = cwd + os.sep + "post-receive.py"
 
+    if bundle_file is not None:
+
+        update_file = bundle_file
+        post_receive_file = bundle_file
+
     update_link = hookspath + os.sep + "update"
     post_receive_link = hookspath + os.sep + "post-receive"
 
@@ -95,7 +196,7 @@ def print_final_message(gitpath):
         gitpath + os.sep + "hooks_config" + os.sep + "bridge.cfg"))
 
 
-def main():
+def main(bundle=False):
 
     cwd = os.getcwd()
     pathlist = cwd.split(os.sep)
@@ -115,8 +216,14 @@ def main():
         hookspath = os.sep.join(pathlist[:pathlist.index("hooks") + 1])
         gitpath = os.sep.join(pathlist[:git_index + 1])
 
+        bundle_file = None
+
+        if bundle:
+
+            bundle_file = build_bundle(cwd)
+
         # Install
-        install_executables(cwd, hookspath)
+        install_executables(cwd, hookspath, bundle_file)
         install_language(cwd, gitpath)
         install_config(cwd, gitpath)
 
@@ -129,7 +236,7 @@ def main():
 if __name__ == "__main__":
 
     try:
-        main()
+        main("--bundle" in sys.argv[1:])
 
     except InstallerError as e:
 
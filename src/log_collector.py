@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+"""
+@summary: Central log collector of the hooks. Concurrent update and
+post-receive processes send their records through a unix socket (see
+Log.use_collector) and this process is the only writer of the log file, so
+rotation is safe and records are never interleaved. Records are written in
+batches.
+
+The hooks start the collector when it is not running. It exits after some time
+without clients.
+
+The handler used by the hooks to send their records (UnixSocketHandler) lives
+here too, next to the code decoding them.
+
+Usage: log_collector.py <socket path> <log file>
+
+"""
+
+import errno
+import fcntl
+import json
+import logging
+import logging.handlers
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+
+# Same format as Log.FILE_FORMATTER. Log is not imported because its handlers
+# would send the records of the collector to itself.
+FILE_FORMATTER = ('%(asctime)s %(levelname)-8s '
+                  '[%(push_id)s %(ref)s %(process)d] %(message)s')
+
+# Records are written when this number is reached or after FLUSH_INTERVAL
+BATCH_SIZE = 200
+FLUSH_INTERVAL = 0.5
+
+# Seconds without clients nor records before exiting
+IDLE_TIMEOUT = 600
+
+# Longest encoded record accepted from a client
+MAX_RECORD_SIZE = 1024 * 1024
+
+
+class UnixSocketHandler(logging.handlers.SocketHandler):
+
+    """
+    Sends records to the log collector through a unix socket. Records are
+    encoded as length prefixed JSON objects.
+    """
+
+    # Record attributes sent to the collector
+    FIELDS = ("name", "levelno", "levelname", "msg", "created", "msecs",
+              "process", "push_id", "ref", "exc_text")
+
+    def __init__(self, path):
+
+        logging.handlers.SocketHandler.__init__(self, path, None)
+
+    def makeSocket(self, timeout=1):
+
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        s.connect(self.host)
+
+        return s
+
+    def makePickle(self, record):
+
+        data = {}
+
+        for field in self.FIELDS:
+
+            data[field] = getattr(record, field, None)
+
+        data["msg"] = record.getMessage()
+        data = json.dumps(data)
+
+        return struct.pack(">L", len(data)) + data
+
+
+def open_socket(socket_path):
+    """
+    Creates the listening socket, removing the socket file of a dead
+    collector.
+
+    """
+
+    if os.path.exists(socket_path):
+
+        os.remove(socket_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+
+    # Hooks run as the user pushing
+    os.chmod(socket_path, 0666)
+    server.listen(32)
+    server.setblocking(0)
+
+    return server
+
+
+def read_records(buf):
+    """
+    Extracts the complete length prefixed JSON records of the buffer. Returns
+    the records and the remaining bytes.
+
+    Raises ValueError exception when a record is not valid or too long.
+
+    """
+
+    records = []
+
+    while len(buf) >= 4:
+
+        length = struct.unpack(">L", buf[:4])[0]
+
+        if length > MAX_RECORD_SIZE:
+
+            raise ValueError("record of " + str(length) + " bytes")
+
+        if len(buf) < 4 + length:
+
+            break
+
+        data = json.loads(buf[4:4 + length])
+        buf = buf[4 + length:]
+
+        if not isinstance(data, dict):
+
+            raise ValueError("record is not an object")
+
+        # Logging expects str messages in Python 2
+        for key, value in data.items():
+
+            if isinstance(value, unicode):
+
+                data[key] = value.encode("utf-8")
+
+        records.append(logging.makeLogRecord(data))
+
+    return records, buf
+
+
+def collector_record(message):
+    """
+    Returns a warning record of the collector itself.
+
+    """
+
+    return logging.makeLogRecord({"name": "log_collector",
+                                  "levelno": logging.WARNING,
+                                  "levelname": "WARNING", "msg": message,
+                                  "push_id": "-", "ref": "-"})
+
+
+def write_batch(handler, batch):
+
+    for record in batch:
+
+        handler.handle(record)
+
+    handler.flush()
+
+
+def serve(server, handler):
+    """
+    Receives records from every client and writes them in batches until the
+    idle timeout expires.
+
+    """
+
+    clients = {}
+    batch = []
+    last_flush = time.time()
+    last_activity = time.time()
+
+    while True:
+
+        try:
+
+            readable = select.select([server] + clients.keys(), [], [],
+                                     FLUSH_INTERVAL)[0]
+
+        except select.error as e:
+
+            if e.args[0] == errno.EINTR:
+
+                continue
+
+            raise
+
+        for s in readable:
+
+            last_activity = time.time()
+
+            if s is server:
+
+                try:
+
+                    client = server.accept()[0]
+                    clients[client] = ""
+
+                except socket.error:
+
+                    pass
+
+                continue
+
+            try:
+
+                data = s.recv(65536)
+
+                if data:
+
+                    records, clients[s] = read_records(clients[s] + data)
+                    batch.extend(records)
+                    continue
+
+            except (socket.error, ValueError) as e:
+
+                # Only the failing client is dropped
+                batch.append(collector_record("Log client dropped: " +
+                                              str(e)))
+
+            del clients[s]
+            s.close()
+
+        if batch and (len(batch) >= BATCH_SIZE or
+                      time.time() - last_flush >= FLUSH_INTERVAL):
+
+            write_batch(handler, batch)
+            batch = []
+            last_flush = time.time()
+
+        if not clients and time.time() - last_activity > IDLE_TIMEOUT:
+
+            break
+
+    write_batch(handler, batch)
+
+
+def main():
+
+    socket_path = sys.argv[1]
+    log_file = sys.argv[2]
+
+    # Only one collector per socket
+    lock = open(socket_path + ".lock", "a")
+
+    try:
+
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    except IOError:
+
+        sys.exit(0)
+
+    handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=1000000,
+                                                   backupCount=5)
+    handler.setFormatter(logging.Formatter(FILE_FORMATTER))
+
+    # Terminating the collector must remove its socket too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    server = open_socket(socket_path)
+
+    try:
+
+        serve(server, handler)
+
+    finally:
+
+        server.close()
+        os.remove(socket_path)
+        handler.close()
+
+
+if __name__ == "__main__":
+
+    main()
@@ -10,35 +10,46 @@ execution of a push operation takes effect.
 
 import os
 import sys
+import time
 import traceback
+import Admission
 import Log
+import Profiler
 
+from CheckoutTree import CheckoutTree
+from CommitReplay import CommitReplay
 from ClearCase import CCError
 from ClearCase import ClearCase
+from CommandEngine import CommandEngine
 from GIT import GIT
 from GIT import GITError
 from HooksConfig import ConfigException
 from HooksConfig import HooksConfig
+from Ledger import Ledger
+from Ledger import from_clearcase
+from Manifest import Manifest
+from MetadataCache import MetadataCache
+from Metrics import Metrics
+from ShardMap import ShardMap
+from ViewLock import ViewLock
+from ViewLock import ViewLockError
 
 
-def add_file(ccpath, labels, list_co):
+def add_files(ccpaths, labels, list_co, cc):
     """
-    Adds one file to ClearCase view.
+    Adds the new files to ClearCase view grouped by parent directory.
 
     """
 
-    cc = ClearCase()
-
-    cc.create_file(ccpath, labels, list_co)
+    cc.create_files(ccpaths, labels, list_co)
 
 
-def checkin_file(ccpath, labels):
+def checkin_file(ccpath, labels, cc):
     """
     Checks in one file in the ClearCase view.
 
     """
 
-    cc = ClearCase()
     cc.checkin(ccpath, labels)
 
 
@@ -58,20 +69,19 @@ def log_received_files_and_labels (labels, file_status_list):
     labels.
 
     """
-    list_of_files = '\n'.join(str(p) for p in file_status_list)
-    
     Log.debug ("Post-receive hook Received Git Files")
     Log.debug ("====================================")
-    Log.debug (list_of_files)
+    Log.debug (lambda: '\n'.join(str(p) for p in file_status_list))
     
     Log.debug ("Labels received to synchronise with ClearCase")
     Log.debug ("============================================")
     Log.debug (labels)
     
-def process_push(cc_view_path, file_status_list):
+def process_push(cc_view_path, file_status_list, cc):
     """
     This procedure executes the right ClearCase operation for every file in the
-    file_status_list.
+    file_status_list, with the ClearCase object of the view (see ShardMap).
+    Returns the labels set.
 
     """
 
@@ -82,41 +92,87 @@ def process_push(cc_view_path, file_status_list):
     
     labels = git.last_commit_labels(cc_view_path)
 
-    list_co = []
+    list_co = CheckoutTree()
+    added_files = []
     
     log_received_files_and_labels (labels, file_status_list)
-    
+
+    # Ignored files (see IgnoreRules) are not in the list
     for git_file in file_status_list:
 
-        if git_file[1] != ".gitignore":
-            """
-            .gitignore file must have no version in CC.
-            Note: In the future could be interesting a list of ignored files.
+        if git_file[0] == 'A':
 
-            """
+            added_files.append(cc_view_path + git_file[1])
 
-            if git_file[0] == 'A':
+        elif git_file[0] == 'M':
 
-                add_file(cc_view_path + git_file[1], labels, list_co)
+            checkin_file(cc_view_path + git_file[1], labels, cc)
 
-            elif git_file[0] == 'M':
+        # Deleted files do not need post_receive operations.
 
-                checkin_file(cc_view_path + git_file[1], labels)
+    if added_files:
 
-            # Deleted files do not need post_receive operations.
+        add_files(added_files, labels, list_co, cc)
 
     # Checkout dirs needed to Add files checked-in.
-    cc = ClearCase()
     cc.checkin_list (list_co, labels)
-    
+
+    return labels
+
+def sync_shard(git, ref, shard, sharded, old_revision, new_revision,
+               file_status_list, deferred=False):
+    """
+    Updates the view of the shard to new_revision and writes the files of the
+    shard in ClearCase. A push deferred by the admission control of the update
+    hook is replayed. Returns the labels set and the number of files
+    synchronized.
+
+    """
+
+    config = HooksConfig()
+    cc_view_path = shard.view + os.sep
+
+    # Pushes not touching a shard leave its view behind old_revision
+    view_revision = old_revision
+
+    if sharded:
+
+        view_revision = git.view_head(cc_view_path)
+
+    if deferred or config.get_sync_mode() == "replay":
+
+        # Every commit is written in ClearCase on its own, the update hook
+        # only took the view lock
+        replay = CommitReplay(git, shard, ref)
+        replay.replay(old_revision, new_revision, view_revision)
+
+        return replay.labels, replay.files
+
+    # Update ClearCase view using GIT
+    if config.get_view_update_mode() == "incremental":
+
+        Log.debug("git incremental update of " + cc_view_path + "...")
+        git.update_view(cc_view_path, ref, view_revision, new_revision)
+        Log.debug("git incremental update of " + cc_view_path + "...OK")
+
+    else:
+
+        Log.debug("git pull from " + cc_view_path + "...")
+        git.pull(cc_view_path)
+        Log.debug("git pull from " + cc_view_path + "...OK")
+
+    # Process every file
+    return (process_push(cc_view_path, file_status_list, shard.cc),
+            len(file_status_list))
+
 def do_sync(old_revision, new_revision, git, config, refs):
     """
     Checks conditions to do a Clearcase sync:
         * Reference must be a HEAD
         * Old revision must be not null.
         * New revision must exists (For example, a tag has no new revision.
-        * Committer must be different from the cc_pusher_user defined in the
-            configuration file
+        * New revision must not come from ClearCase (see
+            Ledger.from_clearcase)
         * Branch (ref[2]) must be in the sync branches list
 
     """
@@ -129,42 +185,199 @@ def do_sync(old_revision, new_revision, git, config, refs):
             refs[2] is not None and
             refs[2] in config.get_sync_branches()):
 
-        committer = git.get_committer(new_revision)
-
-        sync = committer != config.get_cc_pusher_user()
+        sync = not from_clearcase(git, new_revision)
 
     return sync
 
 
 def get_standard_input():
     """
-    Returns the old and new revisions from the standard input because this hook
+    Returns the [<old revision>, <new revision>, <reference>] of every
+    reference updated by the push from the standard input because this hook
     does not receive parameters from Git.
 
     """
 
-    line = sys.stdin.readline()
-    params = line.split()
+    updates = []
 
-    if len(params) > 1:
+    for line in sys.stdin:
 
-        return params[0], params[1], params[2]
+        params = line.split()
 
-    else:
+        if len(params) > 2:
+
+            updates.append(params[:3])
+
+    return updates
+
+
+def sync_ref(git, config, old_revision, new_revision, refs, start, held=()):
+    """
+    Synchronizes one updated branch with ClearCase in the views of its shards,
+    with the view locks taken by the update hook. The locks of the held views
+    are not released. Returns False when the synchronization failed.
+
+    """
+
+    # Load user messages
+    _ = HooksConfig.get_translations()
+
+    locked = []
+
+    try:
+
+        shards = ShardMap(refs[2])
+
+        if not do_sync(old_revision, new_revision, git, config, refs):
+
+            ShardMap.release([shard for shard in shards.shards
+                              if shard.view not in held])
+            return True
+
+        deferred = Admission.take_deferred(refs, new_revision)
+        file_status_list = git.get_commit_files(old_revision, new_revision)
+
+        # The view locks taken by the update hook of this push are reused
+        # here
+        locked = shards.touched(file_status_list)
+        ShardMap.acquire(locked, config.get_lock_timeout())
+
+        # Every shard is synchronized in its own view at the same time
+        labels = []
+        files = 0
+
+        for shard_labels, shard_files in CommandEngine.parallel(
+                "shard", lambda shard, shard_file_list: sync_shard(
+                    git, '/'.join(refs), shard, shards.is_sharded(),
+                    old_revision, new_revision, shard_file_list, deferred),
+                shards.split(file_status_list)):
+
+            labels.extend(label for label in shard_labels
+                          if label not in labels)
+            files += shard_files
+
+        Profiler.record_files(files)
+
+        # The manifest describes the [cc_view] view
+        if not shards.mapped:
+
+            Manifest().update(git, shards, old_revision, new_revision,
+                              file_status_list)
+
+        if Ledger().is_enabled():
+
+            try:
+
+                Ledger().record_push('/'.join(refs), old_revision,
+                                     new_revision,
+                                     git.rev_list(old_revision, new_revision),
+                                     labels,
+                                     [shard.view for shard in shards.shards])
 
-        return params[0], None, None
+            except:
+
+                # ClearCase is already synchronized: the push did not fail
+                Log.warning("Push not recorded in the ledger: " +
+                            str(sys.exc_info()))
+
+        Metrics().record_push("post-receive", "synced", time.time() - start)
+
+        # Check in every remaining check out
+        #checkin_all (cc_view_path)
+
+    except (GITError, CCError, ConfigException, ViewLockError) as e:
+        Log.error("{0} {1}".format(_("post-receive hook error:"), e.value))
+        Log.error("Please review checkout files!!!!")
+        Metrics().record_push("post-receive", "failed", time.time() - start)
+        return False
+
+    except:
+        Log.error("{0} {1}".format(_("post-receive hook unexpected error:"),
+                               traceback.format_exc(), sys.exc_info()[0]))
+        Log.error("Please review checkout files!!!!")
+        Metrics().record_push("post-receive", "failed", time.time() - start)
+        return False
+
+    finally:
+
+        ShardMap.release([shard for shard in locked
+                          if shard.view not in held])
+
+    return True
+
+
+def group_updates(updates):
+    """
+    Groups the updated branches sharing any view: the view lock of a push is
+    one ticket for all its branches, so they cannot be synchronized at the
+    same time in the same view. Returns [<views>, <updates>] for every group,
+    with its updates in the order of the push.
+
+    """
+
+    groups = []
+
+    for index, update in enumerate(updates):
+
+        try:
+
+            views = set(shard.view for shard in ShardMap(update[2][2]).shards)
+
+        except ConfigException:
+
+            # Reported by sync_ref
+            views = set()
+
+        group = [views, [index]]
+
+        for other in [other for other in groups if other[0] & views]:
+
+            groups.remove(other)
+            group[0] |= other[0]
+            group[1].extend(other[1])
+
+        groups.append(group)
+
+    return [[views, [updates[index] for index in sorted(indexes)]]
+            for views, indexes in groups]
+
+
+def sync_refs(git, config, views, updates, start):
+    """
+    Synchronizes one after the other the given updated branches sharing the
+    given views, releasing their locks when the last one has finished.
+    Returns False when the synchronization of any branch failed.
+
+    """
+
+    results = []
+
+    try:
+
+        for old_revision, new_revision, refs in updates:
+
+            results.append(sync_ref(git, config, old_revision, new_revision,
+                                    refs, start, views))
+
+    finally:
+
+        for view in views:
+
+            ViewLock(view).release()
+
+    return all(results)
 
 
 def main():
     """
     Retrieves the old and new revisions from the standard input and performs
     all necessary operations to maintain ClearCase after GIT updates its
-    references.
+    references. The synchronized branches of the push are processed in their
+    own threads, the ones sharing a view in the same thread.
 
     """
-    Log.debug ("START POST-RECEIVE")
-    Log.debug ("==================")
-    
+    start = time.time()
+
     # Load user messages
     _ = HooksConfig.get_translations()
 
@@ -172,16 +385,23 @@ def main():
 
         git = GIT()
         config = HooksConfig()
+        Log.configure(*config.get_log_levels())
+
+        if config.get_log_collector() is not None:
 
-        old_revision, new_revision, refs = get_standard_input()
+            Log.use_collector(config.get_log_collector())
+
+        updates = get_standard_input()
+        Log.set_context(ref=",".join(update[2] for update in updates))
 
         """
         ref[0] = "refs"
         ref[1] can be: "heads", "remotes", "tags"
         ref[2] can be: a reference to the head (branch),
-                       remote or tags respectively
+                       remote or tags respectively, with any '/' it contains
         """
-        refs = refs.split('/')
+        updates = [[old_revision, new_revision, refs.split('/', 2)]
+                   for old_revision, new_revision, refs in updates]
 
     except (GITError, ConfigException) as e:
         Log.error("{0} {1}".format(_("post-receive hook error:"), e.value))
@@ -194,38 +414,33 @@ def main():
         Log.error("Please review checkout files!!!!")
         sys.exit(1)
 
-    if do_sync(old_revision, new_revision, git, config, refs):
+    # Fast path: the update hook never locks the view for references not
+    # synchronized
+    updates = [update for update in updates
+               if len(update[2]) == 3 and update[2][1] == "heads" and
+               update[2][2] in config.get_sync_branches()]
 
-        try:
+    if not updates:
 
-            # Path to ClearCase view
-            cc_view_path = config.get_view() + os.sep
+        return
 
-            # Update ClearCase view and recover file status list using GIT
-            Log.debug("git pull from " + cc_view_path + "...")
-            git.pull(cc_view_path)
-            Log.debug("git pull from " + cc_view_path + "...OK")
-            file_status_list = git.get_commit_files(old_revision, new_revision)
+    Log.debug ("START POST-RECEIVE")
+    Log.debug ("==================")
 
-            # Process every file
-            process_push(cc_view_path, file_status_list)
+    # Branches sharing a view are synchronized in the order of the push,
+    # the ones in other views at the same time
+    results = CommandEngine.parallel(
+        "branch", lambda views, group: sync_refs(
+            git, config, views, group, start), group_updates(updates))
 
-            # Check in every remaining check out
-            #checkin_all (cc_view_path)
+    MetadataCache().log_statistics()
 
-        except (GITError, CCError, ConfigException) as e:
-            Log.error("{0} {1}".format(_("post-receive hook error:"), e.value))
-            Log.error("Please review checkout files!!!!")
-            sys.exit(1)
+    Log.debug ("END POST-RECEIVE")
 
-        except:
-            Log.error("{0} {1}".format(_("post-receive hook unexpected error:"),
-                                   traceback.format_exc(), sys.exc_info()[0]))
-            Log.error("Please review checkout files!!!!")
-            sys.exit(1)
+    if not all(results):
 
-    Log.debug ("END POST-RECEIVE")
+        sys.exit(1)
 
 if __name__ == "__main__":
 
-    main()
+    Profiler.run("post-receive", main)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+
+"""
+@summary: This script compares a branch of the bare repository with the files
+of the ClearCase snapshot view and reports the drift between them:
+
+    reconcile.py [--branch <branch>] [--plan <file>] [<bare repository>]
+
+Files missing in the view, only in the view or with different content are
+reported, as well as the checkouts left in the view. Contents are compared in
+GIT blob format, hashed in a pool of processes (big files are mapped in
+memory), and only when the sizes are equal. When the manifest describes the
+branch revision, files with the blob, size and modification time it recorded
+are not hashed again.
+
+With --plan the repair needed to make the view match the branch is written in
+the format of git diff --name-status (A: add to the view, M: update it, D:
+remove it from the view), the list of files the synchronization processes.
+
+The exit code is 0 when the view matches the branch and 1 otherwise.
+
+"""
+
+import hashlib
+import mmap
+import optparse
+import os
+import sys
+import traceback
+import Log
+
+from CCHistory import blob_id
+from ClearCase import CCError
+from ClearCase import ClearCase
+from GIT import GIT
+from GIT import GITError
+from HooksConfig import ConfigException
+from HooksConfig import HooksConfig
+from Manifest import Manifest
+
+# Files at least this size are hashed through mmap instead of being read
+MMAP_SIZE = 1024 * 1024
+
+# View entries that are not part of the synchronized tree
+VIEW_METADATA = (".git", "view.dat", "lost+found")
+
+
+def hash_file(args):
+    """
+    Returns (path, GIT blob id) of a view file. Symbolic links are hashed as
+    GIT stores them, by their target. Runs in the pool processes.
+
+    """
+
+    path, filename = args
+
+    if os.path.islink(filename):
+
+        return path, blob_id(os.readlink(filename))
+
+    with open(filename, "rb") as f:
+
+        size = os.fstat(f.fileno()).st_size
+
+        if size < MMAP_SIZE:
+
+            return path, blob_id(f.read())
+
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+
+            sha = hashlib.sha1("blob " + str(size) + "\0")
+            sha.update(data)
+
+            return path, sha.hexdigest()
+
+        finally:
+
+            data.close()
+
+
+def walk_view(view):
+    """
+    Returns every file of the view as {<path>: (<size>, <is link>, <mtime>)},
+    paths relative to the view with the GIT separator.
+
+    """
+
+    files = {}
+
+    for root, dirs, names in os.walk(view):
+
+        relroot = os.path.relpath(root, view)
+        prefix = "" if relroot == "." else relroot.replace(os.sep, "/") + "/"
+
+        dirs[:] = [d for d in dirs if d not in VIEW_METADATA]
+
+        # Links to directories are listed in dirs but GIT stores them as files
+        for name in names + [d for d in dirs
+                             if os.path.islink(os.path.join(root, d))]:
+
+            if name in VIEW_METADATA:
+
+                continue
+
+            st = os.lstat(os.path.join(root, name))
+            files[prefix + name] = (st.st_size, os.path.islink(
+                os.path.join(root, name)), st.st_mtime)
+
+    return files
+
+
+def compare(tree, files, view, manifest):
+    """
+    Returns the (missing, extra, different) paths of the view compared with
+    the GIT tree. Files the manifest (of the same revision) knows unchanged
+    are not hashed.
+
+    """
+
+    import multiprocessing
+
+    missing = sorted(p for p in tree if p not in files)
+    extra = sorted(p for p in files if p not in tree)
+    different = []
+    to_hash = []
+
+    for path in files:
+
+        if path not in tree:
+
+            continue
+
+        mode, blob, size = tree[path]
+        size_in_view, is_link, mtime = files[path]
+        known = manifest.get(path)
+
+        if (mode == "120000") != is_link:
+
+            different.append(path)
+
+        elif known is not None and known[0] == blob and \
+                known[2:] == (size_in_view, mtime):
+
+            continue
+
+        elif is_link or size == size_in_view:
+
+            to_hash.append((path, os.path.join(view, path)))
+
+        else:
+
+            different.append(path)
+
+    Log.debug(lambda: str(len(to_hash)) + " files to hash")
+
+    if to_hash:
+
+        pool = multiprocessing.Pool()
+
+        try:
+
+            for path, blob in pool.imap_unordered(hash_file, to_hash, 64):
+
+                if blob != tree[path][1]:
+
+                    different.append(path)
+
+        finally:
+
+            pool.terminate()
+            pool.join()
+
+    return missing, extra, sorted(different)
+
+
+def write_plan(filename, missing, extra, different):
+    """
+    Writes the repair of the view in git diff --name-status format.
+
+    """
+
+    with open(filename, "w") as f:
+
+        for status, paths in (("A", missing), ("M", different),
+                              ("D", extra)):
+
+            for path in paths:
+
+                f.write(status + "\t" + path + "\n")
+
+
+def report(title, paths):
+
+    if paths:
+
+        sys.stdout.write(title + " (" + str(len(paths)) + "):\n")
+
+        for path in paths:
+
+            sys.stdout.write("    " + path + "\n")
+
+
+def main():
+    """
+    Compares the branch with the view and reports the differences.
+
+    """
+
+    # Load user messages
+    _ = HooksConfig.get_translations()
+
+    parser = optparse.OptionParser(
+        usage="%prog [--branch <branch>] [--plan <file>] [<bare repository>]")
+    parser.add_option("--branch", help="branch to compare with the view, by "
+                      "default the first synchronized branch")
+    parser.add_option("--plan", help="file where the repair plan is written")
+    options, args = parser.parse_args()
+
+    if args:
+
+        os.chdir(args[0])
+
+    try:
+
+        config = HooksConfig()
+        Log.configure(*config.get_log_levels())
+        Log.set_context(ref="reconcile")
+
+        git = GIT()
+        branch = options.branch or config.get_sync_branches()[0]
+        mapping = config.get_branch_mapping(branch)
+        view = os.path.normpath(config.get_view())
+        vobs = None
+
+        # Branches with their own view are compared with it
+        if mapping is not None:
+
+            view = os.path.normpath(mapping[0])
+            vobs = mapping[1]
+
+        revision = git.resolve("refs/heads/" + branch)
+
+        if revision is None:
+
+            raise GITError("refs/heads/" + branch + _("ref_not_found"))
+
+        tree = git.list_tree(revision)
+        files = walk_view(view)
+        manifest = {}
+
+        if mapping is None and Manifest().revision() == revision:
+
+            manifest = Manifest().files()
+
+        missing, extra, different = compare(tree, files, view, manifest)
+        checkouts = ClearCase(view, vobs).list_checkouts_in_all_vobs()
+
+    except (GITError, CCError, ConfigException) as e:
+        Log.error("{0} {1}".format(_("reconcile_error"), e.value))
+        sys.exit(2)
+
+    except:
+        Log.error("{0} {1}".format(_("reconcile_error"),
+                                   traceback.format_exc()))
+        sys.exit(2)
+
+    sys.stdout.write(branch + " " + revision + " / " + view + ": " +
+                     str(len(tree)) + " files in GIT, " + str(len(files)) +
+                     " in the view\n")
+    report("Missing in the view", missing)
+    report("Only in the view", extra)
+    report("Different content", different)
+    report("Checked out", checkouts)
+
+    if options.plan:
+
+        write_plan(options.plan, missing, extra, different)
+
+    if missing or extra or different or checkouts:
+
+        sys.exit(1)
+
+    sys.stdout.write("The view matches " + branch + "\n")
+
+
+if __name__ == "__main__":
+
+    main()
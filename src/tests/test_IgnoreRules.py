@@ -0,0 +1,124 @@
+"""
+@summary: Checks the ignore rules against the gitignore semantics. Run it from
+the src directory: python -m unittest discover -s tests
+
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from IgnoreRules import DEFAULT_PATTERNS
+from IgnoreRules import IgnoreRules
+from IgnoreRules import _MAX_GROUPS
+
+# [<patterns>, <path>, <is directory>, <ignored>]
+CASES = [
+    # Names at any level
+    [["*.o"], "a.o", False, True],
+    [["*.o"], "src/lib/a.o", False, True],
+    [["*.o"], "a.oo", False, False],
+    [["core"], "src/core", False, True],
+    [["core"], "src/core/main.c", False, True],
+    [["?.c"], "a.c", False, True],
+    [["?.c"], "ab.c", False, False],
+    [["[ab].c"], "b.c", False, True],
+    [["[ab].c"], "c.c", False, False],
+    [["[!ab].c"], "c.c", False, True],
+    # Anchoring
+    [["/vendor"], "vendor", True, True],
+    [["/vendor"], "src/vendor", True, False],
+    [["docs/generated"], "docs/generated/index.html", False, True],
+    [["docs/generated"], "src/docs/generated", True, False],
+    [["doc/*.txt"], "doc/a.txt", False, True],
+    [["doc/*.txt"], "doc/sub/a.txt", False, False],
+    # Directories only
+    [["build/"], "build", True, True],
+    [["build/"], "build", False, False],
+    [["build/"], "src/build", True, True],
+    [["build/"], "src/build/out.o", False, True],
+    [["*.d/"], "x.d", False, False],
+    [["*.d/"], "x.d/y", False, True],
+    # '**'
+    [["**/logs"], "logs", True, True],
+    [["**/logs"], "a/b/logs", True, True],
+    [["a/**/b"], "a/b", False, True],
+    [["a/**/b"], "a/x/y/b", False, True],
+    [["a/**/b"], "c/a/b", False, False],
+    [["abc/**"], "abc/x/y", False, True],
+    [["abc/**"], "abc", True, False],
+    # Negation: the last matching pattern decides
+    [["*.log", "!keep.log"], "keep.log", False, False],
+    [["*.log", "!keep.log"], "other.log", False, True],
+    [["!keep.log", "*.log"], "keep.log", False, True],
+    [["tmp*", "!tmp?.c"], "tmp1.c", False, False],
+    [["/out", "!out"], "out", False, False],
+    # A path of an excluded directory cannot be synchronized again
+    [["build/", "!build/keep"], "build/keep", False, True],
+    [["build/", "!build/"], "build/keep", False, False],
+    # The root .gitignore file
+    [[], ".gitignore", False, True],
+    [[], "src/.gitignore", False, False],
+    [["!/.gitignore"], ".gitignore", False, False],
+]
+
+# More wildcard patterns than groups in one regular expression
+FILLERS = ["f%d_*" % i for i in range(_MAX_GROUPS + 50)]
+
+SPLIT_CASES = [
+    [FILLERS, "f0_a", False, True],
+    [FILLERS, "f%d_a" % (_MAX_GROUPS + 49), False, True],
+    [FILLERS, "g_a", False, False],
+    [["x*"] + FILLERS + ["!xy*"], "xy", False, False],
+    [["x*"] + FILLERS + ["!xy*"], "xz", False, True],
+    [["!xy*"] + FILLERS + ["x*"], "xy", False, True],
+    [FILLERS + ["!f3_*"], "f3_a", False, False],
+    [["!f%d_*" % (_MAX_GROUPS + 10)] + FILLERS,
+     "f%d_a" % (_MAX_GROUPS + 10), False, True],
+]
+
+
+def rules(patterns):
+    """
+    Returns ignore rules compiled from the given patterns, without reading
+    the configuration.
+
+    """
+
+    ignore_rules = object.__new__(IgnoreRules)
+    ignore_rules._compile(DEFAULT_PATTERNS + patterns)
+
+    return ignore_rules
+
+
+class IgnoreRulesTest(unittest.TestCase):
+
+    def check(self, cases):
+
+        for patterns, path, is_dir, ignored in cases:
+
+            self.assertEqual(rules(patterns).ignored(path, is_dir), ignored,
+                             "%s %s%s" % (patterns[-3:], path,
+                                          "/" if is_dir else ""))
+
+    def test_patterns(self):
+
+        self.check(CASES)
+
+    def test_split(self):
+
+        self.check(SPLIT_CASES)
+
+    def test_filter(self):
+
+        file_status_list = [["M", "a.o"], ["A", "src/a.c"], ["D", "build/x"]]
+
+        self.assertEqual(list(rules(["*.o", "build/"]).filter(
+            file_status_list)), [["A", "src/a.c"]])
+
+
+if __name__ == "__main__":
+
+    unittest.main()
@@ -10,188 +10,311 @@ excecution of a push operation takes effect.
 
 import os
 import sys
+import time
 import traceback
-import re
+import Admission
 import Log
+import Profiler
 
+from CheckoutTree import CheckoutTree
 from ClearCase import CCError
 from ClearCase import ClearCase
+from CommandEngine import CommandEngine
 from GIT import GIT
 from GIT import GITError
 from HooksConfig import ConfigException
 from HooksConfig import HooksConfig
-
-def add_file(ccpath):
+from Ledger import from_clearcase
+from MetadataCache import MetadataCache
+from Metrics import Metrics
+from PushMetadata import PushMetadata
+from ShardMap import ShardMap
+from ViewLock import ViewLockError
+
+def add_files(ccpaths, cc):
     """
-    Creates all necessary directories in the git_file path. If a problem
-    occurs during the execution of this method it will finish the execution of
-    the script printing a message to the user.
+    Creates all necessary directories in the paths of the added files. Every
+    parent directory is checked out and checked in only once.
 
     """
-    cc = ClearCase()
-    cc.create_path(os.path.dirname(ccpath))
+    cc.create_paths([os.path.dirname(ccpath) for ccpath in ccpaths])
 
 
-def modify_file(ccpath, committer, comments):
+def modify_file(ccpath, metadata, cc):
     """
     This procedure checks out the file in ClearCase.
 
     """
 
-    cc = ClearCase()
-    co_comment = committer + ".GIT push:" + os.linesep
-    make_label = False
-
-    for comment in comments:
-
-        m = re.search('@[A-Z_0-9]*',comment)
-        if m is not None:
-          label = m.group(0)[1:]
-          Log.debug("Label found: " + label)
-          make_label = True
-          co_comment += re.sub('@[A-Z_0-9]*',"",comment) + os.linesep
-        else:
-          co_comment += comment + os.linesep
+    Log.debug ("Making checkout FILE : " + ccpath + "  COMMENT:" +
+               metadata.checkout_comment);
 
-    Log.debug ("Making checkout FILE : " + ccpath + "  COMMENT:" + co_comment);
+    cc.checkout(ccpath, metadata.checkout_comment)
 
-    cc.checkout(ccpath, co_comment)
-    if make_label:
-          cc.makelabel(ccpath, label)
 
-def process_deletions(cc_view_path, old_revision, new_revision):
+def label_files(ccpaths, metadata, cc):
     """
-    This procedure deletes all necessary files and folders from the file system
-    and from ClearCase version.
+    Sets every label requested in the push comments to the given files in one
+    labelling pass.
 
     """
 
-    git = GIT()
-    cc = ClearCase()
-    deletion_list = git.list_deletions(old_revision, new_revision)
-    co_list = []
-    
-    for deletion in deletion_list:
+    if not metadata.labels or not ccpaths:
 
-        """
-        We must check dpath existence every time because it could be deleted in
-        a previous iteration. For example:
+        return
 
-        deletion_list = ["dir1", "dir1/dir2", "dir1/dir2/file"]
+    Log.debug("Labels found: " + " ".join(metadata.labels))
 
-        We could delete the list in reverse but is more efficient delete just
-        dir1 folder because we do only one call to CC.
+    for vob_paths in cc.group_by_vob(ccpaths).values():
 
-        """
+        cc.create_and_set_labels_list(vob_paths, metadata.labels)
 
-        dpath = cc_view_path + deletion
+def process_deletions(shard, old_revision, new_revision):
+    """
+    This procedure deletes all necessary files and folders of the shard from
+    the file system and from ClearCase version.
 
-        if os.path.exists(dpath):
+    """
+
+    git = GIT()
+    cc = shard.cc
+    cc_view_path = shard.view + os.sep
+    deletion_list = [deletion for deletion
+                     in git.list_deletions(old_revision, new_revision)
+                     if shard.owns(deletion)]
+    co_list = CheckoutTree()
 
-            cc.remove_name(dpath, co_list)
+    # Only top-most deleted entries are removed, with one rmname per parent
+    cc.remove_names([cc_view_path + deletion for deletion in deletion_list],
+                    co_list)
 
     # Checkout dirs for delete files are check-in.
     #
     cc.checkin_list (co_list)
 
-def process_push(committer, comments, file_status_list, old_revision,
-                 new_revision):
+def log_push_files(file_status_list):
     """
-    This procedure executes the right ClearCase operation for every file in
-    the file_status_list.
+    Logs and measures the files received in the push.
 
     """
 
-    Log.debug("Processing push...")
-    Log.debug("committer: " + committer)
-    comments_str = '\n'.join(str(c) for c in comments)
-    Log.debug("comments: " + comments_str)
     Log.info("Files received to synchronise with ClearCase: ")
     Log.info ("============================================")
     #[<File status>, <Path to file>]
     #M       icas/ccm/configurations/fdp/dep_evatool_fdp.xml
     #D       icas/ccm/load_balancer/Makefile
+    files_by_status = {}
     for file_status in file_status_list:
         Log.info("  " + file_status[0] + "  " + file_status[1])
+        files_by_status[file_status[0]] = \
+            files_by_status.get(file_status[0], 0) + 1
     Log.info ("============================================")
-    delete_mark = False
 
-    # Path to ClearCase view
-    try:
+    for status, count in files_by_status.items():
+        Metrics().observe("git2cc_push_files", count, status=status)
 
-        config = HooksConfig()
-        cc_view_path = config.get_view() + os.sep
+    Profiler.record_files(len(file_status_list))
+
+def process_push(committer, comments, file_status_list, old_revision,
+                 new_revision, shard):
+    """
+    This procedure executes the right ClearCase operation for every file in
+    the file_status_list, all of them in the view of the given shard.
 
-    except:
+    """
 
-        raise
+    Log.debug("Processing push in shard " + shard.name + "...")
+    Log.debug("committer: %s", committer)
+    Log.debug(lambda: "comments: " + '\n'.join(str(c) for c in comments))
+
+    delete_mark = False
+    added_files = []
+    modified_files = []
+
+    # Comment and labels are the same for every file of the push
+    metadata = PushMetadata(committer, comments)
+
+    # Path to ClearCase view
+    cc_view_path = shard.view + os.sep
 
     # Load user messages
     _ = HooksConfig.get_translations()
 
-    # Process every file
+    # Process every file. Ignored files (see IgnoreRules) are not in the
+    # list, they must have no version in CC.
     for git_file in file_status_list:
 
-        if git_file[1] != ".gitignore":
-            """
-            .gitignore file must have no version in CC.
-            Note: In the future could be interesting a list of ignored files.
-
-            """
+        if git_file[0] == 'A':
 
-            if git_file[0] == 'A':
+            added_files.append(cc_view_path + git_file[1])
 
-                add_file(cc_view_path + git_file[1])
+        elif git_file[0] == 'M':
 
-            elif git_file[0] == 'M':
+            modify_file(cc_view_path + git_file[1], metadata, shard.cc)
+            modified_files.append(cc_view_path + git_file[1])
 
-                modify_file(cc_view_path + git_file[1], committer, comments)
+        elif git_file[0] == 'D':
 
-            elif git_file[0] == 'D':
+            if not delete_mark:
 
-                if not delete_mark:
+                delete_mark = True
 
-                    delete_mark = True
+        else:
 
-            else:
+            efile = cc_view_path + git_file[1]
+            Log.error ("{0} {1} {2}".format(_("update_hook_error"),
+                                       _("filestatus_not_supported"),
+                                       efile))
+            sys.exit(1)
 
-                efile = cc_view_path + git_file[1]
-                Log.error ("{0} {1} {2}".format(_("update_hook_error"),
-                                           _("filestatus_not_supported"),
-                                           efile))
-                sys.exit(1)
+    label_files(modified_files, metadata, shard.cc)
 
-        else:
+    # New directories are created in one pass grouped by parent
+    if added_files:
 
-            ignored_path = cc_view_path + git_file[1]
-            Log.error ("{0} : {1} {2}".format(_("NOTICE"),
-                                         ignored_path,
-                                         _("avoided_file")))
+        add_files(added_files, shard.cc)
 
     # Deleted files require a special treatment.
     if delete_mark:
 
-        process_deletions(cc_view_path, old_revision, new_revision)
+        process_deletions(shard, old_revision, new_revision)
+
+
+def affected_element(cc_view_path, git_file):
+    """
+    Returns the existing ClearCase element the synchronization of the given
+    file will query or check out: the file itself when it is modified and its
+    parent directory when it is added or deleted.
+
+    """
+
+    ccpath = cc_view_path + git_file[1]
+
+    if git_file[0] != 'M':
+
+        ccpath = os.path.dirname(ccpath)
+
+    return ccpath
+
+
+def load_push_info(git, shards, old_revision, new_revision,
+                   file_status_list=None):
+    """
+    Returns the committer, the comments list and the file status list of the
+    push. The committer and the comments are read in the background while the
+    diff is streamed (unless the file status list is already known); as soon
+    as each changed path comes out of the diff, the ClearCase state of its
+    element starts being resolved, so it is ready when the synchronization
+    starts.
+
+    """
+
+    committer_future = git.get_committer_async(new_revision)
+    comments_future = git.get_comments_list_async(old_revision, new_revision)
+
+    git_files = file_status_list
+
+    if git_files is None:
+
+        git_files = git.iter_commit_files(old_revision, new_revision)
+
+    file_status_list = []
+    state_futures = []
+    prefetched = set()
+
+    for git_file in git_files:
+
+        file_status_list.append(git_file)
+
+        shard = shards.shard_of(git_file[1])
+        element = affected_element(shard.view + os.sep, git_file)
+
+        if element not in prefetched:
+
+            prefetched.add(element)
+            state_futures.extend(shard.cc.prefetch_states([element]))
+
+    committer = committer_future.result()
+    comments = comments_future.result()
+
+    # Prefetch failures are not fatal: the synchronization queries again
+    for error in CommandEngine.wait_all(state_futures):
+
+        Log.debug("ClearCase state prefetch failed: " + str(error))
+
+    Log.debug("ClearCase state prefetched for " + str(len(prefetched)) +
+              " elements")
+
+    return committer, comments, file_status_list
+
+
+def check_modifications(git, shards, old_revision, new_revision,
+                        file_status_list=None):
+    """
+    Checks, without changing ClearCase, that every file modified by the push
+    can be checked out in the view of its shard, so a conflict rejects the
+    push before the post-receive hook replays it.
+
+    Raises CCError exception on the first conflict.
+
+    """
+
+    if file_status_list is None:
+
+        file_status_list = git.get_commit_files(old_revision, new_revision)
+
+    for shard, files in shards.split(file_status_list):
+
+        shard.cc.check_checkouts([shard.view + os.sep + git_file[1]
+                                  for git_file in files
+                                  if git_file[0] == 'M'])
+
+
+def admit(git, shards, old_revision, new_revision, file_status_list):
+    """
+    Estimates the duration of the ClearCase synchronization of the push
+    before any cleartool command runs and returns the decision of the
+    admission control (see Admission).
+
+    """
+
+    # Load user messages
+    _ = HooksConfig.get_translations()
+
+    metadata = PushMetadata("", git.get_comments_list(old_revision,
+                                                      new_revision))
+    cost = Admission.PushCost(shards, file_status_list, metadata.labels)
+    decision = cost.decision()
+
+    Log.info("Estimated ClearCase synchronization: %.1fs (%s)" %
+             (cost.seconds, decision))
+    Log.debug(lambda: "Estimated cleartool commands: " +
+              ", ".join("%s %d" % (command, count) for command, count
+                        in sorted(cost.commands.items()) if count))
+
+    if decision == Admission.REJECTED:
+
+        Log.error("{0} {1} {2:.0f}s. {3}".format(_("update_hook_error"),
+                                                 _("push_too_expensive"),
+                                                 cost.seconds,
+                                                 _("split_push")))
+
+    return decision
 
 
-def do_sync(old_revision, new_revision, git, cc_pusher_user):
+def do_sync(old_revision, new_revision, git):
     """
     Checks conditions to do a Clearcase sync:
         * Old revision must be not null.
         * New revision must exists (For example, a tag has no new revision.
-        * Committer must be different from the cc_pusher_user defined in the
-        configuration file
+        * New revision must not come from ClearCase (see Ledger.from_clearcase)
     """
 
     sync = False
 
     if not git.isNullRevision(old_revision) and new_revision is not None:
 
-        committer = git.get_committer(new_revision)
-        if (committer == cc_pusher_user):
-            Log.debug ("Commiter is the Clearcase pusher: " + cc_pusher_user + ", no sync is done, it is a push from Clearcase")
-            
-        sync = committer != cc_pusher_user
+        sync = not from_clearcase(git, new_revision)
 
     return sync
 
@@ -202,25 +325,25 @@ def main():
     before GIT updates any reference.
 
     """
+    start = time.time()
+
     # Get args
     # hook_script = sys.argv[0]
     refs = sys.argv[1]
     old_revision = sys.argv[2]
     new_revision = sys.argv[3] if len(sys.argv) > 3 else None
 
-    Log.debug ("=====================")
-    Log.debug ("START NEW PUSH/UPDATE")
-    Log.debug ("=====================")
-    Log.debug ("refs: " + refs)
-    Log.debug ("old_revision: " + old_revision)
-    Log.debug ("new_revision: " + new_revision)
-    Log.debug ("=====================")
-
     try:
 
         # Load user messages and configuration
         _ = HooksConfig.get_translations()
         config = HooksConfig()
+        Log.configure(*config.get_log_levels())
+        Log.set_context(ref=refs)
+
+        if config.get_log_collector() is not None:
+
+            Log.use_collector(config.get_log_collector())
 
     except (ConfigException) as e:
 
@@ -231,11 +354,25 @@ def main():
     ref[0] = "refs"
     ref[1] can be: "heads", "remotes", "tags"
     ref[2] can be: a reference to the head (branch),
-                remote or tags respectively
+                remote or tags respectively, with any '/' it contains
     """
-    refs = refs.split('/')
+    refs = refs.split('/', 2)
 
-    if refs[1] == "heads" and refs[2] in config.get_sync_branches():
+    # Fast path: only branches are synchronized, other references are
+    # accepted without any further work
+    if refs[1] != "heads":
+
+        return
+
+    Log.debug ("=====================")
+    Log.debug ("START NEW PUSH/UPDATE")
+    Log.debug ("=====================")
+    Log.debug ("refs: " + '/'.join(refs))
+    Log.debug ("old_revision: " + old_revision)
+    Log.debug ("new_revision: " + str(new_revision))
+    Log.debug ("=====================")
+
+    if refs[2] in config.get_sync_branches():
 
         Log.info("{0}".format(_("branch_sync") + refs[2]))
         Log.debug("This git branch '" + refs[2] +
@@ -243,43 +380,195 @@ def main():
         try:
 
             git = GIT()
-            sync = do_sync(old_revision, new_revision, git,
-                           config.get_cc_pusher_user())
-
-            if sync:
-
-                # Load push info
-                committer = git.get_committer(new_revision)
-                comments = git.get_comments_list(old_revision, new_revision)
-                file_status_list = git.get_commit_files(old_revision,
-                                                        new_revision)
+            sync = do_sync(old_revision, new_revision, git)
 
         except (GITError, ConfigException) as e:
 
             Log.error("{0} {1}".format(_("update_hook_error"), e.value))
+            Metrics().record_push("update", "rejected", time.time() - start)
             sys.exit(1)
 
         except:
 
             Log.error("{0} {1}".format(_("update_hook_unexpected_error"),
                                    sys.exc_info()))
+            Metrics().record_push("update", "rejected", time.time() - start)
             sys.exit(1)
 
         if sync:
 
+            # Concurrent pushes must use the view of every shard they touch
+            # one after another
             try:
 
-                process_push(committer, comments, file_status_list,
-                             old_revision, new_revision)
+                shards = ShardMap(refs[2])
+                file_status_list = None
+                admission = config.get_admission_enabled()
+                decision = Admission.INLINE
+
+                # Only the views of the shards changed by the push are locked
+                if shards.is_sharded() or admission:
+
+                    file_status_list = git.get_commit_files(old_revision,
+                                                            new_revision)
+
+                # The cost is estimated before waiting for any view
+                if admission:
+
+                    decision = admit(git, shards, old_revision, new_revision,
+                                     file_status_list)
+
+                    if decision == Admission.REJECTED:
+
+                        Metrics().record_push("update", "rejected",
+                                              time.time() - start)
+                        sys.exit(1)
+
+                locked = shards.touched(file_status_list or [])
+                ShardMap.acquire(locked, config.get_lock_timeout())
+
+            except (GITError, ConfigException, ViewLockError) as e:
+
+                Log.error("{0} {1}".format(_("update_hook_error"), e.value))
+                Metrics().record_push("update", "rejected",
+                                      time.time() - start)
+                sys.exit(1)
+
+            except (OSError, IOError) as e:
+
+                Log.error("{0} {1}".format(_("update_hook_error"), str(e)))
+                Metrics().record_push("update", "rejected",
+                                      time.time() - start)
+                sys.exit(1)
+
+            try:
+
+                # A branch with its own view is checked in on the ClearCase
+                # branch of the view config spec
+                for shard in locked:
+
+                    if shard.cc_branch is not None:
+
+                        shard.cc.check_branch(shard.cc_branch)
+
+            except CCError as e:
+
+                Log.error("{0} {1}".format(_("update_hook_error"), e.value))
+                ShardMap.release(locked)
+                Metrics().record_push("update", "rejected",
+                                      time.time() - start)
+                sys.exit(1)
+
+            if config.get_sync_mode() == "replay":
+
+                # The post-receive hook replays the commits of the push with
+                # the locks taken here, once the files it modifies are known
+                # to be free to check out
+                try:
+
+                    check_modifications(git, shards, old_revision,
+                                        new_revision, file_status_list)
+
+                except (GITError, CCError) as e:
+
+                    Log.error("{0} {1}".format(_("update_hook_error"),
+                                               e.value))
+                    ShardMap.release(locked)
+                    Metrics().record_push("update", "rejected",
+                                          time.time() - start)
+                    sys.exit(1)
+
+                Log.debug("Replay mode: ClearCase is updated by post-receive")
+                Metrics().record_push("update", "synced", time.time() - start)
+                return
+
+            if decision == Admission.DEFERRED:
+
+                # The post-receive hook writes the push commit by commit, as in
+                # replay mode, with the locks taken here
+                try:
+
+                    check_modifications(git, shards, old_revision,
+                                        new_revision, file_status_list)
+
+                except (GITError, CCError) as e:
+
+                    Log.error("{0} {1}".format(_("update_hook_error"),
+                                               e.value))
+                    ShardMap.release(locked)
+                    Metrics().record_push("update", "rejected",
+                                          time.time() - start)
+                    sys.exit(1)
+
+                try:
+
+                    Admission.defer(refs, new_revision)
+
+                except (OSError, IOError) as e:
+
+                    Log.error("{0} {1}".format(_("update_hook_error"), str(e)))
+                    ShardMap.release(locked)
+                    Metrics().record_push("update", "rejected",
+                                          time.time() - start)
+                    sys.exit(1)
+
+                Log.info("Push deferred: ClearCase is updated by post-receive")
+                Metrics().record_push("update", "deferred",
+                                      time.time() - start)
+                return
+
+            try:
+
+                # Load push info
+                committer, comments, file_status_list = load_push_info(
+                    git, shards, old_revision, new_revision,
+                    file_status_list)
+
+            except (GITError, ConfigException) as e:
+
+                Log.error("{0} {1}".format(_("update_hook_error"), e.value))
+                ShardMap.release(locked)
+                Metrics().record_push("update", "rejected",
+                                      time.time() - start)
+                sys.exit(1)
+
+            except:
+
+                Log.error("{0} {1}".format(_("update_hook_unexpected_error"),
+                                       sys.exc_info()))
+                ShardMap.release(locked)
+                Metrics().record_push("update", "rejected",
+                                      time.time() - start)
+                sys.exit(1)
+
+            try:
+
+                Log.debug("Processing push...")
+                log_push_files(file_status_list)
+
+                # Every shard is synchronized in its own view at the same time
+                CommandEngine.parallel("shard", lambda shard, files:
+                                       process_push(committer, comments,
+                                                    files, old_revision,
+                                                    new_revision, shard),
+                                       shards.split(file_status_list))
+
+                MetadataCache().log_statistics()
+
+                Metrics().record_push("update", "synced", time.time() - start)
 
             except (CCError, ConfigException) as e:
 
                 Log.error("{0} {1}".format(_("update_hook_error"), e.value))
 
                 # Try to recover previous state
-                cc = ClearCase()
-                cc.uncheckout_all()
+                for shard in locked:
+
+                    shard.cc.uncheckout_all()
 
+                ShardMap.release(locked)
+                Metrics().record_push("update", "rejected",
+                                      time.time() - start)
                 sys.exit(1)
 
             except:
@@ -288,16 +577,22 @@ def main():
                                        traceback.format_exc()))
 
                 # Try to recover previous state
-                cc = ClearCase()
-                cc.uncheckout_all()
+                for shard in locked:
 
+                    shard.cc.uncheckout_all()
+
+                ShardMap.release(locked)
+                Metrics().record_push("update", "rejected",
+                                      time.time() - start)
                 sys.exit(1)
 
+            # The lock is kept until the post-receive hook of this push
+            # checks in the files checked out here.
+
     else:
 
-        if refs[1] == "heads":
-            Log.debug("This git branch '" + refs[2] + "' is not configured as a synchronized Clearcase branch");
-            Log.error("{0}".format(_("branch_not_sync") + refs[2]))
+        Log.debug("This git branch '" + refs[2] + "' is not configured as a synchronized Clearcase branch");
+        Log.error("{0}".format(_("branch_not_sync") + refs[2]))
 
     Log.debug ("=====================")
     Log.debug ("END NEW PUSH/UPDATE")
@@ -305,4 +600,4 @@ def main():
 
 if __name__ == "__main__":
 
-    main()
+    Profiler.run("update", main)